@@ -17,6 +17,7 @@
         #imgs/sec: true average over entire train, only measures during actual training batches, so looks slow in the beginning
     #tensorboard logging: most items set to log per gradient update or per epoch
     #each epoch's leftover training items are appended to next epoch
+    #exact mid-epoch resume: --checkpoint_every_n_steps saves unet, optimizer, lr_scheduler + sampler position to output/resume_checkpoint
     #use convert_diffusers_to_original_sdxl to convert saved diffusers pipeline to safetensors
     #aspect ratio bucketing: multiple aspect ratio buckets per training resolution
     #multi-resolution: set a training resolution range
@@ -110,6 +111,7 @@
 
 import argparse
 from collections import defaultdict
+import functools
 import json
 import gc
 import logging
@@ -120,7 +122,8 @@ import time
 #import shutil #not currently used, but probably will be used later
 
 from accelerate import Accelerator
-from accelerate.utils import set_seed
+from accelerate.data_loader import DataLoaderShard
+from accelerate.utils import broadcast_object_list, set_seed
 import bitsandbytes as bnb
 from diffusers import UNet2DConditionModel, StableDiffusionXLPipeline, AutoencoderKL, DDPMScheduler
 from diffusers.optimization import get_scheduler
@@ -130,8 +133,16 @@ import torch
 import torch.nn.functional as F #for F.mse_loss: mean squared error (MSE)
 from torch.utils.tensorboard import SummaryWriter
 from tqdm.auto import tqdm
-
-from sdxl_data_functions_18 import cache_image_caption_pair, cached_file_integrity_check, CachedImageDataset, BucketBatchSampler
+from transformers import CLIPTextModel, CLIPTextModelWithProjection
+
+from sdxl_data_functions_18 import cache_image_caption_pair, verify_cached_dataset, load_cached_json_list, CachedImageDataset, BucketBatchSampler, cached_batch_collate, apply_conditional_dropout, encode_caption_token_ids
+from sdxl_cache_format_functions_01 import PackedShardDataset, BucketMemmapDataset
+from sdxl_catalog_functions_01 import load_cached_metadata, catalog_filename
+from sdxl_bucket_functions_01 import get_bucket_engine
+from sdxl_shared_cache_functions_01 import NodeSharedCache, node_shared_cache_key
+from sdxl_prefetch_functions_01 import BatchPrefetcher
+from sdxl_readahead_functions_01 import ReadAheadService, readahead_modes
+from sdxl_tar_shard_functions_01 import TarShardIterableDataset
 from sdxl_validation_functions_23 import make_sample_images, calculate_validation_image_scores, calculate_validation_loss
 
 
@@ -154,8 +165,30 @@ def main():
     parser.add_argument("--upscale_use_GFPGAN", action='store_true', help="after upscale image, use GFPGAN to fix face (use for photos only)")
     parser.add_argument("--save_upscale_samples", action='store_true', help="after upscale image, save_upscale_samples")
     parser.add_argument("--verify_cached_dataset_hash_values", action='store_true', help="before training, verify integrity of cached dataset")
+    parser.add_argument("--verify_deep_check", action='store_true', help="verify: also load cached tensors, check shape, dtype & NaN/Inf")
+    parser.add_argument("--verify_num_workers", type=int, default=16, help="verify: number of threads checking cached files")
+    parser.add_argument("--packed_shard_dirs", nargs='+', type=str, help="path/to/packed_shards : read cached tensors from packed shards, see sdxl_convert_cache_format")
+    parser.add_argument("--bucket_memmap_dirs", nargs='+', type=str, help="path/to/bucket_memmap : read cached tensors from memory-mapped bucket arrays, see sdxl_convert_cache_format")
+    parser.add_argument("--tar_shard_dirs", nargs='+', type=str, help="path/to/tar_shards : stream training items from tar shards, for caches on bulk storage, see sdxl_convert_cache_format")
+    parser.add_argument("--tar_shuffle_buffer", type=int, default=64, help="--tar_shard_dirs: streamed items held per aspect bucket before one is picked at random")
+    parser.add_argument("--tar_open_shards", type=int, default=4, help="--tar_shard_dirs: shards streamed at once per DataLoader worker, mixes buckets between batches")
     #training parameters
     parser.add_argument("--conditional_dropout_percent", type=float, default=0.1, help="percent of captions to replace with empty captions.")
+    parser.add_argument("--drop_leftover_items", action='store_true', help="drop each epoch's leftover training items, instead of appending them to next epoch")
+    parser.add_argument("--num_workers", type=int, default=0, help="DataLoader worker processes loading cached items, 0 = load in the training process")
+    parser.add_argument("--prefetch_factor", type=int, default=2, help="batches loaded in advance per DataLoader worker, used if --num_workers > 0")
+    parser.add_argument("--persistent_workers", action='store_true', help="keep DataLoader workers alive between epochs, used if --num_workers > 0")
+    parser.add_argument("--pin_memory", action='store_true', help="DataLoader returns batches in pinned memory, faster host to gpu copies")
+    parser.add_argument("--fetch_threads", type=int, default=8, help="threads reading a batch's cached files in parallel, per DataLoader worker, 0 = one item after another")
+    parser.add_argument("--prefetch_batches", type=int, default=2, help="training batches copied to the gpu ahead of the step on a side stream, 0 = accelerate places each batch when it is used")
+    parser.add_argument("--readahead_batches", type=int, default=0, help="training batches per gpu whose cached files are requested from the OS ahead of the dataset, for HDD/NFS cache dirs, grows with slow fetches, 0 = off")
+    parser.add_argument("--readahead_max_batches", type=int, default=32, help="upper limit of the adaptive --readahead_batches depth")
+    parser.add_argument("--readahead_mode", type=str, default="fadvise", choices=readahead_modes, help="fadvise: posix_fadvise WILLNEED hints, read: files are read on background threads, for filesystems that ignore fadvise")
+    parser.add_argument("--readahead_threads", type=int, default=8, help="background threads issuing --readahead_batches requests")
+    parser.add_argument("--node_shared_cache", action='store_true', help="pack cached tensors once per node into a ram disk, all local ranks read the same copy, see sdxl_shared_cache_functions")
+    parser.add_argument("--node_shared_cache_dir", type=str, default="/dev/shm/sdxl_dataset_cache", help="ram disk dir for --node_shared_cache")
+    parser.add_argument("--encode_text_on_the_fly", action='store_true', help="text encode each batch's cached token ids on every gpu instead of reading cached prompt embeds, .metadata.json cache format only")
+    parser.add_argument("--dataset_ram_cache_gb", type=float, default=0, help="in-RAM LRU cache of cached training tensors, GB per gpu process (split between its DataLoader workers), 0 = off")
     parser.add_argument("--gradient_accumulation_steps", type=int, default=60, help="number of gradient_accumulation_steps")
     parser.add_argument("--learning_rate_scheduler", type=str, default="constant_with_warmup", help='Choose between ["linear", "cosine", "cosine_with_restarts", "polynomial", "constant", "constant_with_warmup"]')
     parser.add_argument("--num_train_epochs", type=int, default=200, help="number of epochs to train")
@@ -173,7 +206,8 @@ def main():
     parser.add_argument("--save_state", action='store_true', help="save training state when saving model")
     parser.add_argument("--project_name", type=str, default="ABC", help="name of the project")
     parser.add_argument("--output_dir", type=str, help="path/to/output_dir, where to store samples/saved_models")
-    parser.add_argument("--load_saved_state", type=str, help="path/to/saved_state, for continuing training - check output/epoch/model")
+    parser.add_argument("--load_saved_state", type=str, help="path/to/saved_state, for continuing training - check output/epoch/model or output/resume_checkpoint")
+    parser.add_argument("--checkpoint_every_n_steps", type=int, default=0, help="mid-epoch checkpoint to output/resume_checkpoint every n steps (at the next gradient update), 0 = off")
     parser.add_argument("--start_save_model_epoch", type=int, default=0, help="epoch to begin saving models")
     #logging
     parser.add_argument("--log_dir", type=str, default="logs", help="logs_dir location")
@@ -240,8 +274,21 @@ def main():
     train_batch_size = args.train_batch_size #Batch size
     gradient_accumulation_steps = args.gradient_accumulation_steps
     effective_batch_size = num_processes * train_batch_size * gradient_accumulation_steps
-    num_workers = 0 #num_workers for dataloader, leave at 0, throws errors with other numbers.
+    num_workers = args.num_workers #num_workers for dataloader, dataset & sampler are worker safe (cpu tensors, dropout decided by sampler)
+    #prefetch_factor & persistent_workers: only valid with worker processes
+    dataloader_worker_kwargs = {"prefetch_factor": args.prefetch_factor, "persistent_workers": args.persistent_workers} if num_workers > 0 else {}
+    #pin_memory: no workers = cached_batch_collate allocates pinned buffers, workers = DataLoader pins batches
+    collate_fn = functools.partial(cached_batch_collate, pin_memory=args.pin_memory and num_workers == 0)
+    dataloader_pin_memory = args.pin_memory and num_workers > 0
+    fetch_threads = args.fetch_threads #CachedImageDataset.__getitems__ thread pool, works with num_workers = 0
+    prefetch_batches = args.prefetch_batches #BatchPrefetcher, see sdxl_prefetch_functions
+    readahead_batches = args.readahead_batches #ReadAheadService, see sdxl_readahead_functions
+    #ram cache per process: each DataLoader worker gets its share, workers only keep their cache between epochs with --persistent_workers
+    dataset_ram_cache_gb = args.dataset_ram_cache_gb / max(1, num_workers)
     conditional_dropout_percent = args.conditional_dropout_percent
+    carry_leftover_items = not args.drop_leftover_items
+    #BucketBatchSampler seed: every rank derives the same batch order from (seed, epoch)
+    sampler_seed = args.set_seed if args.set_seed != None else 123
 
     #learning rate
     learning_rate = args.learning_rate #learning rate
@@ -252,8 +299,25 @@ def main():
 
     #dataset stuff
     verify_cached_dataset_hash_values = args.verify_cached_dataset_hash_values
+    verify_deep_check = args.verify_deep_check
+    verify_num_workers = args.verify_num_workers
     cached_dataset_dirs = args.cached_dataset_dirs
     cached_dataset_lists = args.cached_dataset_lists
+    packed_shard_dirs = args.packed_shard_dirs
+    bucket_memmap_dirs = args.bucket_memmap_dirs
+    tar_shard_dirs = args.tar_shard_dirs
+    #tar shards: training items only, validation reads the .metadata.json cache
+    #not prepared by accelerate, batches are placed on the gpu by BatchPrefetcher
+    if tar_shard_dirs != None:
+        if prefetch_batches == 0:
+            prefetch_batches = 1
+        if num_workers > 0 and args.persistent_workers:
+            accelerator.print("--persistent_workers not used with --tar_shard_dirs: workers read the epoch's shard plan when they start")
+            dataloader_worker_kwargs.pop("persistent_workers")
+    #token ids are read from .metadata.json / catalog, packed formats & node shared cache store prompt embeds
+    encode_text_on_the_fly = args.encode_text_on_the_fly and packed_shard_dirs == None and bucket_memmap_dirs == None and tar_shard_dirs == None and not args.node_shared_cache
+    if args.encode_text_on_the_fly and not encode_text_on_the_fly:
+        accelerator.print("--encode_text_on_the_fly not used: needs the .metadata.json cache format, not --packed_shard_dirs, --bucket_memmap_dirs, --tar_shard_dirs or --node_shared_cache")
     #ensure cached dataset was processed with same resolution values, these are only used to repair cached dataset
     max_resolution = args.max_resolution #image max_resolution
     min_resolution = args.min_resolution #image min_resolution
@@ -269,6 +333,8 @@ def main():
     save_state = args.save_state #whether to save state when saving models
     load_saved_state = args.load_saved_state #path to saved state, for resuming training
     resume_epoch = None
+    resume_epoch_step = 0 #steps per process already trained in resumed epoch
+    checkpoint_every_n_steps = args.checkpoint_every_n_steps #mid-epoch checkpoint, overwritten each time
 
     #dirs & names
     filename = os.path.basename(os.path.abspath(__file__)) #this file's name
@@ -377,104 +443,85 @@ def main():
     #read cached_dataset_lists
     if accelerator.is_main_process:
         print("\nprocessing cached_dataset_lists:")
-    cached_json_list = []
-    for item in cached_dataset_lists:
-        if accelerator.is_main_process:
-            print(f"processing {item}:")
-        with open(item, "r") as f:
-            cached_json_list_temp = f.readlines() #each line to an item in list
-            cached_json_list_temp  = [line.strip() for line in cached_json_list_temp ]  #remove newlines
-            cached_json_list_temp  = list(set(cached_json_list_temp )) #remove duplicates
-            cached_json_list_temp  = [item for item in cached_json_list_temp  if item] #remove empty items
-            
-            #append cached_json_list_temp to cached_json_list
-            cached_json_list = cached_json_list + cached_json_list_temp
-            '''
-            if accelerator.is_main_process:
-                for _item in cached_json_list_temp: #doesn't do anything, 
-                    print(f"\r{_item}", end="")  #just looks cool if lots of items
-            '''
-            print("\n  --complete")
-    print(f"processed: {len(cached_json_list)} cached image-caption pairs found")
+    if accelerator.is_main_process:
+        for item in cached_dataset_lists:
+            print(f"processing {item}")
+    #sorted & without duplicates: same order on every rank & launch, sampler resume state & validation split depend on it
+    cached_json_list = load_cached_json_list(cached_dataset_lists)
+    accelerator.print(f"processed: {len(cached_json_list)} cached image-caption pairs found")
 
 
     ##dataset integrity check
+    #main process verifies & re-caches, then broadcasts passed/failed lists, other processes wait
     if verify_cached_dataset_hash_values == True:
-
-        #open and read json_files
+        verify_result = [None]
         if accelerator.is_main_process:
             print("\nbeginning verify cached files integrity")
-        failed_hash_check = []
-        count = 0
-        for json_file in cached_json_list:
-            count += 1
-            #check hash_values
-            result = cached_file_integrity_check(json_file)
-            if accelerator.is_main_process:
-                print(f"\r{[count]}: {json_file}: {result}", end="") #just looking busy
-            #failed hash check
-            if result != "pass":
-                if accelerator.is_main_process:
-                    print(f"{json_file} : {result}")
-                failed_hash_check.append(json_file) #add to bad list
-                cached_json_list.remove(json_file) #remove from good list
-        #print initial pass check hash result
-        if accelerator.is_main_process:
+            cached_json_list, failed_hash_results = verify_cached_dataset(cached_json_list, verify_deep_check, verify_num_workers)
+            failed_hash_check = list(failed_hash_results)
+            #print initial pass check hash result
             if len(failed_hash_check) == 0:
-                if accelerator.is_main_process:
-                    print("\n --success : all files passed verification")
+                print(" --success : all files passed verification")
             else:
-                if accelerator.is_main_process:
-                    print(f"\rOh, No. {len(failed_hash_check)} files failed verification.")
-                    print(" --attempting re-caching failed files")
-
-
-        #process failed hash files --> try re-caching
-        #create failed_image_files & failed_caption_files lists
-        for json_file in failed_hash_check:
-            #open and read json_file metadata, append to failed captions list
-            with open(json_file, "r") as f: 
-                metadata = json.load(f)
-            basename = metadata["basename"]
-            cache_dir = metadata["cache_dir"]
-            data_dir = metadata["data_dir"]
-            image_file = metadata["image_file"]
-            caption_file = metadata["caption_file"]
-            #to tuple list
-            image_caption_files_tuple_list = []
-            failed_pair = (image_file, caption_file)
-            image_caption_files_tuple_list.append(failed_pair)
-            #try re-caching image-caption.txt pair
-            recached_json_list = cache_image_caption_pair(
-                    image_caption_files_tuple_list,
-                    pretrained_model_name_or_path,
-                    pretrained_vae_model_name_or_path,
-                    cache_dir,
-                    data_dir,
-                    basename,
-                    accelerator,
-                    device,
-                    max_resolution,
-                    min_resolution,
-                    upscale_to_resolution,
-                    upscale_use_GFPGAN,
-                    save_upscale_samples
-                )
-            #verify re-cached hash values
-            for json_file_recached in recached_json_list:
-                cached_file_integrity_check(json_file_recached)
-                #pass
-                if result == True:
-                    cached_json_list.append(json_file_recached)
-                    failed_hash_check.remove(json_file)
-                    if accelerator.is_main_process:
-                        print(f"{json_file_recached} re-cached successfully.  It's nice to be back.")
-                #fail
-                else:
-                    error_message = f"{json_file} double failed hash verification.  We tried, it's your responsibility now."
-                    if accelerator.is_main_process:
-                        print(error_message)
+                print(f"Oh, No. {len(failed_hash_check)} files failed verification.")
+                print(" --attempting re-caching failed files")
+
+            #process failed hash files --> try re-caching
+            #group failed image-caption.txt pairs by cached dataset, one cache_image_caption_pair call per dataset
+            recache_groups = defaultdict(list) #{(cache_dir, data_dir, basename): [(image_file, caption_file)]}
+            for json_file in failed_hash_check:
+                try:
+                    with open(json_file, "r") as f:
+                        metadata = json.load(f)
+                except Exception as e:
+                    error_message = f"{json_file} can't be re-cached, Error: {e}"
+                    print(error_message)
                     logging.error(error_message)
+                    continue
+                #metadata cache_dir is cache_dir/basename
+                recache_groups[(os.path.dirname(metadata["cache_dir"]), metadata["data_dir"], metadata["basename"])].append((metadata["image_file"], metadata["caption_file"]))
+                #remove stale json_file, item is fully re-cached
+                os.remove(json_file)
+
+            for (cache_dir, data_dir, basename), image_caption_files_tuple_list in recache_groups.items():
+                #try re-caching image-caption.txt pairs
+                #json_file paths don't change, the dataset's .list is kept: re-cached items get their own temporary .list
+                recache_list_file = os.path.join(cache_dir, basename, "recache.list")
+                recached_json_list = cache_image_caption_pair(
+                        image_caption_files_tuple_list,
+                        pretrained_model_name_or_path,
+                        pretrained_vae_model_name_or_path,
+                        cache_dir,
+                        data_dir,
+                        basename,
+                        accelerator,
+                        device,
+                        max_resolution,
+                        min_resolution,
+                        upscale_to_resolution,
+                        upscale_use_GFPGAN,
+                        save_upscale_samples,
+                        json_list_file=recache_list_file,
+                        cache_prompt_embeds=not encode_text_on_the_fly
+                    )
+                if os.path.exists(recache_list_file):
+                    os.remove(recache_list_file)
+                #verify re-cached hash values
+                recached_passed, recached_failed = verify_cached_dataset(recached_json_list, verify_deep_check, verify_num_workers)
+                for json_file_recached in recached_passed:
+                    cached_json_list.append(json_file_recached)
+                    failed_hash_check.remove(json_file_recached)
+                    print(f"{json_file_recached} re-cached successfully.  It's nice to be back.")
+            for json_file in failed_hash_check:
+                error_message = f"{json_file} double failed hash verification.  We tried, it's your responsibility now."
+                print(error_message)
+                logging.error(error_message)
+            verify_result = [(cached_json_list, failed_hash_check)]
+
+        #other processes: passed/failed lists from main process
+        broadcast_object_list(verify_result, from_process=0)
+        cached_json_list, failed_hash_check = verify_result[0]
+        cached_json_list = sorted(set(cached_json_list)) #verify & re-cache order varies between launches
 
         #completed dataset integrity check
         if accelerator.is_main_process:				
@@ -487,6 +534,38 @@ def main():
     dataset_initial_length = len(cached_json_list)
 
 
+    ##bulk read dataset metadata: catalog.sqlite next to each .list file, .metadata.json for items missing from catalogs
+    accelerator.print("\nreading cached dataset metadata")
+    catalog_paths = sorted(set(os.path.join(os.path.dirname(item), catalog_filename) for item in cached_dataset_lists))
+    metadata_lookup = load_cached_metadata(cached_json_list, catalog_paths)
+
+    #cached dataset & training resolution range must be the same: closest_buckets outside the range are reported
+    closest_buckets = [metadata_lookup[json_file]["closest_bucket"] for json_file in cached_json_list if json_file in metadata_lookup]
+    if accelerator.is_main_process and len(closest_buckets) > 0:
+        in_range = get_bucket_engine().buckets_in_range(closest_buckets, min_resolution, max(max_resolution, upscale_to_resolution or 0))
+        if not in_range.all():
+            error_message = f"Warning: {int((~in_range).sum())} cached items have a closest_bucket outside --min_resolution {min_resolution} to --max_resolution {max_resolution}, check the cached dataset resolution range"
+            print(error_message)
+            logging.error(error_message)
+    del closest_buckets
+
+    #caption format: --encode_text_on_the_fly needs token ids, cached prompt embeds need embed files
+        #token ids only items: cached with sdxl_process_data_dir --token_ids_only
+        #items cached before token ids existed: sdxl_process_data_dir --recache_captions_only adds them
+    num_without_token_ids = sum(1 for json_file in cached_json_list if metadata_lookup.get(json_file, {}).get("token_ids_one") is None)
+    num_without_prompt_embeds = sum(1 for json_file in cached_json_list if json_file in metadata_lookup and metadata_lookup[json_file].get("prompt_embed_file") is None)
+    if encode_text_on_the_fly and num_without_token_ids > 0:
+        error_message = f"--encode_text_on_the_fly not used: {num_without_token_ids} cached items have no token ids, re-cache captions with sdxl_process_data_dir --recache_captions_only"
+        accelerator.print(error_message)
+        logging.error(error_message)
+        encode_text_on_the_fly = False
+    if not encode_text_on_the_fly and num_without_prompt_embeds > 0:
+        error_message = f"Error: {num_without_prompt_embeds} cached items have token ids only, no prompt embeds: use --encode_text_on_the_fly, or re-cache without --token_ids_only"
+        accelerator.print(error_message)
+        logging.error(error_message)
+        return
+
+
     ##create sample_prompt_list after dataset completely finalized
     
     #read sample_prompts.txt
@@ -506,8 +585,9 @@ def main():
         accelerator.print("\ncollecting random_sample_image_prompts for sample_image_prompts")
         for i in range(num_needed_prompts):
             json_file = random.choice(cached_json_list)
-            with open(json_file, "r") as f: #open and read json file
-                metadata = json.load(f)
+            metadata = metadata_lookup.get(json_file)
+            if metadata is None: #unreadable metadata, already logged
+                continue
             caption_string = metadata["caption_string"]
             sample_image_prompts.append(caption_string)
     sample_image_prompts.sort()
@@ -523,7 +603,8 @@ def main():
     if validation_loss:
         accelerator.print("\npreparing validation_loss list")
         #shuffle cached_json_list to ensure randomness
-        random.shuffle(cached_json_list)
+        #seeded: same validation split on every rank & every launch, also without --set_seed
+        random.Random(sampler_seed).shuffle(cached_json_list)
         
         #organize json files by closest_bucket
         bucket_files = defaultdict(list)
@@ -531,12 +612,9 @@ def main():
 
         #read json files metadata
         for file_path in cached_json_list:
-            try:
-                with open(file_path, 'r') as file:
-                    metadata = json.load(file)
-            except Exception as e:
-                metadata = None
-                accelerator.print(f"create validation_loss list of lists: Error reading {file_path}: {e}")
+            metadata = metadata_lookup.get(file_path)
+            if metadata is None:
+                accelerator.print(f"create validation_loss list of lists: Error reading {file_path}")
                 
             #loss_validation is created to exactly fit buckets & batch_size
             if metadata:
@@ -553,7 +631,9 @@ def main():
         
         #remove validation_loss file from cached_json_list
         validation_loss_jsons = [item for sublist in validation_loss_list_of_lists for item in sublist]
-        cached_json_list = [file for file in cached_json_list if file not in validation_loss_jsons]
+        #sorted again: the train dataset's item order doesn't depend on the shuffle
+        validation_loss_json_set = set(validation_loss_jsons)
+        cached_json_list = sorted(file for file in cached_json_list if file not in validation_loss_json_set)
         with open(validation_loss_jsons_txt, "w") as file: 
                 for item in validation_loss_jsons:
                     file.write(f"{item}\n")
@@ -625,36 +705,114 @@ def main():
             del sorted_list
 
 
+    ##node shared cache: one copy of train & validation tensors per node, first local rank packs it, released before end_training
+    node_shared_cache = None
+    if args.node_shared_cache and packed_shard_dirs == None and bucket_memmap_dirs == None and tar_shard_dirs == None:
+        accelerator.print("\nnode shared cache setup:")
+        #cache key from the main process: json_files are stat'ed once, not on every rank
+        node_shared_cache_jsons = cached_json_list + validation_loss_jsons
+        cache_key = [node_shared_cache_key(node_shared_cache_jsons) if accelerator.is_main_process else None]
+        broadcast_object_list(cache_key, from_process=0)
+        node_shared_cache = NodeSharedCache(node_shared_cache_jsons, metadata_lookup, args.node_shared_cache_dir, cache_key=cache_key[0])
+        if not node_shared_cache.open():
+            node_shared_cache = None
+        accelerator.wait_for_everyone()
+
     ##setup train_dataset
     accelerator.print("\ntrain dataset setup:")
-    train_dataset = CachedImageDataset(cached_json_list, conditional_dropout_percent) 
+    if packed_shard_dirs != None:
+        train_dataset = PackedShardDataset(packed_shard_dirs, cached_json_list, conditional_dropout_percent, fetch_threads=fetch_threads)
+    elif bucket_memmap_dirs != None:
+        train_dataset = BucketMemmapDataset(bucket_memmap_dirs, cached_json_list, conditional_dropout_percent, fetch_threads=fetch_threads)
+    elif tar_shard_dirs != None:
+        train_dataset = TarShardIterableDataset(tar_shard_dirs, train_batch_size, cached_json_list, conditional_dropout_percent, seed=sampler_seed, process_index=accelerator.process_index, num_processes=num_processes, num_workers=num_workers, shuffle_buffer=args.tar_shuffle_buffer, open_shards=args.tar_open_shards)
+    elif node_shared_cache != None:
+        train_dataset = node_shared_cache.dataset(cached_json_list, conditional_dropout_percent, fetch_threads=fetch_threads)
+    else:
+        train_dataset = CachedImageDataset(cached_json_list, conditional_dropout_percent, metadata_lookup, fetch_threads=fetch_threads, ram_cache_gb=dataset_ram_cache_gb, load_prompt_embeds=not encode_text_on_the_fly)
     accelerator.print(f"len_train_dataset: {len(train_dataset)}")
+    if args.dataset_ram_cache_gb > 0 and (packed_shard_dirs != None or bucket_memmap_dirs != None or node_shared_cache != None):
+        accelerator.print("  --dataset_ram_cache_gb not used: packed shards, bucket memmap & node shared cache are memory-mapped, already in RAM / page cache")
+    if args.dataset_ram_cache_gb > 0 and tar_shard_dirs != None:
+        accelerator.print("  --dataset_ram_cache_gb not used: tar shards are streamed, items are read once per epoch")
+
+    #read-ahead of upcoming training batches, node shared cache is already in RAM
+    readahead = None
+    if readahead_batches > 0 and node_shared_cache == None and tar_shard_dirs == None:
+        readahead = ReadAheadService(train_dataset, readahead_batches, args.readahead_max_batches, args.readahead_threads, args.readahead_mode, accelerator.process_index, accelerator.num_processes)
+    elif readahead_batches > 0:
+        accelerator.print("  --readahead_batches not used: node shared cache is in a ram disk, tar shards are read sequentially")
+
+    if tar_shard_dirs != None:
+        #tar shards: the dataset yields same-bucket batches, it also takes the sampler's set_epoch & state_dict role
+        #DataLoaderShard without sharding or device placement: registers with accelerate's gradient state like a prepared dataloader
+            #accumulate() syncs on the epoch's last batch, the last partial accumulation window doesn't leak into the next epoch
+        train_bucket_batch_sampler = train_dataset
+        train_dataloader = DataLoaderShard(
+            train_dataset,
+            batch_size=None, #batches come from the dataset
+            collate_fn=collate_fn, #contiguous batch tensors, add_time_id [bsz, 6]
+            num_workers=num_workers,
+            pin_memory=dataloader_pin_memory,
+            **dataloader_worker_kwargs
+        )
+    else:
+        #create bucket batch sampler
+        train_bucket_batch_sampler = BucketBatchSampler(train_dataset, batch_size=train_batch_size, drop_last=True, seed=sampler_seed, carry_leftovers=carry_leftover_items, readahead=readahead)
+
+        #initialize the DataLoader with the bucket batch sampler
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_sampler=train_bucket_batch_sampler, #use bucket_batch_sampler instead of shuffle
+            collate_fn=collate_fn, #contiguous batch tensors, add_time_id [bsz, 6]
+            num_workers=num_workers,
+            pin_memory=dataloader_pin_memory,
+            **dataloader_worker_kwargs
+        )
 
-    #create bucket batch sampler
-    bucket_batch_sampler = BucketBatchSampler(train_dataset, batch_size=train_batch_size, drop_last=True)
-
-    #initialize the DataLoader with the bucket batch sampler
-    train_dataloader = torch.utils.data.DataLoader(
-        train_dataset,
-        batch_sampler=bucket_batch_sampler, #use bucket_batch_sampler instead of shuffle
-        num_workers=num_workers
-    )
+    #conditional dropout: dropped items skip their prompt embed files, empty embeds stay on device for the whole run
+    #apply_conditional_dropout swaps them into the dropped rows of each batch
+    empty_prompt_embed = train_dataset.empty_prompt_embed.to(accelerator.device)
+    empty_pooled_prompt_embed = train_dataset.empty_pooled_prompt_embed.to(accelerator.device)
+
+    #--encode_text_on_the_fly: frozen text encoders on every gpu, not prepared/sharded, fp32 weights + autocast like caching
+    text_encoders = None
+    if encode_text_on_the_fly:
+        accelerator.print("\nencode_text_on_the_fly: loading text encoders")
+        text_encoders = (
+            CLIPTextModel.from_pretrained(pretrained_model_name_or_path, subfolder="text_encoder"),
+            CLIPTextModelWithProjection.from_pretrained(pretrained_model_name_or_path, subfolder="text_encoder_2"),
+        )
+        for text_encoder in text_encoders:
+            text_encoder.requires_grad_(False)
+            text_encoder.eval()
+            text_encoder.to(accelerator.device)
 
 
     ##setup validation_dataset
     accelerator.print("\nvalidation dataset setup:")
     validation_conditional_dropout = 0.0
-    validation_loss_dataset = CachedImageDataset(validation_loss_jsons, validation_conditional_dropout) 
+    if packed_shard_dirs != None:
+        validation_loss_dataset = PackedShardDataset(packed_shard_dirs, validation_loss_jsons, validation_conditional_dropout, fetch_threads=fetch_threads)
+    elif bucket_memmap_dirs != None:
+        validation_loss_dataset = BucketMemmapDataset(bucket_memmap_dirs, validation_loss_jsons, validation_conditional_dropout, fetch_threads=fetch_threads)
+    elif node_shared_cache != None:
+        validation_loss_dataset = node_shared_cache.dataset(validation_loss_jsons, validation_conditional_dropout, fetch_threads=fetch_threads)
+    else:
+        validation_loss_dataset = CachedImageDataset(validation_loss_jsons, validation_conditional_dropout, metadata_lookup, fetch_threads=fetch_threads, load_prompt_embeds=not encode_text_on_the_fly)
     accelerator.print(f"len_validation_loss_dataset: {len(validation_loss_dataset)}")
 
     #create bucket batch sampler
-    bucket_batch_sampler = BucketBatchSampler(validation_loss_dataset, batch_size=train_batch_size, drop_last=True)
+    validation_bucket_batch_sampler = BucketBatchSampler(validation_loss_dataset, batch_size=train_batch_size, drop_last=True, seed=sampler_seed)
 
     #initialize the DataLoader with the bucket batch sampler
     validation_loss_dataloader = torch.utils.data.DataLoader(
         validation_loss_dataset,
-        batch_sampler=bucket_batch_sampler, #use bucket_batch_sampler instead of shuffle
-        num_workers=num_workers
+        batch_sampler=validation_bucket_batch_sampler, #use bucket_batch_sampler instead of shuffle
+        collate_fn=collate_fn, #contiguous batch tensors, add_time_id [bsz, 6]
+        num_workers=num_workers,
+        pin_memory=dataloader_pin_memory,
+        **dataloader_worker_kwargs
     )
 
 
@@ -665,6 +823,14 @@ def main():
     num_update_steps_per_epoch = num_steps_per_epoch // gradient_accumulation_steps
     total_num_train_steps = num_train_epochs * num_steps_per_epoch
     total_num_update_steps = num_update_steps_per_epoch * num_train_epochs
+    #tar shards: batches per rank differ per epoch (shard plan from seed & epoch), summed over the trained epochs 1..num_train_epochs
+        #an epoch's last partial accumulation window is synced, one update step
+    if tar_shard_dirs != None:
+        tar_epoch_steps = [train_dataset.num_batches(epoch) for epoch in range(1, num_train_epochs + 1)]
+        total_num_train_steps = sum(tar_epoch_steps)
+        total_num_update_steps = sum((steps + gradient_accumulation_steps - 1) // gradient_accumulation_steps for steps in tar_epoch_steps)
+        num_steps_per_epoch = total_num_train_steps // max(1, num_train_epochs) #average, printed only
+        num_update_steps_per_epoch = total_num_update_steps // max(1, num_train_epochs)
     num_warmup_update_steps = percent_lr_warm_up_steps * total_num_update_steps
 
     #variables based on validation dataset & dataloader
@@ -718,7 +884,12 @@ def main():
             )
         
         #move everything to accelerate
-        unet, optimizer, train_dataloader, validation_loss_dataloader, lr_scheduler = accelerator.prepare(unet, optimizer, train_dataloader, validation_loss_dataloader, lr_scheduler) 
+        #train_dataloader: no device placement when BatchPrefetcher places batches
+        #tar shards: not prepared, every rank already streams its own shards
+        if tar_shard_dirs != None:
+            unet, optimizer, validation_loss_dataloader, lr_scheduler = accelerator.prepare(unet, optimizer, validation_loss_dataloader, lr_scheduler)
+        else:
+            unet, optimizer, train_dataloader, validation_loss_dataloader, lr_scheduler = accelerator.prepare(unet, optimizer, train_dataloader, validation_loss_dataloader, lr_scheduler, device_placement=[None, None, False if prefetch_batches > 0 else None, None, None]) 
 
         accelerator.print(" --loaded")
 
@@ -728,16 +899,25 @@ def main():
         accelerator.print(f"\nloading saved_state: {load_saved_state}")
         
         #load saved models
+        #mid-epoch checkpoints have no saved pipeline, use base model + unet_state_dict
+        if os.path.isdir(os.path.join(load_saved_state, "unet")):
+            saved_model_path = load_saved_state
+        else:
+            saved_model_path = pretrained_model_name_or_path
         noise_scheduler = DDPMScheduler.from_pretrained(
-            load_saved_state, subfolder="scheduler"
+            saved_model_path, subfolder="scheduler"
         )
         unet = UNet2DConditionModel.from_pretrained(
-            load_saved_state, subfolder="unet"
+            saved_model_path, subfolder="unet"
         )
 
         #temp loading unet solution, until BNB works with save_state
-        unet_stat_dict_path = os.path.join(load_saved_state, "unet_state_dict.pth")
-        unet_state_dict = torch.load(unet_stat_dict_path)
+        #mid-epoch checkpoints: full precision weights from unet_state_dict, epoch checkpoints use the saved pipeline's unet
+        if saved_model_path != load_saved_state:
+            unet_stat_dict_path = os.path.join(load_saved_state, "unet_state_dict.pth")
+            unet_state_dict = torch.load(unet_stat_dict_path, map_location="cpu")
+            unet.load_state_dict(unet_state_dict)
+            del unet_state_dict
         
         unet.train() #sets unet for training
         unet.enable_gradient_checkpointing()
@@ -761,7 +941,12 @@ def main():
             )
 
         #move everything to accelerate
-        unet, optimizer, train_dataloader, validation_loss_dataloader, lr_scheduler = accelerator.prepare(unet, optimizer, train_dataloader, validation_loss_dataloader, lr_scheduler) 
+        #train_dataloader: no device placement when BatchPrefetcher places batches
+        #tar shards: not prepared, every rank already streams its own shards
+        if tar_shard_dirs != None:
+            unet, optimizer, validation_loss_dataloader, lr_scheduler = accelerator.prepare(unet, optimizer, validation_loss_dataloader, lr_scheduler)
+        else:
+            unet, optimizer, train_dataloader, validation_loss_dataloader, lr_scheduler = accelerator.prepare(unet, optimizer, train_dataloader, validation_loss_dataloader, lr_scheduler, device_placement=[None, None, False if prefetch_batches > 0 else None, None, None]) 
 
         accelerator.print(" --loaded")
         
@@ -778,7 +963,28 @@ def main():
         resume_global_gradient_update_step = checkpoint["global_gradient_update_step"]
         resume_epoch = checkpoint["epoch"]
 
-        #add lr_scheduler later
+        #restore sampler: seed, epoch, leftover items, & position in epoch
+        if "train_sampler" in checkpoint:
+            train_sampler_state = checkpoint["train_sampler"]
+            if checkpoint.get("num_processes", num_processes) != num_processes and train_sampler_state["num_batches_consumed"] != 0:
+                warning_message = f"load_saved_state: saved with {checkpoint['num_processes']} processes, now {num_processes}: resuming at start of epoch {train_sampler_state['epoch']}"
+                print(warning_message)
+                logging.warning(warning_message)
+                train_sampler_state["num_batches_consumed"] = 0
+            train_bucket_batch_sampler.load_state_dict(train_sampler_state)
+            resume_epoch_step = train_bucket_batch_sampler.resume_num_batches // num_processes #tar shards: rounded up to whole worker rounds
+
+        #mid-epoch checkpoints: lr_scheduler & this process's optimizer shard, epoch checkpoints restart both
+        if "lr_scheduler" in checkpoint:
+            lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
+        optimizer_state_path = os.path.join(load_saved_state, f"optimizer_state_{accelerator.process_index}.pth")
+        if checkpoint.get("num_processes", num_processes) == num_processes and os.path.exists(optimizer_state_path):
+            optimizer.load_state_dict(torch.load(optimizer_state_path, map_location="cpu"))
+        elif "lr_scheduler" in checkpoint:
+            warning_message = f"load_saved_state: no optimizer state for {num_processes} processes, AdamW8bit moments restart"
+            accelerator.print(warning_message)
+            logging.warning(warning_message)
+
         if accelerator.is_main_process:
             print(" --loaded")
 
@@ -805,6 +1011,8 @@ def main():
     img_step = 0 #step for imgs/sec
     img_sec_total_time = 0	
     gradient_update_loss = 0.0 #tracking loss between gradient updates
+    ram_cache_hits = 0 #dataset ram cache hits & misses between gradient updates
+    ram_cache_misses = 0
     between_gradient_updates_step = 0 #tracking steps between gradient updates
     gradient_update_loss_list = [] #track gradient update loss per epoch, for epoch loss
     epoch_loss = 0.0 #tracking loss between epochs
@@ -996,7 +1204,7 @@ def main():
                     print("begin image generation")
                     pipeline.to(device).to(weight_dtype)
 
-                    calculate_validation_image_scores(pipeline, generator, device, accelerator, validation_image_jsons, epoch, writer, output_dir)
+                    calculate_validation_image_scores(pipeline, generator, device, accelerator, validation_image_jsons, epoch, writer, output_dir, metadata_lookup)
 
                     del pipeline
                     gc.collect()
@@ -1006,7 +1214,7 @@ def main():
             #calculate validation_loss
             accelerator.wait_for_everyone()
             if validation_loss: #validation_loss runs every epoch
-                calculate_validation_loss(accelerator, unet, validation_loss_dataloader, val_batch_size, num_val_steps_per_epoch, num_processes, noise_scheduler, writer, epoch)
+                calculate_validation_loss(accelerator, unet, validation_loss_dataloader, val_batch_size, num_val_steps_per_epoch, num_processes, noise_scheduler, writer, epoch, text_encoders)
             
             accelerator.wait_for_everyone()
 
@@ -1029,8 +1237,8 @@ def main():
         #create a new progress bar for each epoch
         if accelerator.is_main_process:
             progress_bar = tqdm(
-                range(num_steps_per_epoch),
-                initial=0,
+                range(train_dataset.num_batches(epoch) if tar_shard_dirs != None else num_steps_per_epoch),
+                initial=resume_epoch_step,
                 desc=f"Current Epoch Steps",
                 #disable=not accelerator.is_local_main_process, #printout timing seems off
             )
@@ -1038,13 +1246,31 @@ def main():
 
         ##forward_pass & backward_pass
 
-        #batches
-        for step, batch in enumerate(train_dataloader):
+        #batch order is derived from (sampler_seed, epoch)
+        #if resumed mid-epoch, sampler skips batches already trained
+        train_bucket_batch_sampler.set_epoch(epoch)
+        if tar_shard_dirs != None: #DataLoaderShard passes its own epoch to the dataset every __iter__
+            train_dataloader.set_epoch(epoch)
+        epoch_step_offset = resume_epoch_step
+        resume_epoch_step = 0
+        steps_since_checkpoint = 0
+
+        #batches, staged on the gpu ahead of each step if prefetch_batches > 0, same order
+        train_batches = BatchPrefetcher(train_dataloader, accelerator.device, prefetch_batches) if prefetch_batches > 0 else train_dataloader
+        for step, batch in enumerate(train_batches):
 
             with accelerator.accumulate(unet): #this tracks our gradient_accumulation_steps
                 if accelerator.is_main_process:
                     img_sec_start_time = time.time()
 
+                #--encode_text_on_the_fly: prompt embeds from the batch's token ids, same clip-skip 2 encode as caching
+                if text_encoders is not None:
+                    with torch.no_grad():
+                        batch["prompt_embed"], batch["pooled_prompt_embed"] = encode_caption_token_ids(batch["token_ids_one"], batch["token_ids_two"], *text_encoders, accelerator, accelerator.device)
+
+                #empty prompt embeds into dropped rows, batch mask from the sampler's dropout flags
+                batch = apply_conditional_dropout(batch, empty_prompt_embed, empty_pooled_prompt_embed)
+
                 #sample noise to add to latents
                 noise = torch.randn_like(batch["model_input"]) #create noise in the shape of latent tensor
                 bsz = batch["model_input"].shape[0] #bsz = batch size
@@ -1057,9 +1283,8 @@ def main():
                 #add noise to the latents according to the noise magnitude at each timestep (noise manitude@timestep is set by scheduler)
                 noisy_model_input = noise_scheduler.add_noise(batch["model_input"], noise, timesteps)
 
-                #time_ids come in as a list of six tensors, with num_values per tensor = batch_size, then it gets flattened here
-                add_time_id = torch.cat(batch["add_time_id"], dim=0).view(-1)
-                #add_time_id.shape: torch.Size([66] #6 * batch_size 11
+                #time_ids: [bsz, 6] from cached_batch_collate, one row per sample
+                add_time_id = batch["add_time_id"]
 
                 # Predict the noise residual
                 unet_added_conditions = {"time_ids": add_time_id}
@@ -1090,6 +1315,10 @@ def main():
                         lr_scheduler.step()
                 optimizer.zero_grad(set_to_none=True)
 
+                #read-ahead depth follows this rank's fetch time vs step time
+                if readahead != None:
+                    readahead.update(batch["fetch_seconds"])
+
 
                 ##post batch logging
 
@@ -1097,6 +1326,15 @@ def main():
                 if accelerator.is_main_process:
                     vram_usage = round(get_gpu_memory_usage(device_id) / (1024 ** 3), 3)
                     writer.add_scalar('Performance/GPU VRAM Usage', vram_usage, global_step + 1)
+                    #time the dataset took to read this batch's cached files, see CachedImageDataset.__getitems__
+                    writer.add_scalar('Performance/batch fetch seconds', batch["fetch_seconds"], global_step + 1)
+                    #time the step waited for this batch, ~0 = gpu didn't stall on data loading
+                    if prefetch_batches > 0:
+                        writer.add_scalar('Performance/data wait seconds', train_batches.data_wait_seconds, global_step + 1)
+                    ram_cache_hits += batch["ram_cache_hits"]
+                    if readahead != None:
+                        writer.add_scalar('Performance/readahead depth', readahead.depth, global_step + 1)
+                    ram_cache_misses += batch["ram_cache_misses"]
 
                 #calculate imgs/second
                 global_step += 1
@@ -1123,6 +1361,12 @@ def main():
                     #log stuff every gradient update
                     #if step % log_interval == 0: #script uses gradient updates or epochs to log
                     writer.add_scalar("Performance/imgs per sec, per update_step", imgs_sec, global_gradient_update_step) #log imgs/sec
+                    #dataset ram cache, main process only
+                    if ram_cache_hits + ram_cache_misses > 0:
+                        writer.add_scalar("Performance/dataset ram cache hit rate, per update_step", ram_cache_hits / (ram_cache_hits + ram_cache_misses), global_gradient_update_step)
+                        writer.add_scalar("Performance/dataset ram cache misses, per update_step", ram_cache_misses, global_gradient_update_step)
+                        ram_cache_hits = 0
+                        ram_cache_misses = 0
                     
                     #if no gradient update, don't log
                     if accelerator.optimizer_step_was_skipped:
@@ -1146,6 +1390,40 @@ def main():
                     gradient_update_loss = 0.0
                     between_gradient_updates_step = 0
 
+            #mid-epoch checkpoint, for exact resume with --load_saved_state
+                #only at gradient updates, so no partly accumulated gradients are lost
+                #overwrites previous: optimizer shards & unet_state_dict first, then checkpoint.pth
+                #optimizer: each process saves its own FSDP shard of the AdamW8bit state, resumed with the same num_processes
+                    #FSDP.optim_state_dict would all-gather bnb's blockwise absmax/quantile states as if they had the parameters' shapes
+            steps_since_checkpoint += 1
+            if checkpoint_every_n_steps > 0 and steps_since_checkpoint >= checkpoint_every_n_steps and accelerator.sync_gradients:
+                steps_since_checkpoint = 0
+                checkpoint_dir = os.path.join(output_dir, "resume_checkpoint")
+                os.makedirs(checkpoint_dir, exist_ok=True)
+                optimizer_state_path = os.path.join(checkpoint_dir, f"optimizer_state_{accelerator.process_index}.pth")
+                torch.save(optimizer.state_dict(), optimizer_state_path + ".tmp")
+                os.replace(optimizer_state_path + ".tmp", optimizer_state_path)
+                unet_state_dict = accelerator.get_state_dict(unet) #get_state_dict on all processes
+                accelerator.wait_for_everyone() #optimizer shards written before checkpoint.pth
+                if accelerator.is_main_process:
+                    unet_state_dict_path = os.path.join(checkpoint_dir, "unet_state_dict.pth")
+                    torch.save(unet_state_dict, unet_state_dict_path + ".tmp")
+                    os.replace(unet_state_dict_path + ".tmp", unet_state_dict_path)
+                    state_path = os.path.join(checkpoint_dir, "checkpoint.pth")
+                    torch.save({
+                        "global_step": global_step,
+                        "global_gradient_update_step": global_gradient_update_step,
+                        "epoch": epoch - 1, #last completed epoch
+                        "num_processes": num_processes,
+                        #batches consumed by all processes in this epoch
+                        "train_sampler": train_bucket_batch_sampler.state_dict(num_batches_consumed=(step + 1) * num_processes),
+                        "lr_scheduler": lr_scheduler.state_dict(),
+                    }, state_path + ".tmp")
+                    os.replace(state_path + ".tmp", state_path)
+                    print(f"\n  checkpoint saved: {checkpoint_dir}, epoch {epoch} step {epoch_step_offset + step + 1}")
+                del unet_state_dict
+                accelerator.wait_for_everyone()
+
             #batch column
         #epoch column
 
@@ -1183,7 +1461,7 @@ def main():
         accelerator.wait_for_everyone()
         if validation_loss:
             if epoch % validation_loss_every_n_epochs == 0:
-                calculate_validation_loss(accelerator, unet, validation_loss_dataloader, val_batch_size, num_val_steps_per_epoch, num_processes, noise_scheduler, writer, epoch)
+                calculate_validation_loss(accelerator, unet, validation_loss_dataloader, val_batch_size, num_val_steps_per_epoch, num_processes, noise_scheduler, writer, epoch, text_encoders)
         '''
 
         ##save_state & save_pipeline
@@ -1214,6 +1492,8 @@ def main():
                             "global_step": global_step,
                             "global_gradient_update_step": global_gradient_update_step,
                             "epoch": epoch,
+                            "num_processes": num_processes,
+                            "train_sampler": train_bucket_batch_sampler.state_dict(), #resumes at start of next epoch
                         }, state_path)
                         if accelerator.is_main_process:
                             print("   --state saved")
@@ -1301,6 +1581,12 @@ def main():
         total_time = end_time - start_time
         hours = total_time / 3600
         print(f"training complete: total training time {hours:.2f} hours")
+    if readahead != None:
+        readahead.close()
+    #last process on each node removes the node shared cache
+    if node_shared_cache != None:
+        accelerator.wait_for_everyone()
+        node_shared_cache.release()
     accelerator.end_training()
 
 
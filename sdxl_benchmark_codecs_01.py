@@ -0,0 +1,77 @@
+#benchmark_codecs.py
+	#compares storage codecs for cached tensors, see sdxl_codec_functions
+	#reads random cached items (any storage_codec), re-encodes their tensors in memory with each codec
+	#reports per codec: bytes/sample, encode & decode us/sample, max abs error vs the cached tensors
+	#zstd & lz4 codecs are skipped if zstandard / lz4 are not installed
+
+
+import argparse
+import importlib.util
+import json
+import random
+import time
+
+import torch
+
+from sdxl_codec_functions_01 import decode_tensor, encode_tensor, load_tensor, storage_codecs, storage_compressions
+
+
+#welcome message
+print("\nbenchmark_codecs: initializing")
+
+
+##arguments
+parser = argparse.ArgumentParser()
+parser.add_argument("--cached_dataset_lists", nargs='+', type=str, required=True, help="path/to/cache_dataset.list, accepts multiple files")
+parser.add_argument("--num_samples", type=int, default=200, help="number of random items to encode & decode")
+parser.add_argument("--seed", type=int, default=123, help="seed for the random item selection")
+args = parser.parse_args()
+
+
+#read .list files
+json_file_paths_list = []
+for item in args.cached_dataset_lists:
+	with open(item, "r") as f:
+		json_file_paths_list += [line.strip() for line in f if line.strip()]
+json_file_paths_list = sorted(set(json_file_paths_list))
+
+random.seed(args.seed)
+num_samples = min(args.num_samples, len(json_file_paths_list))
+sample_jsons = random.sample(json_file_paths_list, num_samples)
+
+#load samples once, codecs are compared in memory, disk speed not included
+samples = []
+for json_file in sample_jsons:
+	with open(json_file, "r") as f:
+		metadata = json.load(f)
+	storage_codec = metadata.get("storage_codec") or "raw"
+	samples.append([load_tensor(metadata[f"{key}_file"], storage_codec) for key in ["model_input", "prompt_embed", "pooled_prompt_embed"]])
+
+
+#codecs to compare, compressed codecs only if their package is installed
+codecs = [codec for codec in storage_codecs if codec != "raw"]
+for compression, package in zip(storage_compressions, ["zstandard", "lz4"]):
+	if importlib.util.find_spec(package) is None:
+		print(f"{package} not installed, skipping +{compression} codecs")
+		continue
+	codecs += [f"{codec}+{compression}" for codec in storage_codecs if codec != "raw"]
+
+
+##run
+print(f"{num_samples} samples\n")
+raw_bytes = sum(tensor.element_size() * tensor.nelement() for sample in samples for tensor in sample) / num_samples
+print(f"{'codec':<12}{'bytes/sample':>14}{'ratio':>8}{'encode us':>12}{'decode us':>12}{'max abs err':>14}")
+print(f"{'in memory':<12}{raw_bytes:>14.0f}{1.0:>8.2f}")
+for codec in codecs:
+	start_time = time.perf_counter()
+	encoded_samples = [[encode_tensor(tensor, codec) for tensor in sample] for sample in samples]
+	encode_time = time.perf_counter() - start_time
+
+	start_time = time.perf_counter()
+	decoded_samples = [[decode_tensor(data) for data in encoded] for encoded in encoded_samples]
+	decode_time = time.perf_counter() - start_time
+
+	num_bytes = sum(len(data) for encoded in encoded_samples for data in encoded) / num_samples
+	max_error = max((decoded.float() - tensor.float()).abs().max().item() for sample, decoded_sample in zip(samples, decoded_samples) for tensor, decoded in zip(sample, decoded_sample))
+	print(f"{codec:<12}{num_bytes:>14.0f}{raw_bytes / num_bytes:>8.2f}{encode_time / num_samples * 1e6:>12.1f}{decode_time / num_samples * 1e6:>12.1f}{max_error:>14.5f}")
+	del encoded_samples, decoded_samples
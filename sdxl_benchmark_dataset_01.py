@@ -0,0 +1,68 @@
+#benchmark_dataset.py
+	#compares cached dataset read speed of the available cache formats
+	#joblib: CachedImageDataset (.metadata.json + 3 .pkl files per item)
+	#packed_shards: PackedShardDataset, if --packed_shard_dir
+	#bucket_memmap: BucketMemmapDataset, if --bucket_memmap_dir
+	#run twice to compare cold (first run after drop caches) vs warm (page cache) reads
+
+
+import argparse
+import os
+import random
+import time
+
+from sdxl_data_functions_18 import CachedImageDataset
+from sdxl_cache_format_functions_01 import PackedShardDataset, BucketMemmapDataset
+
+
+#welcome message
+print("\nbenchmark_dataset: initializing")
+
+
+##arguments
+parser = argparse.ArgumentParser()
+parser.add_argument("--cached_dataset_lists", nargs='+', type=str, required=True, help="path/to/cache_dataset.list, accepts multiple files")
+parser.add_argument("--packed_shard_dir", type=str, help="path/to/packed_shards, converted from the same .list files")
+parser.add_argument("--bucket_memmap_dir", type=str, help="path/to/bucket_memmap, converted from the same .list files")
+parser.add_argument("--num_samples", type=int, default=1000, help="number of random items to read per format")
+parser.add_argument("--seed", type=int, default=123, help="seed for the random read order")
+args = parser.parse_args()
+
+
+#read .list files
+json_file_paths_list = []
+for item in args.cached_dataset_lists:
+	with open(item, "r") as f:
+		json_file_paths_list += [line.strip() for line in f if line.strip()]
+json_file_paths_list = sorted(set(json_file_paths_list))
+
+#same random items & order for every format
+random.seed(args.seed)
+num_samples = min(args.num_samples, len(json_file_paths_list))
+sample_jsons = random.sample(json_file_paths_list, num_samples)
+
+
+#reads every item once, touches tensor data so lazy mmap reads are counted
+def benchmark(name, dataset):
+	start_time = time.perf_counter()
+	num_bytes = 0
+	for idx in range(len(dataset)):
+		item = dataset[idx]
+		for key in ["model_input", "prompt_embed", "pooled_prompt_embed"]:
+			tensor = item[key]
+			tensor.sum() #forces pages in
+			num_bytes += tensor.element_size() * tensor.nelement()
+	total_time = time.perf_counter() - start_time
+	print(f"{name}:")
+	print(f"  samples/sec: {len(dataset) / total_time:.1f}")
+	print(f"  us/sample: {total_time / len(dataset) * 1e6:.1f}")
+	print(f"  MB/sec: {num_bytes / total_time / 1024 ** 2:.1f}")
+
+
+##run
+print(f"{num_samples} random samples per format\n")
+benchmark("joblib", CachedImageDataset(sample_jsons, conditional_dropout_percent=0.0))
+if args.packed_shard_dir:
+	benchmark("packed_shards", PackedShardDataset(args.packed_shard_dir, sample_jsons, conditional_dropout_percent=0.0))
+if args.bucket_memmap_dir:
+	benchmark("bucket_memmap", BucketMemmapDataset(args.bucket_memmap_dir, sample_jsons, conditional_dropout_percent=0.0))
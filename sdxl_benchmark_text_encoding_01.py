@@ -0,0 +1,160 @@
+#benchmark_text_encoding.py
+	#compares cached prompt embeds vs --encode_text_on_the_fly, per batch of random cached items
+	#cached: reads model_input, prompt_embed & pooled_prompt_embed files, copies them to the device
+	#on the fly: reads model_input file, copies token ids to the device, text encodes them, see encode_caption_token_ids
+	#reports per mode: bytes read/sample, read seconds, device seconds (copy + text encode), step seconds & samples/sec
+	#reports max abs error of on the fly embeds vs the cached embeds, same encode path as caching: expected ~0
+	#token ids from .metadata.json, items cached before token ids existed are tokenized here (not timed)
+	#page cache: cached files are dropped from the page cache before each read (posix_fadvise DONTNEED), disk reads are measured
+
+
+import argparse
+import json
+import os
+import random
+import time
+
+from accelerate import Accelerator
+import torch
+from transformers import CLIPTextModel, CLIPTextModelWithProjection
+
+from sdxl_codec_functions_01 import load_tensor
+from sdxl_data_functions_18 import encode_caption_token_ids, load_clip_tokenizers, tokenize_captions
+
+
+#welcome message
+print("\nbenchmark_text_encoding: initializing")
+
+
+##arguments
+parser = argparse.ArgumentParser()
+parser.add_argument("--cached_dataset_lists", nargs='+', type=str, required=True, help="path/to/cache_dataset.list, accepts multiple files, items need prompt embed files")
+parser.add_argument("--pretrained_model_name_or_path", type=str, default="stabilityai/stable-diffusion-xl-base-1.0", help="model the cached dataset was text encoded with")
+parser.add_argument("--num_samples", type=int, default=256, help="number of random items")
+parser.add_argument("--batch_size", type=int, default=8, help="items per batch, as --train_batch_size")
+parser.add_argument("--seed", type=int, default=123, help="seed for the random item selection")
+parser.add_argument("--keep_page_cache", action='store_true', help="don't drop cached files from the page cache before reading")
+args = parser.parse_args()
+
+
+#same mixed precision as caching & training
+accelerator = Accelerator(mixed_precision="fp16" if torch.cuda.is_available() else "no")
+device = accelerator.device
+
+
+#read .list files
+json_file_paths_list = []
+for item in args.cached_dataset_lists:
+	with open(item, "r") as f:
+		json_file_paths_list += [line.strip() for line in f if line.strip()]
+json_file_paths_list = sorted(set(json_file_paths_list))
+
+#items with cached prompt embeds
+samples = []
+for json_file in json_file_paths_list:
+	with open(json_file, "r") as f:
+		metadata = json.load(f)
+	if metadata.get("prompt_embed_file") is not None:
+		samples.append(metadata)
+random.seed(args.seed)
+samples = random.sample(samples, min(args.num_samples, len(samples)))
+num_samples = len(samples)
+if num_samples == 0:
+	print("no cached items with prompt embed files found")
+	exit()
+
+#token ids, tokenized here for items cached before token ids existed
+missing_token_ids = [metadata for metadata in samples if metadata.get("token_ids_one") is None]
+if len(missing_token_ids) > 0:
+	print(f"{len(missing_token_ids)} items without token ids, tokenizing")
+	tokenizer_one, tokenizer_two = load_clip_tokenizers(args.pretrained_model_name_or_path)
+	token_ids_one, token_ids_two = tokenize_captions([metadata["caption_string"] for metadata in missing_token_ids], tokenizer_one, tokenizer_two)
+	for i, metadata in enumerate(missing_token_ids):
+		metadata["token_ids_one"] = token_ids_one[i].tolist()
+		metadata["token_ids_two"] = token_ids_two[i].tolist()
+
+#text encoders, as sdxl_train --encode_text_on_the_fly
+text_encoders = (
+	CLIPTextModel.from_pretrained(args.pretrained_model_name_or_path, subfolder="text_encoder"),
+	CLIPTextModelWithProjection.from_pretrained(args.pretrained_model_name_or_path, subfolder="text_encoder_2"),
+)
+for text_encoder in text_encoders:
+	text_encoder.requires_grad_(False)
+	text_encoder.eval()
+	text_encoder.to(device)
+
+
+def synchronize():
+	if device.type == "cuda":
+		torch.cuda.synchronize(device)
+
+
+#drops file_path from the page cache, next read comes from disk
+def drop_page_cache(file_path):
+	if args.keep_page_cache:
+		return
+	try:
+		fd = os.open(file_path, os.O_RDONLY)
+		try:
+			os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+		finally:
+			os.close(fd)
+	except (AttributeError, OSError): #no posix_fadvise on this platform
+		pass
+
+
+#returns (bytes read, read seconds, device seconds, prompt_embeds, pooled_prompt_embeds) for a batch
+def run_batch(batch, on_the_fly):
+	names = ["model_input"] if on_the_fly else ["model_input", "prompt_embed", "pooled_prompt_embed"]
+	files = [metadata[f"{name}_file"] for metadata in batch for name in names]
+	for file_path in files:
+		drop_page_cache(file_path)
+	num_bytes = sum(os.path.getsize(file_path) for file_path in files)
+
+	start_time = time.perf_counter()
+	tensors = [[load_tensor(metadata[f"{name}_file"], metadata.get("storage_codec") or "raw", map_location="cpu") for name in names] for metadata in batch]
+	read_seconds = time.perf_counter() - start_time
+
+	start_time = time.perf_counter()
+	model_inputs = [item[0].to(device, non_blocking=True) for item in tensors]
+	with torch.no_grad():
+		if on_the_fly:
+			token_ids_one = torch.tensor([metadata["token_ids_one"] for metadata in batch], dtype=torch.long)
+			token_ids_two = torch.tensor([metadata["token_ids_two"] for metadata in batch], dtype=torch.long)
+			prompt_embeds, pooled_prompt_embeds = encode_caption_token_ids(token_ids_one, token_ids_two, *text_encoders, accelerator, device)
+		else:
+			prompt_embeds = torch.stack([item[1] for item in tensors]).to(device, non_blocking=True)
+			pooled_prompt_embeds = torch.stack([item[2] for item in tensors]).to(device, non_blocking=True)
+	synchronize()
+	device_seconds = time.perf_counter() - start_time
+	del model_inputs
+	return num_bytes, read_seconds, device_seconds, prompt_embeds, pooled_prompt_embeds
+
+
+batches = [samples[i:i + args.batch_size] for i in range(0, num_samples, args.batch_size)]
+
+#warmup: cuda context & kernels, not measured
+run_batch(batches[0], True)
+run_batch(batches[0], False)
+
+
+##run
+print(f"{num_samples} samples, batch_size {args.batch_size}, device {device}\n")
+print(f"{'mode':<12}{'bytes/sample':>14}{'read s/batch':>14}{'device s/batch':>16}{'step s/batch':>14}{'samples/s':>11}")
+results = {}
+for mode, on_the_fly in [("cached", False), ("on the fly", True)]:
+	num_bytes, read_seconds, device_seconds = 0, 0.0, 0.0
+	embeds = []
+	for batch in batches:
+		batch_bytes, batch_read_seconds, batch_device_seconds, prompt_embeds, pooled_prompt_embeds = run_batch(batch, on_the_fly)
+		num_bytes += batch_bytes
+		read_seconds += batch_read_seconds
+		device_seconds += batch_device_seconds
+		embeds.append((prompt_embeds.float().cpu(), pooled_prompt_embeds.float().cpu()))
+	results[mode] = embeds
+	step_seconds = (read_seconds + device_seconds) / len(batches)
+	print(f"{mode:<12}{num_bytes / num_samples:>14.0f}{read_seconds / len(batches):>14.4f}{device_seconds / len(batches):>16.4f}{step_seconds:>14.4f}{num_samples / (read_seconds + device_seconds):>11.1f}")
+
+#on the fly vs cached embeds
+max_error = max(max((a - b).abs().max().item() for a, b in zip(cached, on_the_fly)) for cached, on_the_fly in zip(results["cached"], results["on the fly"]))
+print(f"\nmax abs error, on the fly vs cached prompt embeds: {max_error:.6f}")
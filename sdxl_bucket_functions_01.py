@@ -0,0 +1,104 @@
+#sdxl_bucket_functions.py
+#aspect ratio bucket engine:
+    #create_aspect_categories - generates the aspect_categories table at runtime, same algorithm as utils/create_aspects.py, cached
+        #default: 256 to 2048, step 64, aspect ratios 2:1 to 1:2, identical to the table data_functions used to paste in
+    #AspectBucketEngine - numpy bucket assignment for whole arrays of (width, height), one call for any number of images
+        #same results as the per image next(...) category_key & min(...) closest_bucket, see utils/verify_bucket_engine.py
+    #get_bucket_engine - cached AspectBucketEngine per table settings, use from caching & trainer
+        #trainer: buckets_in_range checks cached datasets against the training resolution range
+#bucket rules:
+    #category_key: smallest key (within min_resolution & max_resolution) >= sqrt of 64 floored pixels, else max_resolution
+    #closest_bucket: bucket in category_key with the closest width/height ratio to the original image, first bucket on ties
+
+
+import functools
+
+import numpy as np
+
+
+#returns {square_dim: [[width, height], ...]}, buckets sorted by pixels, largest first
+#cached: the returned table is shared, don't modify it
+@functools.lru_cache(maxsize=None)
+def create_aspect_categories(start_dim=256, end_dim=2048, step_dim=64, max_aspect_ratio=2.0):
+    min_aspect_ratio = 1 / max_aspect_ratio
+    square_dims = [i for i in range(start_dim, end_dim + 1, step_dim)]
+    aspect_categories = {}
+    for i, square_dim in enumerate(square_dims):
+        sizes = []
+        min_pixels = 0 if i == 0 else square_dims[i-1]**2
+        max_pixels = square_dim**2
+        for width in range(64, square_dim * 4, 64):
+            for height in range(64, square_dim * 4, 64):
+                if min_pixels < width * height <= max_pixels:
+                    aspect_ratio = width / height
+                    if min_aspect_ratio <= aspect_ratio <= max_aspect_ratio:
+                        if not width * height <= (start_dim - step_dim) ** 2:
+                            sizes.append([width, height])
+        #remove duplicates & sort by pixels, same order as utils/create_aspects.py
+        sizes = [list(tup) for tup in set(tuple(item) for item in sizes)]
+        sizes.sort(key=lambda x: x[0]*x[1], reverse=True)
+        aspect_categories[square_dim] = sizes
+    return aspect_categories
+
+
+class AspectBucketEngine:
+    def __init__(self, aspect_categories):
+        self.aspect_categories = aspect_categories
+        self.category_keys = np.array(sorted(aspect_categories), dtype=np.int64)
+        #buckets padded to the largest category, padding never wins: aspect ratio inf
+        max_buckets = max(len(buckets) for buckets in aspect_categories.values())
+        self.buckets = np.zeros((len(self.category_keys), max_buckets, 2), dtype=np.int64)
+        self.bucket_aspect_ratios = np.full((len(self.category_keys), max_buckets), np.inf)
+        for row, category_key in enumerate(self.category_keys.tolist()):
+            buckets = np.array(aspect_categories[category_key], dtype=np.int64)
+            self.buckets[row, :len(buckets)] = buckets
+            self.bucket_aspect_ratios[row, :len(buckets)] = buckets[:, 0] / buckets[:, 1]
+
+    #sorted category keys within min_resolution & max_resolution
+    def filtered_category_keys(self, min_resolution, max_resolution):
+        return self.category_keys[(self.category_keys >= min_resolution) & (self.category_keys <= max_resolution)]
+
+    #returns category_key per image: smallest sorted_categories_keys >= image_pixels_64_sqrt, else default_key
+    def category_keys_for(self, image_pixels_64_sqrt, sorted_categories_keys, default_key):
+        sorted_categories_keys = np.asarray(sorted_categories_keys, dtype=np.int64)
+        image_pixels_64_sqrt = np.asarray(image_pixels_64_sqrt, dtype=np.int64)
+        if len(sorted_categories_keys) == 0:
+            return np.full(image_pixels_64_sqrt.shape, default_key, dtype=np.int64)
+        index = np.searchsorted(sorted_categories_keys, image_pixels_64_sqrt, side="left")
+        found = index < len(sorted_categories_keys)
+        return np.where(found, sorted_categories_keys[np.minimum(index, len(sorted_categories_keys) - 1)], default_key)
+
+    #returns closest_bucket per image, [N, 2] (width, height)
+    def closest_buckets_for(self, category_keys, original_aspect_ratios):
+        category_keys = np.asarray(category_keys, dtype=np.int64)
+        rows = np.searchsorted(self.category_keys, category_keys)
+        rows = np.minimum(rows, len(self.category_keys) - 1)
+        missing = self.category_keys[rows] != category_keys
+        if missing.any():
+            raise KeyError(f"category_key not in aspect_categories: {np.unique(category_keys[missing]).tolist()}")
+        #argmin: first bucket on ties, same as min()
+        distances = np.abs(self.bucket_aspect_ratios[rows] - np.asarray(original_aspect_ratios, dtype=np.float64)[..., None])
+        return self.buckets[rows, np.argmin(distances, axis=-1)]
+
+    #returns (category_keys [N], closest_buckets [N, 2]) for original image widths & heights
+    def assign(self, widths, heights, min_resolution, max_resolution):
+        widths = np.asarray(widths, dtype=np.int64)
+        heights = np.asarray(heights, dtype=np.int64)
+        image_pixels_64 = (widths // 64) * 64 * ((heights // 64) * 64)
+        image_pixels_64_sqrt = np.floor(np.sqrt(image_pixels_64.astype(np.float64))).astype(np.int64) #same as int(math.sqrt())
+        category_keys = self.category_keys_for(image_pixels_64_sqrt, self.filtered_category_keys(min_resolution, max_resolution), max_resolution)
+        return category_keys, self.closest_buckets_for(category_keys, widths / heights)
+
+    #returns bool mask [N], closest_buckets [N, 2] found in categories within min_resolution & max_resolution
+    def buckets_in_range(self, closest_buckets, min_resolution, max_resolution):
+        rows = (self.category_keys >= min_resolution) & (self.category_keys <= max_resolution)
+        valid_buckets = self.buckets[rows][np.isfinite(self.bucket_aspect_ratios[rows])]
+        closest_buckets = np.asarray(closest_buckets, dtype=np.int64).reshape(-1, 2)
+        #(width, height) -> one int64 per bucket
+        return np.isin(closest_buckets[:, 0] * 1_000_000 + closest_buckets[:, 1], valid_buckets[:, 0] * 1_000_000 + valid_buckets[:, 1])
+
+
+#cached AspectBucketEngine for create_aspect_categories settings
+@functools.lru_cache(maxsize=None)
+def get_bucket_engine(start_dim=256, end_dim=2048, step_dim=64, max_aspect_ratio=2.0):
+    return AspectBucketEngine(create_aspect_categories(start_dim, end_dim, step_dim, max_aspect_ratio))
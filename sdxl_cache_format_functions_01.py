@@ -0,0 +1,497 @@
+#sdxl_cache_format_functions.py
+#packed cached dataset formats for sdxl_train system:
+    #PackedShardWriter - appends cached tensors as raw bytes to large shard files + offset index
+    #PackedShardDataset - CachedImageDataset that reads samples from packed shards
+        #one seek per sample: model_input, prompt_embed, pooled_prompt_embed are stored back to back
+        #zero-copy: tensors are views into a memory-mapped shard file
+        #__getitems__: one madvise(WILLNEED) per batch item before building views, the kernel reads the whole batch at once
+        #conditional dropout items: prompt embeds not read, see CachedImageDataset
+        #_readahead_ranges: each item is one range of its shard file, see sdxl_readahead_functions
+    #convert_cached_dataset_to_packed_shards - converts existing .metadata.json/.pkl cache to packed shards
+    #BucketMemmapDataset - CachedImageDataset that reads samples from per aspect bucket .npy arrays
+        #every item in a bucket has the same model_input_shape, so each bucket is 3 fixed-shape arrays
+        #arrays are memory-mapped: torch.from_numpy views, no deserialization, OS page cache shared between ranks
+    #convert_cached_dataset_to_bucket_memmap - converts existing .metadata.json/.pkl cache to bucket memmap arrays
+#packed shard dir layout:
+    #shard_00000.bin, shard_00001.bin, ... : raw tensor bytes
+    #packed_index.json : shard list + per sample offsets, tensor layout, and metadata used by CachedImageDataset
+#bucket memmap dir layout:
+    #bucket_{width}x{height}/model_input.npy, prompt_embed.npy, pooled_prompt_embed.npy : [num_items, *shape] arrays
+    #bucket_memmap_index.json : bucket list, dtypes, and per item metadata used by CachedImageDataset
+#see sdxl_convert_cache_format for the conversion script
+
+
+import json
+import logging
+import math
+import mmap
+import os
+
+import numpy as np
+import torch
+
+from sdxl_catalog_functions_01 import CachedDatasetCatalog, catalog_filename
+from sdxl_codec_functions_01 import load_tensor
+from sdxl_data_functions_18 import CachedImageDataset
+
+
+packed_index_filename = "packed_index.json"
+bucket_memmap_index_filename = "bucket_memmap_index.json"
+
+#each tensor starts on an aligned offset inside the shard file
+packed_alignment = 64
+
+#dtype name <-> torch dtype, dtype names are stored in index files
+torch_dtypes = {
+    "torch.float16": torch.float16,
+    "torch.bfloat16": torch.bfloat16,
+    "torch.float32": torch.float32,
+    "torch.float64": torch.float64,
+    "torch.int64": torch.int64,
+    "torch.int32": torch.int32,
+    "torch.int16": torch.int16,
+    "torch.int8": torch.int8,
+    "torch.uint8": torch.uint8,
+}
+
+#cached tensor names, in the order they are written per sample
+cached_tensor_names = ["model_input", "prompt_embed", "pooled_prompt_embed"]
+
+#metadata kept in the index, everything CachedImageDataset & BucketBatchSampler need
+packed_metadata_keys = [
+    "add_time_id",
+    "category_key",
+    "closest_bucket",
+    "original_image_size",
+    "cropped_image_size",
+]
+
+
+#returns raw bytes of a tensor, works for dtypes numpy doesn't support (bfloat16)
+def tensor_to_bytes(tensor):
+    tensor = tensor.detach().to("cpu").contiguous()
+    return tensor.reshape(-1).view(torch.uint8).numpy().tobytes()
+
+
+#appends cached tensors to shard files, creates packed_index.json on close()
+class PackedShardWriter:
+    def __init__(self, shard_dir, shard_size_gb=4.0):
+        self.shard_dir = shard_dir
+        self.max_shard_bytes = int(shard_size_gb * 1024 ** 3)
+        os.makedirs(shard_dir, exist_ok=True)
+
+        self.shards = []
+        self.items = []
+        self.shard_file = None
+        self.shard_bytes = 0
+
+    def _open_next_shard(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+        shard_name = f"shard_{len(self.shards):05d}.bin"
+        self.shard_file = open(os.path.join(self.shard_dir, shard_name), "wb")
+        self.shards.append(shard_name)
+        self.shard_bytes = 0
+
+    #key: unique sample id (json_file path of the original cache)
+    #tensors: dict of name: tensor, metadata: dict of packed_metadata_keys
+    def add(self, key, tensors, metadata):
+        #layout tensors back to back, each aligned, offsets relative to sample start
+        layout = {}
+        blobs = []
+        sample_bytes = 0
+        for name, tensor in tensors.items():
+            padding = -sample_bytes % packed_alignment
+            if padding:
+                blobs.append(b"\0" * padding)
+                sample_bytes += padding
+            data = tensor_to_bytes(tensor)
+            layout[name] = {
+                "offset": sample_bytes,
+                "dtype": str(tensor.dtype),
+                "shape": list(tensor.shape),
+            }
+            blobs.append(data)
+            sample_bytes += len(data)
+
+        #start new shard if needed, a sample never spans 2 shards
+        if self.shard_file is None or (self.shard_bytes > 0 and self.shard_bytes + sample_bytes > self.max_shard_bytes):
+            self._open_next_shard()
+
+        #align sample start
+        padding = -self.shard_bytes % packed_alignment
+        if padding:
+            self.shard_file.write(b"\0" * padding)
+            self.shard_bytes += padding
+
+        offset = self.shard_bytes
+        for blob in blobs:
+            self.shard_file.write(blob)
+        self.shard_bytes += sample_bytes
+
+        item = {
+            "key": key,
+            "shard": len(self.shards) - 1,
+            "offset": offset,
+            "nbytes": sample_bytes,
+            "tensors": layout,
+        }
+        item.update({k: metadata[k] for k in packed_metadata_keys if k in metadata})
+        self.items.append(item)
+
+    def close(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+            self.shard_file = None
+        index = {
+            "shards": self.shards,
+            "items": self.items,
+        }
+        #write index last, a packed dir without index is incomplete
+        index_path = os.path.join(self.shard_dir, packed_index_filename)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(index_path + ".tmp", index_path)
+
+
+#reads packed_index.json, returns list of items with absolute shard paths
+def load_packed_index(shard_dir):
+    with open(os.path.join(shard_dir, packed_index_filename), "r") as f:
+        index = json.load(f)
+    shard_paths = [os.path.join(shard_dir, shard) for shard in index["shards"]]
+    for item in index["items"]:
+        item["shard_path"] = shard_paths[item["shard"]]
+    return index["items"]
+
+
+##input: packed shard dir(s) -> output: same items as CachedImageDataset
+#json_file_paths_list: optional, selects & orders items by their original json_file path
+class PackedShardDataset(CachedImageDataset):
+    def __init__(self, shard_dirs, json_file_paths_list=None, conditional_dropout_percent=0.1, fetch_threads=8):
+        if isinstance(shard_dirs, str):
+            shard_dirs = [shard_dirs]
+
+        #combine indexes
+        items_by_key = {}
+        for shard_dir in shard_dirs:
+            for item in load_packed_index(shard_dir):
+                items_by_key[item["key"]] = item
+
+        #select items
+        if json_file_paths_list is None:
+            self.items = list(items_by_key.values())
+        else:
+            self.items = []
+            for json_file in json_file_paths_list:
+                item = items_by_key.get(json_file)
+                if item is None:
+                    error_message = f"PackedShardDataset: {json_file} not found in packed shards, skipped"
+                    print(error_message)
+                    logging.error(error_message)
+                    continue
+                self.items.append(item)
+
+        super().__init__([item["key"] for item in self.items], conditional_dropout_percent, fetch_threads=fetch_threads)
+        self._shard_maps = {} #shard_path: mmap, opened lazily per process
+
+    #mmaps are not pickled, each DataLoader worker opens its own
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_shard_maps"] = {}
+        return state
+
+    def _shard_map(self, shard_path):
+        shard_map = self._shard_maps.get(shard_path)
+        if shard_map is None:
+            with open(shard_path, "rb") as f:
+                #ACCESS_COPY: writable copy-on-write view, so torch.frombuffer doesn't warn, file is never modified
+                shard_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            self._shard_maps[shard_path] = shard_map
+        return shard_map
+
+    def get_closest_bucket(self, index):
+        return self.items[index]["closest_bucket"]
+
+    def _load_metadata(self, index):
+        return self.items[index]
+
+    #(start, end) bytes of an item in its shard file, start page aligned
+    #conditional dropout items: only their model_input range
+    def _item_range(self, item, dropped):
+        start = item["offset"] - item["offset"] % mmap.PAGESIZE
+        end = item["offset"] + item["nbytes"]
+        if dropped:
+            layout = item["tensors"]["model_input"]
+            end = item["offset"] + layout["offset"] + torch.empty(0, dtype=torch_dtypes[layout["dtype"]]).element_size() * math.prod(layout["shape"])
+        return start, end
+
+    #one range per item, in its shard file
+    def _readahead_ranges(self, index, dropped):
+        item = self.items[index]
+        start, end = self._item_range(item, dropped)
+        return [(item["shard_path"], start, end - start)]
+
+    #vectored read-ahead: all batch items are requested from the kernel before the views are built & copied
+    def __getitems__(self, indices):
+        for index in indices:
+            index, dropped = index if isinstance(index, (tuple, list)) else (index, False)
+            item = self.items[index]
+            start, end = self._item_range(item, dropped)
+            try:
+                self._shard_map(item["shard_path"]).madvise(mmap.MADV_WILLNEED, start, end - start)
+            except (AttributeError, OSError): #no madvise on this platform
+                break
+        return super().__getitems__(indices)
+
+    #load_embeds=False: prompt embed pages aren't touched
+    def _load_cached_tensors(self, index, metadata, load_embeds=True):
+        shard_map = self._shard_map(metadata["shard_path"])
+        tensors = []
+        for name in cached_tensor_names:
+            if not load_embeds and name != "model_input":
+                tensors.append(None)
+                continue
+            layout = metadata["tensors"][name]
+            dtype = torch_dtypes[layout["dtype"]]
+            shape = layout["shape"]
+            count = 1
+            for dim in shape:
+                count *= dim
+            tensor = torch.frombuffer(shard_map, dtype=dtype, count=count, offset=metadata["offset"] + layout["offset"])
+            tensors.append(tensor.view(shape))
+        return tensors
+
+
+#converts existing cached dataset (.metadata.json + .pkl files) to packed shards
+#input: json_file_paths_list, output: shard_dir
+#returns (items packed, items that failed), sdxl_convert_cache_format fails the run if any item failed
+def convert_cached_dataset_to_packed_shards(json_file_paths_list, shard_dir, shard_size_gb=4.0):
+    print(f"\nconverting {len(json_file_paths_list)} cached items to packed shards")
+    print(f"  shard_dir: {shard_dir}")
+
+    writer = PackedShardWriter(shard_dir, shard_size_gb)
+    catalogs = {} #cache_dir: catalog, packed locations are recorded in existing catalogs
+    count = 0
+    num_failed = 0
+    for json_file in json_file_paths_list:
+        try:
+            with open(json_file, "r") as f:
+                metadata = json.load(f)
+            #raw .pkl tensors were saved on the caching gpu, loaded to cpu
+            tensors = {name: load_tensor(metadata[f"{name}_file"], metadata.get("storage_codec") or "raw", map_location="cpu") for name in cached_tensor_names}
+        except Exception as e:
+            error_message = f"Error: {e}, for {json_file}"
+            print(error_message)
+            logging.error(error_message)
+            num_failed += 1
+            continue
+
+        writer.add(json_file, tensors, metadata)
+        count += 1
+        print(f"\r[{count}]: {json_file[-60:]}", end="")
+
+        #record shard & offset in the dataset's catalog
+        catalog_path = os.path.join(metadata.get("cache_dir", ""), catalog_filename)
+        if catalog_path not in catalogs:
+            catalogs[catalog_path] = CachedDatasetCatalog(catalog_path) if os.path.exists(catalog_path) else None
+        catalog = catalogs[catalog_path]
+        if catalog is not None:
+            item = writer.items[-1]
+            catalog.set_packed_location(json_file, os.path.join(shard_dir, writer.shards[item["shard"]]), item["offset"], item["nbytes"], commit=False)
+
+    writer.close()
+    for catalog in catalogs.values():
+        if catalog is not None:
+            catalog.close()
+    print(f"\n{count} items packed into {len(writer.shards)} shards, {num_failed} failed")
+    return count, num_failed
+
+
+#numpy has no bfloat16, bfloat16 arrays are stored as int16 and viewed back on load
+def tensor_to_numpy(tensor):
+    tensor = tensor.detach().to("cpu").contiguous()
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+    return tensor.numpy()
+
+
+##input: bucket memmap dir(s) -> output: same items as CachedImageDataset
+#json_file_paths_list: optional, selects & orders items by their original json_file path
+class BucketMemmapDataset(CachedImageDataset):
+    def __init__(self, memmap_dirs, json_file_paths_list=None, conditional_dropout_percent=0.1, fetch_threads=8):
+        if isinstance(memmap_dirs, str):
+            memmap_dirs = [memmap_dirs]
+
+        #combine indexes
+        self.buckets = []
+        items_by_key = {}
+        for memmap_dir in memmap_dirs:
+            with open(os.path.join(memmap_dir, bucket_memmap_index_filename), "r") as f:
+                index = json.load(f)
+            for bucket in index["buckets"]:
+                bucket["path"] = os.path.join(memmap_dir, bucket["dir"])
+                bucket_idx = len(self.buckets)
+                self.buckets.append(bucket)
+                for row, item in enumerate(bucket.pop("items")):
+                    item["bucket_idx"] = bucket_idx
+                    item["row"] = row
+                    item["closest_bucket"] = bucket["closest_bucket"]
+                    items_by_key[item["key"]] = item
+
+        #select items
+        if json_file_paths_list is None:
+            self.items = list(items_by_key.values())
+        else:
+            self.items = []
+            for json_file in json_file_paths_list:
+                item = items_by_key.get(json_file)
+                if item is None:
+                    error_message = f"BucketMemmapDataset: {json_file} not found in bucket memmap, skipped"
+                    print(error_message)
+                    logging.error(error_message)
+                    continue
+                self.items.append(item)
+
+        super().__init__([item["key"] for item in self.items], conditional_dropout_percent, fetch_threads=fetch_threads)
+        self._arrays = {} #(bucket_idx, name): memmap array, opened lazily per process
+
+    #memmaps are not pickled, each DataLoader worker opens its own
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_arrays"] = {}
+        return state
+
+    def _array(self, bucket_idx, name):
+        array = self._arrays.get((bucket_idx, name))
+        if array is None:
+            #mmap_mode="c": copy-on-write, writable views so torch.from_numpy doesn't warn, file is never modified
+            array = np.load(os.path.join(self.buckets[bucket_idx]["path"], f"{name}.npy"), mmap_mode="c")
+            self._arrays[(bucket_idx, name)] = array
+        return array
+
+    def get_closest_bucket(self, index):
+        return self.items[index]["closest_bucket"]
+
+    def _load_metadata(self, index):
+        return self.items[index]
+
+    #the item's row of each bucket array, dropped items only their model_input row
+    def _readahead_ranges(self, index, dropped):
+        item = self.items[index]
+        bucket_idx = item["bucket_idx"]
+        ranges = []
+        for name in cached_tensor_names if not dropped else ["model_input"]:
+            array = self._array(bucket_idx, name)
+            ranges.append((array.filename, array.offset + item["row"] * array.strides[0], array.strides[0]))
+        return ranges
+
+    def _load_cached_tensors(self, index, metadata, load_embeds=True):
+        bucket_idx = metadata["bucket_idx"]
+        dtypes = self.buckets[bucket_idx]["dtypes"]
+        tensors = []
+        for name in cached_tensor_names:
+            if not load_embeds and name != "model_input":
+                tensors.append(None)
+                continue
+            tensor = torch.from_numpy(self._array(bucket_idx, name)[metadata["row"]])
+            if dtypes[name] == "torch.bfloat16":
+                tensor = tensor.view(torch.bfloat16)
+            tensors.append(tensor)
+        return tensors
+
+
+#converts existing cached dataset (.metadata.json + .pkl files) to per bucket memmap arrays
+#input: json_file_paths_list, output: memmap_dir
+#returns (items written, items that failed), sdxl_convert_cache_format fails the run if any item failed
+def convert_cached_dataset_to_bucket_memmap(json_file_paths_list, memmap_dir):
+    print(f"\nconverting {len(json_file_paths_list)} cached items to bucket memmap arrays")
+    print(f"  memmap_dir: {memmap_dir}")
+    os.makedirs(memmap_dir, exist_ok=True)
+
+    #first pass: group items by bucket, arrays are allocated with a fixed num_items
+    bucket_items = {}
+    num_failed = 0
+    for json_file in json_file_paths_list:
+        try:
+            with open(json_file, "r") as f:
+                metadata = json.load(f)
+        except Exception as e:
+            error_message = f"Error: {e}, for {json_file}"
+            print(error_message)
+            logging.error(error_message)
+            num_failed += 1
+            continue
+        bucket_items.setdefault(tuple(metadata["closest_bucket"]), []).append((json_file, metadata))
+
+    #second pass: fill arrays bucket by bucket
+    buckets = []
+    count = 0
+    for closest_bucket, items in sorted(bucket_items.items()):
+        bucket_dir = f"bucket_{closest_bucket[0]}x{closest_bucket[1]}"
+        bucket_path = os.path.join(memmap_dir, bucket_dir)
+        os.makedirs(bucket_path, exist_ok=True)
+        arrays = {}
+        dtypes = {}
+        bucket_index_items = []
+        for json_file, metadata in items:
+            try:
+                #raw .pkl tensors were saved on the caching gpu, loaded to cpu
+                tensors = {name: load_tensor(metadata[f"{name}_file"], metadata.get("storage_codec") or "raw", map_location="cpu") for name in cached_tensor_names}
+            except Exception as e:
+                error_message = f"Error: {e}, for {json_file}"
+                print(error_message)
+                logging.error(error_message)
+                num_failed += 1
+                continue
+
+            #allocate arrays from the first readable item of the bucket
+            if not arrays:
+                for name, tensor in tensors.items():
+                    data = tensor_to_numpy(tensor)
+                    dtypes[name] = str(tensor.dtype)
+                    arrays[name] = np.lib.format.open_memmap(
+                        os.path.join(bucket_path, f"{name}.npy"),
+                        mode="w+",
+                        dtype=data.dtype,
+                        shape=(len(items),) + data.shape,
+                    )
+
+            row = len(bucket_index_items)
+            try:
+                for name, tensor in tensors.items():
+                    arrays[name][row] = tensor_to_numpy(tensor)
+            except Exception as e: #shape mismatch inside a bucket
+                error_message = f"Error: {e}, for {json_file}"
+                print(error_message)
+                logging.error(error_message)
+                num_failed += 1
+                continue
+
+            item = {"key": json_file}
+            item.update({k: metadata[k] for k in packed_metadata_keys if k in metadata})
+            bucket_index_items.append(item)
+            count += 1
+            print(f"\r[{count}]: {json_file[-60:]}", end="")
+
+        if not arrays:
+            continue
+        for array in arrays.values():
+            array.flush()
+        del arrays
+
+        #unused rows (unreadable items) are left at the end of the arrays, index only lists written rows
+        buckets.append({
+            "dir": bucket_dir,
+            "closest_bucket": list(closest_bucket),
+            "dtypes": dtypes,
+            "items": bucket_index_items,
+        })
+
+    #write index last, a memmap dir without index is incomplete
+    index_path = os.path.join(memmap_dir, bucket_memmap_index_filename)
+    with open(index_path + ".tmp", "w") as f:
+        json.dump({"buckets": buckets}, f)
+    os.replace(index_path + ".tmp", index_path)
+
+    print(f"\n{count} items written to {len(buckets)} bucket arrays, {num_failed} failed")
+    return count, num_failed
@@ -0,0 +1,106 @@
+#sdxl_caption_embed_functions.py
+#content-addressed caption embedding store, duplicate captions are encoded & stored once:
+    #one store per cached dataset: cache_dir/basename/caption_embeds/
+        #key[:2]/key.prompt_embed.pkl & key[:2]/key.pooled_prompt_embed.pkl
+    #key: sha256 of text encoder identity + caption_string (+ storage_codec, if not raw)
+        #embeds are only reused for the same caption, text encoders & storage codec
+    #items' .metadata.json prompt_embed_file & pooled_prompt_embed_file point at the store, readers are unchanged
+    #empty captions ("" from data_dir_search) share one entry
+
+
+import hashlib
+import os
+
+from sdxl_codec_functions_01 import dump_tensor, load_tensor
+
+
+caption_embeds_dirname = "caption_embeds"
+
+
+#identifies the text encoders that produced an embed
+    #model path, text encoder classes & hub commit hash (if loaded from the hub)
+def text_encoder_identity(pretrained_model_name_or_path, text_encoder_one, text_encoder_two):
+    parts = [str(pretrained_model_name_or_path)]
+    for text_encoder in [text_encoder_one, text_encoder_two]:
+        config = getattr(text_encoder, "config", None)
+        parts.append(type(text_encoder).__name__)
+        parts.append(str(getattr(config, "_commit_hash", None) or ""))
+    return "|".join(parts)
+
+
+class CaptionEmbedStore:
+    def __init__(self, store_dir, encoder_identity):
+        self.store_dir = store_dir
+        self.encoder_identity = encoder_identity
+        self.known_keys = set() #keys written or queued for writing this run
+        self.embed_shapes = None #(prompt_embed_shape, pooled_prompt_embed_shape)
+        #savings report
+        self.num_captions = 0
+        self.num_encoded = 0
+        self.encode_seconds = 0.0
+        self.embed_nbytes = 0 #prompt_embed + pooled_prompt_embed bytes, per caption
+
+    def key(self, caption_string, storage_codec="raw"):
+        if storage_codec == "raw":
+            return hashlib.sha256(f"{self.encoder_identity}\n{caption_string}".encode()).hexdigest()
+        return hashlib.sha256(f"{self.encoder_identity}\n{storage_codec}\n{caption_string}".encode()).hexdigest()
+
+    #returns (prompt_embed_file, pooled_prompt_embed_file)
+    def embed_files(self, key):
+        key_dir = os.path.join(self.store_dir, key[:2])
+        return os.path.join(key_dir, f"{key}.prompt_embed.pkl"), os.path.join(key_dir, f"{key}.pooled_prompt_embed.pkl")
+
+    #pooled_prompt_embed_file is written last, exists = both files written
+    def __contains__(self, key):
+        return key in self.known_keys or os.path.exists(self.embed_files(key)[1])
+
+    #points metadata at the store entry for its caption_string & storage_codec, returns key
+    def assign(self, metadata):
+        key = self.key(metadata["caption_string"], metadata.get("storage_codec") or "raw")
+        prompt_embed_file, pooled_prompt_embed_file = self.embed_files(key)
+        metadata["caption_embed_key"] = key
+        metadata["prompt_embed_file"] = prompt_embed_file
+        metadata["prompt_embed_file_hash_value"] = hashlib.sha256(prompt_embed_file.encode()).hexdigest()
+        metadata["pooled_prompt_embed_file"] = pooled_prompt_embed_file
+        metadata["pooled_prompt_embed_file_hash_value"] = hashlib.sha256(pooled_prompt_embed_file.encode()).hexdigest()
+        return key
+
+    #queues key's embeds for writing, writer: CacheFileWriter
+    def submit(self, writer, key, prompt_embed, pooled_prompt_embed, storage_codec="raw"):
+        self.known_keys.add(key)
+        self.embed_shapes = (prompt_embed.shape, pooled_prompt_embed.shape)
+        self.embed_nbytes = prompt_embed.nbytes + pooled_prompt_embed.nbytes
+        writer.submit(self.write, key, prompt_embed, pooled_prompt_embed, storage_codec)
+
+    #temp file + os.replace: several caching processes may write the same key
+    def write(self, key, prompt_embed, pooled_prompt_embed, storage_codec="raw"):
+        for tensor, embed_file in zip([prompt_embed, pooled_prompt_embed], self.embed_files(key)):
+            os.makedirs(os.path.dirname(embed_file), exist_ok=True)
+            temp_file = f"{embed_file}.{os.getpid()}.tmp"
+            dump_tensor(tensor, temp_file, storage_codec)
+            os.replace(temp_file, embed_file)
+
+    #returns (prompt_embed_shape, pooled_prompt_embed_shape), same for every caption
+    def get_embed_shapes(self, key, storage_codec="raw"):
+        if self.embed_shapes is None:
+            #nothing encoded this run, read shapes from an existing entry
+            prompt_embed_file, pooled_prompt_embed_file = self.embed_files(key)
+            prompt_embed = load_tensor(prompt_embed_file, storage_codec)
+            pooled_prompt_embed = load_tensor(pooled_prompt_embed_file, storage_codec)
+            self.embed_shapes = (prompt_embed.shape, pooled_prompt_embed.shape)
+            self.embed_nbytes = prompt_embed.nbytes + pooled_prompt_embed.nbytes
+        return self.embed_shapes
+
+    def add_count(self, num_captions, num_encoded, encode_seconds):
+        self.num_captions += num_captions
+        self.num_encoded += num_encoded
+        self.encode_seconds += encode_seconds
+
+    #encoder time saved: reused captions * measured encode time per caption
+    def print_report(self):
+        num_reused = self.num_captions - self.num_encoded
+        if self.num_captions == 0:
+            return
+        seconds_per_caption = self.encode_seconds / self.num_encoded if self.num_encoded > 0 else 0.0
+        print(f"  --caption_embeds: {self.num_captions} captions, {self.num_encoded} encoded, {num_reused} reused ({100 * num_reused / self.num_captions:.1f}%)")
+        print(f"    saved: ~{num_reused * seconds_per_caption:.1f}s text encoding, ~{num_reused * self.embed_nbytes / 1024**2:.1f} MB disk")
@@ -0,0 +1,209 @@
+#sdxl_catalog_functions.py
+#metadata catalog for cached datasets, replaces reading one .metadata.json per item:
+    #one sqlite file per cached dataset: cache_dir/basename/catalog.sqlite, next to the .list files
+    #CachedDatasetCatalog - written incrementally by cache_image_caption_pair, queried by json_file or bucket
+    #build_catalog_from_json_files - migration tool, builds a catalog from existing .metadata.json trees
+    #load_cached_metadata - bulk read for sdxl_train: catalogs first, .metadata.json only for items missing from catalogs
+#catalog metadata: json_file: dict with the metadata keys used by dataset, sampler, & validation
+    #full .metadata.json contents are kept in the catalog too, use CachedDatasetCatalog.get()
+#commit_every: writes are committed in batches, caching processes sharing a catalog take its write lock once per batch
+    #busy_timeout: a process waiting on another's batch retries for timeout seconds instead of failing with "database is locked"
+    #after a crash the last uncommitted items are missing from the catalog, load_cached_metadata reads their .metadata.json
+
+
+import json
+import logging
+import os
+import sqlite3
+
+
+catalog_filename = "catalog.sqlite"
+catalog_commit_every = 256 #items per commit while caching
+
+#metadata keys stored as json text columns
+catalog_json_columns = [
+    "closest_bucket",
+    "add_time_id",
+    "original_size",
+    "original_image_size",
+    "cropped_image_size",
+    "token_ids_one",
+    "token_ids_two",
+]
+
+#metadata keys stored as plain columns
+catalog_columns = [
+    "category_key",
+    "cropped_image_height",
+    "cropped_image_width",
+    "caption_string",
+    "image_file",
+    "caption_file",
+    "model_input_file",
+    "prompt_embed_file",
+    "pooled_prompt_embed_file",
+    "image_file_hash_value",
+    "caption_file_hash_value",
+    "model_input_file_hash_value",
+    "prompt_embed_file_hash_value",
+    "pooled_prompt_embed_file_hash_value",
+    "storage_codec",
+]
+
+
+class CachedDatasetCatalog:
+    def __init__(self, catalog_path, timeout=60, commit_every=1):
+        self.catalog_path = catalog_path
+        self.commit_every = max(1, commit_every)
+        self.num_uncommitted = 0
+        #timeout: several caching processes may write the same catalog
+        #check_same_thread=False: catalog may be written from a writer thread
+        self.conn = sqlite3.connect(catalog_path, timeout=timeout, check_same_thread=False)
+        self.conn.execute(f"PRAGMA busy_timeout = {int(timeout * 1000)}")
+        #plain columns have no declared type, values keep their python type (int/str)
+        columns = ", ".join([f"{column} TEXT" for column in catalog_json_columns] + catalog_columns)
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS items ("
+            f"json_file TEXT PRIMARY KEY, bucket_width INTEGER, bucket_height INTEGER, {columns}, "
+            f"packed_shard TEXT, packed_offset INTEGER, packed_nbytes INTEGER, metadata TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS items_bucket ON items (bucket_width, bucket_height)")
+        #catalogs created before a column existed
+        existing_columns = {row[1] for row in self.conn.execute("PRAGMA table_info(items)")}
+        for column in catalog_json_columns + catalog_columns:
+            if column not in existing_columns:
+                self.conn.execute(f"ALTER TABLE items ADD COLUMN {column}")
+        self.conn.commit()
+
+    #adds or replaces an item, commit=False for bulk writes, then call commit()
+    #commit=True: committed with every commit_every-th write
+    def add(self, json_file, metadata, commit=True):
+        closest_bucket = metadata.get("closest_bucket") or [None, None]
+        values = [json_file, closest_bucket[0], closest_bucket[1]]
+        values += [json.dumps(metadata.get(column)) for column in catalog_json_columns]
+        values += [metadata.get(column) for column in catalog_columns]
+        values += [json.dumps(metadata)]
+        columns = ["json_file", "bucket_width", "bucket_height"] + catalog_json_columns + catalog_columns + ["metadata"]
+        placeholders = ", ".join("?" for _ in columns)
+        self.conn.execute(f"INSERT OR REPLACE INTO items ({', '.join(columns)}) VALUES ({placeholders})", values)
+        self._written(commit)
+
+    #records where an item is stored in a packed shard
+    def set_packed_location(self, json_file, shard_path, offset, nbytes, commit=True):
+        self.conn.execute(
+            "UPDATE items SET packed_shard = ?, packed_offset = ?, packed_nbytes = ? WHERE json_file = ?",
+            (shard_path, offset, nbytes, json_file),
+        )
+        self._written(commit)
+
+    def remove(self, json_file, commit=True):
+        self.conn.execute("DELETE FROM items WHERE json_file = ?", (json_file,))
+        self._written(commit)
+
+    def _written(self, commit):
+        self.num_uncommitted += 1
+        if commit and self.num_uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.num_uncommitted = 0
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def __contains__(self, json_file):
+        row = self.conn.execute("SELECT 1 FROM items WHERE json_file = ?", (json_file,)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    #returns full .metadata.json contents of an item, None if not in catalog
+    def get(self, json_file):
+        row = self.conn.execute("SELECT metadata FROM items WHERE json_file = ?", (json_file,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    #row -> catalog metadata dict
+    def _row_to_metadata(self, row):
+        metadata = {}
+        for column, value in zip(catalog_json_columns, row[1:]):
+            metadata[column] = json.loads(value) if value is not None else None #NULL: column added after the item
+        for column, value in zip(catalog_columns, row[1 + len(catalog_json_columns):]):
+            metadata[column] = value
+        metadata["packed_shard"], metadata["packed_offset"], metadata["packed_nbytes"] = row[-3:]
+        return metadata
+
+    def _select(self, where="", parameters=()):
+        columns = ["json_file"] + catalog_json_columns + catalog_columns + ["packed_shard", "packed_offset", "packed_nbytes"]
+        return self.conn.execute(f"SELECT {', '.join(columns)} FROM items {where}", parameters)
+
+    #one bulk read of the whole catalog, returns {json_file: catalog metadata}
+    def get_all(self):
+        return {row[0]: self._row_to_metadata(row) for row in self._select()}
+
+    #returns {json_file: catalog metadata} for items in bucket [width, height]
+    def get_bucket(self, closest_bucket):
+        rows = self._select("WHERE bucket_width = ? AND bucket_height = ?", (closest_bucket[0], closest_bucket[1]))
+        return {row[0]: self._row_to_metadata(row) for row in rows}
+
+    #returns {(width, height): num_items}
+    def bucket_counts(self):
+        rows = self.conn.execute("SELECT bucket_width, bucket_height, COUNT(*) FROM items GROUP BY bucket_width, bucket_height")
+        return {(row[0], row[1]): row[2] for row in rows}
+
+
+#migration tool: builds/updates a catalog from existing .metadata.json files
+def build_catalog_from_json_files(json_file_paths_list, catalog_path):
+    print(f"\nbuilding catalog: {catalog_path}")
+    catalog = CachedDatasetCatalog(catalog_path)
+    count = 0
+    for json_file in json_file_paths_list:
+        try:
+            with open(json_file, "r") as f:
+                metadata = json.load(f)
+        except Exception as e:
+            error_message = f"Error: {e}, for {json_file}"
+            print(error_message)
+            logging.error(error_message)
+            continue
+        catalog.add(json_file, metadata, commit=False)
+        count += 1
+        if count % 10000 == 0:
+            catalog.commit()
+            print(f"\r[{count}]", end="")
+    catalog.close()
+    print(f"\n{count} items added to catalog")
+    return count
+
+
+#bulk read metadata for json_file_paths_list
+#catalog_paths: catalogs to read first, items missing from catalogs are read from their .metadata.json
+#returns {json_file: metadata}
+def load_cached_metadata(json_file_paths_list, catalog_paths):
+    metadata_lookup = {}
+    for catalog_path in catalog_paths:
+        if os.path.exists(catalog_path):
+            catalog = CachedDatasetCatalog(catalog_path)
+            metadata_lookup.update(catalog.get_all())
+            catalog.close()
+
+    #fallback for items not in any catalog
+    num_from_catalog = 0
+    for json_file in json_file_paths_list:
+        if json_file in metadata_lookup:
+            num_from_catalog += 1
+            continue
+        try:
+            with open(json_file, "r") as f:
+                metadata_lookup[json_file] = json.load(f)
+        except Exception as e:
+            error_message = f"load_cached_metadata: Error reading {json_file}: {e}"
+            print(error_message)
+            logging.error(error_message)
+
+    print(f"  --metadata: {num_from_catalog} from catalog, {len(json_file_paths_list) - num_from_catalog} from .metadata.json")
+    return metadata_lookup
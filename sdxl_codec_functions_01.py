@@ -0,0 +1,165 @@
+#sdxl_codec_functions.py
+#storage codecs for cached tensors (model_input, prompt_embed, pooled_prompt_embed):
+    #one codec per cached dataset, recorded per item in .metadata.json "storage_codec", missing = "raw"
+    #codec: "<dtype codec>" or "<dtype codec>+<compression>"
+        #dtype codec:
+            #raw: joblib pickle of the tensor as encoded, same files as before codecs existed
+            #fp16 / bf16: cast to torch.float16 / torch.bfloat16
+            #int8: per-channel symmetric int8 with float32 scales, channel = dim 0 (latent channels, prompt_embed tokens)
+        #compression (optional packages): zstd (zstandard), lz4 (lz4)
+    #non-raw files: magic + header length + json header (dtype, shape, codec) + payload [+ int8 scales]
+    #load_tensor decodes to the dtype the tensor had before encoding, readers don't need to know the codec
+        #map_location: raw files hold the tensor on the device it was encoded on (cuda), "cpu" loads without cuda
+
+
+import io
+import json
+import pickle
+import struct
+
+import joblib
+import numpy as np
+import torch
+
+
+storage_codecs = ["raw", "fp16", "bf16", "int8"]
+storage_compressions = ["zstd", "lz4"]
+codec_magic = b"SDXLTC01"
+
+#dtype names stored in headers
+codec_dtypes = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "int8": torch.int8,
+}
+
+
+#returns (dtype codec, compression or None), raises ValueError for unknown codecs
+def parse_storage_codec(storage_codec):
+    dtype_codec, _, compression = (storage_codec or "raw").partition("+")
+    if dtype_codec not in storage_codecs or (compression and compression not in storage_compressions):
+        raise ValueError(f"unknown storage_codec: {storage_codec}, use one of {storage_codecs}, optionally + one of {storage_compressions}")
+    if dtype_codec == "raw" and compression:
+        raise ValueError(f"storage_codec raw can't be compressed, use fp16+{compression} etc.")
+    return dtype_codec, compression or None
+
+
+def compress_bytes(data, compression):
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if compression == "lz4":
+        import lz4.frame
+        return lz4.frame.compress(data)
+    return data
+
+
+def decompress_bytes(data, compression):
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    if compression == "lz4":
+        import lz4.frame
+        return lz4.frame.decompress(data)
+    return data
+
+
+#tensor -> bytes, bfloat16 has no numpy dtype: stored as its int16 bits
+def tensor_to_bytes(tensor):
+    tensor = tensor.detach().cpu().contiguous()
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+    return tensor.numpy().tobytes()
+
+
+def tensor_from_bytes(data, dtype, shape):
+    if dtype == torch.bfloat16:
+        return torch.from_numpy(np.frombuffer(data, dtype=np.int16).copy()).view(torch.bfloat16).reshape(shape)
+    return torch.from_numpy(np.frombuffer(data, dtype=torch.empty(0, dtype=dtype).numpy().dtype).copy()).reshape(shape)
+
+
+#returns (int8 tensor, float32 scales), scales: one per dim 0 channel, max abs value / 127
+def quantize_int8(tensor):
+    tensor = tensor.detach().float().cpu()
+    channels = tensor.reshape(tensor.shape[0], -1) if tensor.dim() > 1 else tensor.reshape(1, -1)
+    scales = channels.abs().amax(dim=1) / 127
+    scales = torch.where(scales > 0, scales, torch.ones_like(scales)) #all zero channel
+    quantized = torch.round(channels / scales[:, None]).clamp(-127, 127).to(torch.int8)
+    return quantized.reshape(tensor.shape), scales
+
+
+def dequantize_int8(quantized, scales, dtype):
+    channels = quantized.reshape(len(scales), -1).float() * scales[:, None]
+    return channels.reshape(quantized.shape).to(dtype)
+
+
+#returns encoded bytes of tensor, storage_codec must not be raw
+def encode_tensor(tensor, storage_codec):
+    dtype_codec, compression = parse_storage_codec(storage_codec)
+    original_dtype = str(tensor.dtype).replace("torch.", "")
+    header = {"codec": storage_codec, "dtype": original_dtype, "shape": list(tensor.shape)}
+    if dtype_codec == "int8":
+        quantized, scales = quantize_int8(tensor)
+        payload = tensor_to_bytes(quantized) + tensor_to_bytes(scales)
+        header["num_scales"] = len(scales)
+    else:
+        stored_dtype = torch.float16 if dtype_codec == "fp16" else torch.bfloat16
+        payload = tensor_to_bytes(tensor.to(stored_dtype))
+    payload = compress_bytes(payload, compression)
+    header_bytes = json.dumps(header).encode()
+    return codec_magic + struct.pack("<I", len(header_bytes)) + header_bytes + payload
+
+
+#encoded bytes -> tensor, in the dtype it had before encoding
+def decode_tensor(data):
+    if data[:len(codec_magic)] != codec_magic:
+        raise ValueError("not a storage codec file")
+    header_start = len(codec_magic) + 4
+    header_length = struct.unpack("<I", data[len(codec_magic):header_start])[0]
+    header = json.loads(data[header_start:header_start + header_length])
+    dtype_codec, compression = parse_storage_codec(header["codec"])
+    payload = decompress_bytes(data[header_start + header_length:], compression)
+    dtype = codec_dtypes[header["dtype"]]
+    shape = header["shape"]
+    if dtype_codec == "int8":
+        num_elements = int(np.prod(shape)) if len(shape) > 0 else 1
+        quantized = tensor_from_bytes(payload[:num_elements], torch.int8, shape)
+        scales = tensor_from_bytes(payload[num_elements:], torch.float32, [header["num_scales"]])
+        return dequantize_int8(quantized, scales, dtype)
+    stored_dtype = torch.float16 if dtype_codec == "fp16" else torch.bfloat16
+    return tensor_from_bytes(payload, stored_dtype, shape).to(dtype)
+
+
+#writes tensor to file_path with storage_codec
+def dump_tensor(tensor, file_path, storage_codec="raw"):
+    if parse_storage_codec(storage_codec)[0] == "raw":
+        joblib.dump(tensor, file_path)
+        return
+    with open(file_path, "wb") as f:
+        f.write(encode_tensor(tensor, storage_codec))
+
+
+#unpickler for raw files, tensor storages are loaded with torch.load map_location
+#no cuda init: safe in DataLoader workers & on machines without the caching gpu
+class MapLocationUnpickler(pickle.Unpickler):
+    def __init__(self, f, map_location):
+        super().__init__(f)
+        self.map_location = map_location
+
+    def find_class(self, module, name):
+        if module == "torch.storage" and name == "_load_from_bytes":
+            return lambda data: torch.load(io.BytesIO(data), map_location=self.map_location, weights_only=False)
+        return super().find_class(module, name)
+
+
+#reads a tensor written by dump_tensor, storage_codec from the item's metadata
+#map_location: None = raw tensors on their saved device, non-raw codecs always decode to cpu
+def load_tensor(file_path, storage_codec="raw", map_location=None):
+    if parse_storage_codec(storage_codec)[0] == "raw":
+        if map_location is None:
+            return joblib.load(file_path)
+        with open(file_path, "rb") as f:
+            return MapLocationUnpickler(f, map_location).load()
+    with open(file_path, "rb") as f:
+        return decode_tensor(f.read())
@@ -0,0 +1,84 @@
+#convert_cache_format.py
+	#converts a cached dataset (.list files of .metadata.json + .pkl files) to another cache format
+	#input: --cached_dataset_dirs and/or --cached_dataset_lists, same as sdxl_FSDP_train
+	#output formats:
+		#packed_shards: large append-only shard files + offset index, use with sdxl_FSDP_train --packed_shard_dirs
+		#bucket_memmap: fixed-shape .npy arrays per aspect bucket, use with sdxl_FSDP_train --bucket_memmap_dirs
+		#tar_shards: sequential tar shards per aspect bucket, streamed, use with sdxl_FSDP_train --tar_shard_dirs
+		#catalog: migration tool, builds catalog.sqlite next to each .list file from existing .metadata.json files
+			#sdxl_FSDP_train reads catalogs automatically, --output_dir not used
+
+
+import argparse
+import logging
+import os
+import sys
+
+from sdxl_cache_format_functions_01 import convert_cached_dataset_to_packed_shards, convert_cached_dataset_to_bucket_memmap
+from sdxl_catalog_functions_01 import build_catalog_from_json_files, catalog_filename
+from sdxl_tar_shard_functions_01 import convert_cached_dataset_to_tar_shards
+
+
+#welcome message
+print("\nconvert_cache_format: initializing")
+
+
+##arguments
+parser = argparse.ArgumentParser()
+parser.add_argument("--cached_dataset_dirs", nargs='+', type=str, help="path/to/cache : has cached_dataset.list(s), accepts multiple dirs")
+parser.add_argument("--cached_dataset_lists", nargs='+', type=str, help="path/to/cache_dataset.list, accepts multiple files")
+parser.add_argument("--output_dir", type=str, help="path/to/output_dir for the converted cache")
+parser.add_argument("--output_format", type=str, default="packed_shards", choices=["packed_shards", "bucket_memmap", "tar_shards", "catalog"], help="cache format to convert to")
+parser.add_argument("--shard_size_gb", type=float, default=4.0, help="packed_shards & tar_shards: maximum size of each shard file")
+parser.add_argument("--seed", type=int, default=123, help="tar_shards: seed for the item order inside each bucket")
+args = parser.parse_args()
+if args.output_format != "catalog" and args.output_dir is None:
+	parser.error(f"--output_dir is required for --output_format {args.output_format}")
+
+
+##error logging
+logging.basicConfig(
+	filename="error_log.txt",  # Specify the log file name
+	level=logging.ERROR,  # Set the logging level to ERROR
+	format="%(asctime)s - %(levelname)s - %(message)s"  # Format for log messages
+)
+
+
+##collect .list files
+cached_dataset_lists = list(args.cached_dataset_lists or [])
+for dir in args.cached_dataset_dirs or []:
+	for item in os.listdir(dir):
+		if item[-5:] == ".list":
+			cached_dataset_lists.append(os.path.join(dir, item))
+
+#read .list files
+json_file_paths_list = []
+for item in cached_dataset_lists:
+	print(f"found: {item}")
+	with open(item, "r") as f:
+		json_file_paths_list += [line.strip() for line in f if line.strip()]
+json_file_paths_list = sorted(set(json_file_paths_list)) #remove duplicates
+print(f"{len(json_file_paths_list)} cached image-caption pairs found")
+
+
+##convert
+num_converted, num_failed = None, 0 #None: catalog, no cached tensors converted
+if args.output_format == "packed_shards":
+	num_converted, num_failed = convert_cached_dataset_to_packed_shards(json_file_paths_list, args.output_dir, args.shard_size_gb)
+elif args.output_format == "bucket_memmap":
+	num_converted, num_failed = convert_cached_dataset_to_bucket_memmap(json_file_paths_list, args.output_dir)
+elif args.output_format == "tar_shards":
+	num_converted, num_failed = convert_cached_dataset_to_tar_shards(json_file_paths_list, args.output_dir, args.shard_size_gb, args.seed)
+elif args.output_format == "catalog":
+	#one catalog per .list dir, where sdxl_FSDP_train looks for it
+	for item in cached_dataset_lists:
+		with open(item, "r") as f:
+			list_json_files = [line.strip() for line in f if line.strip()]
+		build_catalog_from_json_files(list_json_files, os.path.join(os.path.dirname(item), catalog_filename))
+
+#an incomplete converted cache silently trains on fewer items, fail the run
+if num_converted is not None and (num_converted == 0 or num_failed > 0):
+	error_message = f"convert_cache_format: {num_converted} items converted, {num_failed} failed, see error_log.txt"
+	print(error_message)
+	logging.error(error_message)
+	sys.exit(1)
@@ -2,10 +2,26 @@
 #provides various dataset related functions for sdxl_train system:
     #data_dir_search - searches a dataset dir, creates image_caption_pair_file tuple list
     #cache_image_caption_pair - caches lists of image-caption.txt pairs, creates .list file for use as cached dataset 
+        #images are vae encoded in batches per aspect bucket, vae_batch_size
+        #captions are tokenized & text encoded in batches, caption_batch_size
+        #num_preprocess_workers > 0: staged pipeline, process pool preprocessing -> encoders -> writer thread
+        #manifest.jsonl: re-runs skip unchanged pairs, edited captions/images only re-encode their own files
+        #cache_prompt_embeds=False: captions cached as token ids only, text encoded during training (--encode_text_on_the_fly)
+    #recache_captions - re-encodes captions of a cached dataset, keeps latents
     #cached_file_integrity_check - verifies cached dataset integrity
     #CachedImageDataset - loads cached dataset to be sent to dataloader
+        #metadata_lookup: optional {json_file: metadata} from catalog, avoids reading .metadata.json per item
+        #worker safe: cpu tensors only, no shared mutable state, DataLoader num_workers > 0
+        #__getitems__: whole batch fetched at once on fetch_threads threads, fetch_seconds per batch
+        #ram_cache_gb > 0: decoded tensors kept in a bounded LRU cache, see sdxl_ram_cache_functions
+        #load_prompt_embeds=False: items carry the caption's token ids instead of prompt embeds, for --encode_text_on_the_fly
     #BucketBatchSampler - creates batch by aspect ratio buckets, batch_size sent here instead dataloader
         #if drop_last=True, leftover_items are appended to next epoch
+        #yields (index, dropped) items: conditional dropout decided by the sampler's seeded rng, not in workers
+        #dropped items skip reading their prompt embed files, empty embeds are swapped in on device, apply_conditional_dropout
+        #readahead: upcoming batches' files requested from the OS ahead of time, see sdxl_readahead_functions
+    #cached_batch_collate - DataLoader collate_fn for CachedImageDataset, contiguous batch tensors & [bsz, 6] add_time_id
+    #apply_conditional_dropout - swaps device resident empty prompt embeds into the dropped rows of a batch
 #place these 2 files in base directory
     #GFPGANv1.3.pth : https://github.com/TencentARC/GFPGAN/releases/download/v1.3.0/GFPGANv1.3.pth
     #RealESRGAN_x4plus.pth : https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.0/RealESRGAN_x4plus.pth
@@ -14,14 +30,20 @@
     #need to re-check/verify random selection of aspect bucket each batch
 
 
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import gc
 import hashlib
 import json
 import logging
 import math
+import multiprocessing
 import os
 from pathlib import Path #not used, but probably will be used
+import queue
 import random
+import threading
+import time
 
 from diffusers import AutoencoderKL
 import joblib
@@ -31,7 +53,15 @@ import torch
 from torch.utils.data import Dataset, Sampler
 from torchvision import transforms
 from torchvision.transforms import ToTensor, Resize, ToPILImage
-from transformers import CLIPTokenizer, CLIPTextModel, CLIPTextModelWithProjection
+from transformers import CLIPTokenizer, CLIPTokenizerFast, CLIPTextModel, CLIPTextModelWithProjection
+
+from sdxl_catalog_functions_01 import CachedDatasetCatalog, catalog_filename, catalog_commit_every
+from sdxl_manifest_functions_01 import CacheManifest, manifest_filename
+from sdxl_caption_embed_functions_01 import CaptionEmbedStore, caption_embeds_dirname, text_encoder_identity
+from sdxl_scan_functions_01 import scan_data_dir
+from sdxl_bucket_functions_01 import create_aspect_categories, get_bucket_engine
+from sdxl_codec_functions_01 import dump_tensor, load_tensor, parse_storage_codec
+from sdxl_ram_cache_functions_01 import TensorLRUCache
 
 #Real_ESRGAN & GFPGAN
 from basicsr.archs.rrdbnet_arch import RRDBNet
@@ -41,116 +71,261 @@ import cv2
 
 
 #group indices by their corresponding aspect ratio buckets before sampling batches.
+#bucket ids are computed once, each epoch is rebuilt from numpy arrays
+#shuffles are seeded by (seed, epoch): every rank derives the same batch order without communication
+#carry_leftovers: if drop_last=True, leftover items are prepended to their bucket next epoch, else dropped
+#state_dict/load_state_dict: exact mid-epoch resume on the same world size
+    #no rng state to save, an epoch is fully determined by seed, epoch, & leftover items carried into it
+    #batch positions need the same item order every launch: build json_file lists with load_cached_json_list (sorted)
+    #leftover items are also saved as json_file paths, mapped back to indices of the resumed dataset
+#conditional dropout: flags drawn per epoch from (seed, epoch), dataset.conditional_dropout_percent
+    #batches are [(index, dropped), ...], same dropout for any DataLoader num_workers, & on resume
+#readahead: optional ReadAheadService, told the epoch's batch order so upcoming files are read before the dataset needs them
 class BucketBatchSampler(Sampler):
-    def __init__(self, dataset, batch_size, drop_last=True):
+    def __init__(self, dataset, batch_size, drop_last=True, seed=None, carry_leftovers=True, readahead=None):
         self.dataset = dataset
+        self.readahead = readahead #optional ReadAheadService, see sdxl_readahead_functions
         self.batch_size = batch_size
         self.drop_last = drop_last
+        self.carry_leftovers = carry_leftovers
+        if seed is None: #same on all ranks only if python random is seeded, sdxl_train passes a seed
+            seed = random.randrange(2 ** 32)
+        self.seed = seed
+        self.conditional_dropout_percent = getattr(dataset, "conditional_dropout_percent", 0.0)
+        self.epoch = 0
         self.leftover_items = []  #tracks leftover items, without modifying the dataset
+        #current epoch, for state_dict
+        self.iter_epoch = None
+        self.iter_leftover_items = [] #leftover items carried into current epoch
+        self.iter_start_batch = 0 #batches skipped at start of current epoch, when resumed
+        self.resume_num_batches = 0 #batches to skip on next __iter__, set by load_state_dict
         
-        self.bucket_indices = self._bucket_indices_by_aspect_ratio() 
-
-    #groups dataset indices into buckets based on aspect ratio
-    def _bucket_indices_by_aspect_ratio(self):
-        buckets = {}
+        self.bucket_ids, self.buckets = self._bucket_ids_by_aspect_ratio()
+        self.bucket_counts = np.bincount(self.bucket_ids, minlength=len(self.buckets))
+        #dataset indices sorted by bucket id, bucket b = bucket_order[bucket_starts[b]:bucket_starts[b + 1]]
+        self.bucket_order = np.argsort(self.bucket_ids, kind="stable")
+        self.bucket_starts = np.concatenate(([0], np.cumsum(self.bucket_counts)))
+
+    #assigns each dataset index an integer bucket id, only done once
+    #returns bucket_ids array & buckets list (bucket id -> closest_bucket)
+    def _bucket_ids_by_aspect_ratio(self):
+        bucket_to_id = {}
+        bucket_ids = np.empty(len(self.dataset), dtype=np.int64)
         for idx in range(len(self.dataset)): #iterates whole dataset
-            closest_bucket = self.dataset.get_closest_bucket(idx) #retrieves closest_bucket from dataset
-            closest_bucket_key = tuple(closest_bucket) #key for dictionary
-            if closest_bucket_key not in buckets: #creates bucket if needed
-                buckets[closest_bucket_key] = []
-            buckets[closest_bucket_key].append(idx) #adds item to bucket
-        for bucket in buckets.values(): #shuffles each bucket's contents
-            random.shuffle(bucket)
-        return buckets #returns organized buckets
+            closest_bucket_key = tuple(self.dataset.get_closest_bucket(idx)) #key for dictionary
+            bucket_ids[idx] = bucket_to_id.setdefault(closest_bucket_key, len(bucket_to_id))
+        return bucket_ids, list(bucket_to_id)
+
+    #sets epoch used for the next __iter__, otherwise epoch advances by 1 every __iter__
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    #builds an epoch's batches: returns concatenated batch indices, batch start offsets & new leftover items
+    def _build_epoch(self, epoch, leftover_items):
+        rng = np.random.default_rng([self.seed, epoch])
+        leftover_items = np.asarray(leftover_items, dtype=np.int64)
+        leftover_bucket_ids = self.bucket_ids[leftover_items]
+
+        epoch_indices = []
+        batch_starts = []
+        new_leftover_items = []
+        num_indices = 0
+        for bucket_id in rng.permutation(len(self.buckets)): #shuffle buckets' order, random bucket each batch
+            #shuffle bucket's contents, leftovers from last epoch first
+            bucket_indices = rng.permutation(self.bucket_order[self.bucket_starts[bucket_id]:self.bucket_starts[bucket_id + 1]])
+            if len(leftover_items):
+                bucket_indices = np.concatenate((leftover_items[leftover_bucket_ids == bucket_id], bucket_indices))
+
+            #full batches
+            num_full = len(bucket_indices) // self.batch_size * self.batch_size
+            epoch_indices.append(bucket_indices[:num_full])
+            batch_starts.append(np.arange(num_indices, num_indices + num_full, self.batch_size))
+            num_indices += num_full
+
+            #last batch, if too small
+            batch = bucket_indices[num_full:]
+            if not self.drop_last and len(batch): #yield last batch if drop_last is False
+                epoch_indices.append(batch)
+                batch_starts.append(np.array([num_indices]))
+                num_indices += len(batch)
+            elif self.carry_leftovers: #else store leftovers for the next epoch
+                new_leftover_items.extend(batch.tolist())
+
+        epoch_indices = np.concatenate(epoch_indices) if epoch_indices else np.empty(0, dtype=np.int64)
+        batch_starts = np.concatenate(batch_starts + [np.array([num_indices])])
+        return epoch_indices, batch_starts, new_leftover_items
+
+    #conditional dropout flags for an epoch's indices, separate rng stream: batch order unchanged by dropout
+    def _dropout_flags(self, epoch, num_indices):
+        if self.conditional_dropout_percent <= 0:
+            return np.zeros(num_indices, dtype=bool)
+        return np.random.default_rng([self.seed, epoch, 1]).random(num_indices) < self.conditional_dropout_percent
 
     def __iter__(self): #makes sampler iterable, to be used by PyTorch DataLoader
-        #reinitialize bucket_indices, checks if leftover items
-        self.bucket_indices = self._bucket_indices_by_aspect_ratio()
-
-        #if leftover, items are distributed to bucket_indices
-        if self.leftover_items:
-            #same as in def _bucket_indices_by_aspect_ratio(self):
-            for leftover_idx in self.leftover_items:
-                closest_bucket = self.dataset.get_closest_bucket(leftover_idx)
-                closest_bucket_key = tuple(closest_bucket)
-                if closest_bucket_key in self.bucket_indices:
-                    self.bucket_indices[closest_bucket_key].insert(0, leftover_idx)
-                else:
-                    self.bucket_indices[closest_bucket_key] = [leftover_idx]
-            self.leftover_items = []  #reset leftover items
-        
-        all_buckets = list(self.bucket_indices.items())
-        random.shuffle(all_buckets)  #shuffle buckets' order, random bucket each batch
-
-        #iterates over buckets, yields when len(batch) == batch size
-        for _, bucket_indices in all_buckets: #iterate each bucket
-            batch = []
-            for idx in bucket_indices: #for a bucket, try to make batch
-                batch.append(idx)
-                if len(batch) == self.batch_size:
-                    yield batch 
-                    batch = []
-            if not self.drop_last and batch: #if too small
-                yield batch  #yield last batch if drop_last is False
-            elif batch:  #else store leftovers for the next epoch
-                self.leftover_items.extend(batch)  
+        self.iter_epoch = self.epoch
+        self.iter_leftover_items = self.leftover_items
+        epoch_indices, batch_starts, self.leftover_items = self._build_epoch(self.epoch, self.leftover_items)
+        dropout_flags = self._dropout_flags(self.epoch, len(epoch_indices))
+        self.epoch += 1
+
+        #resume: skip batches already trained
+        self.iter_start_batch = self.resume_num_batches
+        self.resume_num_batches = 0
+
+        batches = (list(zip(epoch_indices[batch_starts[i]:batch_starts[i + 1]].tolist(), dropout_flags[batch_starts[i]:batch_starts[i + 1]].tolist())) for i in range(self.iter_start_batch, len(batch_starts) - 1))
+        if self.readahead is None:
+            yield from batches
+            return
+
+        #read-ahead: the service gets the epoch's remaining batches, requests the upcoming ones at every yield
+        batches = list(batches)
+        self.readahead.start(batches)
+        for position, batch in enumerate(batches):
+            self.readahead.advance(position)
+            yield batch
+
+    #num_batches_consumed: None = epoch boundary, resume starts the next epoch
+        #else batches of the current __iter__ already trained, summed over all ranks
+    def state_dict(self, num_batches_consumed=None):
+        if num_batches_consumed is None or self.iter_epoch is None:
+            state_dict = {
+                "seed": self.seed,
+                "epoch": self.epoch,
+                "leftover_items": list(self.leftover_items),
+                "num_batches_consumed": 0,
+            }
+        else:
+            state_dict = {
+                "seed": self.seed,
+                "epoch": self.iter_epoch,
+                "leftover_items": list(self.iter_leftover_items),
+                "num_batches_consumed": self.iter_start_batch + num_batches_consumed,
+            }
+        json_file_paths = getattr(self.dataset, "json_file_paths", None)
+        if json_file_paths is not None:
+            state_dict["leftover_json_files"] = [json_file_paths[index] for index in state_dict["leftover_items"]]
+        return state_dict
+
+    #next __iter__ rebuilds the saved epoch & continues at the next batch
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict["seed"]
+        self.epoch = state_dict["epoch"]
+        self.leftover_items = list(state_dict["leftover_items"])
+        json_file_paths = getattr(self.dataset, "json_file_paths", None)
+        if json_file_paths is not None and "leftover_json_files" in state_dict:
+            #leftover items by json_file, items no longer in the dataset are dropped
+            index_lookup = {json_file: index for index, json_file in enumerate(json_file_paths)}
+            self.leftover_items = [index_lookup[json_file] for json_file in state_dict["leftover_json_files"] if json_file in index_lookup]
+        self.resume_num_batches = state_dict["num_batches_consumed"]
 
     def __len__(self):
-        #calculates total batches
-        total_batches = sum(len(indices) // self.batch_size for indices in self.bucket_indices.values())
-        #if using leftovers, append leftovers to total batches
+        #calculates total batches of the next epoch, including leftover items
+        counts = self.bucket_counts
+        if self.leftover_items:
+            counts = counts + np.bincount(self.bucket_ids[self.leftover_items], minlength=len(self.buckets))
+        total_batches = int(np.sum(counts // self.batch_size))
+        #if not drop_last, each bucket's last too small batch is yielded
         if not self.drop_last:
-            leftovers = sum(len(indices) % self.batch_size for indices in self.bucket_indices.values())
-            total_batches += bool(leftovers)  #add one more batch if there are leftovers
-        return total_batches
+            total_batches += int(np.count_nonzero(counts % self.batch_size))
+        #if resuming mid-epoch, skipped batches
+        return total_batches - self.resume_num_batches
 
 
 ##input: json_file_list -> output: metadata
 #looks like leftover code from leftover_idx, check, then delete
+#fetch_threads: threads reading a batch's files in parallel (__getitems__), 0 = one item after another
+#ram_cache_gb: size limit of the in-RAM LRU tensor cache per process (each DataLoader worker has its own), 0 = off
+    #cached tensors are returned as is for every hit, don't modify them in place
+#load_prompt_embeds=False: prompt embed files are never read, items carry token_ids_one & token_ids_two from metadata
+    #for --encode_text_on_the_fly, the training step text encodes them, see encode_caption_token_ids
 class CachedImageDataset(Dataset):
-    def __init__(self, json_file_paths_list, conditional_dropout_percent=0.1): 
+    def __init__(self, json_file_paths_list, conditional_dropout_percent=0.1, metadata_lookup=None, fetch_threads=8, ram_cache_gb=0, load_prompt_embeds=True): 
         self.json_file_paths = json_file_paths_list
+        self.load_prompt_embeds = load_prompt_embeds
+        self.metadata_lookup = metadata_lookup
+        self.fetch_threads = fetch_threads
+        self.ram_cache = TensorLRUCache(ram_cache_gb * 1024 ** 3) if ram_cache_gb > 0 else None
+        self._fetch_executor = None #created lazily per process, thread pools aren't pickled or forked
+        self._fetch_executor_pid = None #forked DataLoader workers inherit the executor but not its threads
         #for conditional_dropout
         self.conditional_dropout_percent = conditional_dropout_percent
-        self.empty_prompt_embed = joblib.load("empty.prompt_embed.pkl")  # Tuple of (empty_prompt_embed, empty_pooled_prompt_embed)
-        self.empty_pooled_prompt_embed = joblib.load("empty.pooled_prompt_embed.pkl")
+        #cpu: cuda tensors can't be shared with DataLoader workers
+        self.empty_prompt_embed = load_tensor("empty.prompt_embed.pkl", map_location="cpu")  # Tuple of (empty_prompt_embed, empty_pooled_prompt_embed)
+        self.empty_pooled_prompt_embed = load_tensor("empty.pooled_prompt_embed.pkl", map_location="cpu")
 
     #returns dataset length
     def __len__(self):
         return len(self.json_file_paths)
 
+    #each DataLoader worker creates its own fetch thread pool
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_fetch_executor"] = None
+        return state
+
     def get_closest_bucket(self, index):
         # Retrieve the closest_bucket for a given index
-        json_file_path = self.json_file_paths[index]
-        with open(json_file_path, "r") as f:
-            metadata = json.load(f)
-        return metadata["closest_bucket"]
+        return self._load_metadata(index)["closest_bucket"]
 
 
-    #returns dataset item, using index
-    def __getitem__(self, index):
+    #reads item metadata, overridden by packed dataset formats
+    def _load_metadata(self, index):
         json_file_path = self.json_file_paths[index] 
+        if self.metadata_lookup is not None and json_file_path in self.metadata_lookup:
+            return self.metadata_lookup[json_file_path]
         with open(json_file_path, "r") as f: 
             metadata = json.load(f)
+        return metadata
+
+    #loads cached tensors: model_input, prompt_embed, pooled_prompt_embed
+    #overridden by packed dataset formats
+    #storage_codec: see sdxl_codec_functions, decoded to the dtype the tensors were encoded in
+    #raw .pkl tensors were saved on the caching gpu, loaded to cpu, DataLoader moves batches to device
+    #load_embeds=False: conditional dropout item, prompt embed files aren't read, returned as None
+    def _load_cached_tensors(self, index, metadata, load_embeds=True):
+        storage_codec = metadata.get("storage_codec") or "raw"
+        model_input = load_tensor(metadata["model_input_file"], storage_codec, map_location="cpu")
+        if not load_embeds:
+            return model_input, None, None
+        prompt_embed = load_tensor(metadata["prompt_embed_file"], storage_codec, map_location="cpu")
+        pooled_prompt_embed = load_tensor(metadata["pooled_prompt_embed_file"], storage_codec, map_location="cpu")
+        return model_input, prompt_embed, pooled_prompt_embed
 
-        #cached files
-        model_input = joblib.load(metadata["model_input_file"])
-        prompt_embed = joblib.load(metadata["prompt_embed_file"])
-        pooled_prompt_embed = joblib.load(metadata["pooled_prompt_embed_file"])
+    #returns dataset item, using index
+    #index: (index, dropped) from BucketBatchSampler, or int: dropout drawn with python random
+    def __getitem__(self, index):
+        if isinstance(index, (tuple, list)):
+            index, dropped = index
+        else:
+            dropped = random.random() < self.conditional_dropout_percent
+        metadata = self._load_metadata(index)
+
+        #cached files, ram cache first if enabled
+        #dropped items only read model_input, not put in the ram cache (incomplete)
+        load_embeds = self.load_prompt_embeds and not dropped
+        tensors = None
+        if self.ram_cache is not None:
+            tensors = self.ram_cache.get(index)
+            ram_cache_hit = tensors is not None
+        if tensors is None:
+            tensors = self._load_cached_tensors(index, metadata, load_embeds=load_embeds)
+            if self.ram_cache is not None and load_embeds == self.load_prompt_embeds:
+                self.ram_cache.put(index, tensors)
+        model_input, prompt_embed, pooled_prompt_embed = tensors
 
         #conditional_dropout
-        if random.random() < self.conditional_dropout_percent:
+        #empty embeds here only give shape & dtype to cached_batch_collate, their rows are filled on device
+        if dropped:
             prompt_embed = self.empty_prompt_embed
             pooled_prompt_embed = self.empty_pooled_prompt_embed
 
         #TO-DO, check items for error before returning
             #can't load, hash mismatch, etc
 
-        return {
+        item = {
             #cached files
             "model_input": model_input,
-            "prompt_embed": prompt_embed,
-            "pooled_prompt_embed": pooled_prompt_embed,
+            "conditional_dropout": dropped,
             #information from metadata
             "add_time_id": metadata["add_time_id"],
             "category_key": metadata["category_key"],
@@ -158,11 +333,111 @@ class CachedImageDataset(Dataset):
             "original_image_size": metadata["original_image_size"],
             "cropped_image_size": metadata["cropped_image_size"],
         }
+        #prompt embeds, or token ids to text encode in the training step
+        if self.load_prompt_embeds:
+            item["prompt_embed"] = prompt_embed
+            item["pooled_prompt_embed"] = pooled_prompt_embed
+        else:
+            item["token_ids_one"] = metadata["token_ids_one"]
+            item["token_ids_two"] = metadata["token_ids_two"]
+        #only with ram cache, counted by cached_batch_collate
+        if self.ram_cache is not None:
+            item["ram_cache_hit"] = ram_cache_hit
+        return item
+
+    #file ranges an item's fetch will read, for ReadAheadService: [(path, offset, length)], length 0 = whole file
+    #overridden by packed dataset formats
+    #items in the ram cache are skipped, dropped items only need their model_input file
+    def _readahead_ranges(self, index, dropped):
+        if self.ram_cache is not None and index in self.ram_cache:
+            return []
+        metadata = self._load_metadata(index)
+        names = ["model_input"] + (cached_batch_embed_names if self.load_prompt_embeds and not dropped else [])
+        return [(metadata[f"{name}_file"], 0, 0) for name in names]
+
+    #batch fetch, used by DataLoader instead of one __getitem__ per index
+    #items are read in parallel: file reads & unpickling release the GIL
+    #fetch_seconds: time to fetch the whole batch, added to every item, logged by sdxl_train
+    def __getitems__(self, indices):
+        start_time = time.perf_counter()
+        if self.fetch_threads > 1 and len(indices) > 1:
+            if self._fetch_executor is None or self._fetch_executor_pid != os.getpid():
+                self._fetch_executor = ThreadPoolExecutor(max_workers=self.fetch_threads)
+                self._fetch_executor_pid = os.getpid()
+            items = list(self._fetch_executor.map(self.__getitem__, indices))
+        else:
+            items = [self.__getitem__(index) for index in indices]
+        fetch_seconds = time.perf_counter() - start_time
+        for item in items:
+            item["fetch_seconds"] = fetch_seconds
+        return items
+
+
+#collate_fn for CachedImageDataset items, replaces default collate
+#tensors are copied into one preallocated contiguous buffer per key, dtype promoted across items (dropout embeds may differ)
+#add_time_id: [bsz, 6] long, one row per sample (default collate gave 6 per-field tensors)
+#metadata not used by the training step (category_key, closest_bucket, image sizes) is dropped
+#fetch_seconds: batch fetch time from CachedImageDataset.__getitems__, 0.0 if items were fetched one by one
+#ram_cache_hits & ram_cache_misses: items of the batch read from / not found in the dataset's ram cache
+#conditional_dropout_mask: [bsz] bool, dropped rows of prompt_embed & pooled_prompt_embed are zeros
+    #apply_conditional_dropout fills them with the empty prompt embeds on device
+#token_ids_one & token_ids_two: [bsz, 77] long, instead of prompt embeds for load_prompt_embeds=False datasets
+#pin_memory: allocate buffers pinned, only with num_workers = 0, workers leave pinning to DataLoader(pin_memory=True)
+    #use functools.partial(cached_batch_collate, pin_memory=True), picklable for workers
+cached_batch_tensor_names = ["model_input", "prompt_embed", "pooled_prompt_embed"]
+cached_batch_embed_names = ["prompt_embed", "pooled_prompt_embed"]
+def cached_batch_collate(items, pin_memory=False):
+    batch = {}
+    dropped = [item.get("conditional_dropout", False) for item in items]
+    for name in cached_batch_tensor_names:
+        if name not in items[0]:
+            continue
+        tensors = [item[name] for item in items]
+        dtype = tensors[0].dtype
+        for tensor in tensors[1:]:
+            dtype = torch.promote_types(dtype, tensor.dtype)
+        buffer = torch.empty((len(tensors), *tensors[0].shape), dtype=dtype, pin_memory=pin_memory)
+        for i, tensor in enumerate(tensors):
+            if dropped[i] and name in cached_batch_embed_names:
+                buffer[i].zero_()
+            else:
+                buffer[i].copy_(tensor)
+        batch[name] = buffer
+    batch["add_time_id"] = torch.tensor([item["add_time_id"] for item in items], dtype=torch.long)
+    batch["conditional_dropout_mask"] = torch.tensor(dropped, dtype=torch.bool)
+    for name in ["token_ids_one", "token_ids_two"]:
+        if name in items[0]:
+            batch[name] = torch.tensor([item[name] for item in items], dtype=torch.long)
+    if pin_memory:
+        for name in ["add_time_id", "conditional_dropout_mask", "token_ids_one", "token_ids_two"]:
+            if name in batch:
+                batch[name] = batch[name].pin_memory()
+    batch["fetch_seconds"] = items[0].get("fetch_seconds", 0.0)
+    batch["ram_cache_hits"] = sum(1 for item in items if item.get("ram_cache_hit") is True)
+    batch["ram_cache_misses"] = sum(1 for item in items if item.get("ram_cache_hit") is False)
+    return batch
+
+
+#fills the dropped rows of a cached_batch_collate batch with the empty prompt embeds, in place of the batch dict
+#empty_prompt_embed & empty_pooled_prompt_embed: unbatched, kept on the training device, loaded once
+#torch.where with the mask: no host sync, same values as the per item copy the dataset used to make
+def apply_conditional_dropout(batch, empty_prompt_embed, empty_pooled_prompt_embed):
+    dropout_mask = batch.get("conditional_dropout_mask")
+    if dropout_mask is None:
+        return batch
+    for name, empty_embed in zip(cached_batch_embed_names, [empty_prompt_embed, empty_pooled_prompt_embed]):
+        embeds = batch[name]
+        mask = dropout_mask.view(-1, *([1] * (embeds.dim() - 1)))
+        batch[name] = torch.where(mask, empty_embed.to(embeds.dtype), embeds)
+    return batch
 
 
 #search for image-caption.txt pairs the directory and subdirectories
 #input: data_dir output: image_files & caption_files (lists)
-def data_dir_search(data_dir):
+#num_workers: threads for directory listing & image header probing
+#full_decode: also decode every image, catches truncated/corrupt files, slower
+#scan_cache_file: persistent scan results, unchanged directories are not re-listed or re-probed, see sdxl_scan_functions
+def data_dir_search(data_dir, num_workers=16, full_decode=False, scan_cache_file=None):
 
     #convert to absolute data_dir
     if os.path.isabs(data_dir):
@@ -175,112 +450,51 @@ def data_dir_search(data_dir):
     
     #begin
     image_ext = ['.png', '.jpg', '.jpeg', ".bmp", ".webp", ".tif"]
-    image_caption_files_tuple_list = []
-    count = 0
 
     print("\nbegin data_search")
     print("  note:")
-    print("    --If image file or caption.txt has error: image-caption.txt pair will be skipped")
+    print("    --If image file has error: image-caption.txt pair will be skipped")
     print("    --If image file OK & no caption.txt: caption = \"\" [empty_caption]")
     print("    --Check error_log.txt for details")
     print(f"data_dir: {data_dir}")
     print("...")
-        
-    for root, dirs, files in os.walk(data_dir):
-        for file in files:
-            if os.path.splitext(file)[1].lower() in image_ext: #check if supported image file
-                
-                #process image
-                image_file = os.path.join(root, file) #construct full image file path
-                #test Image.open image file                
-                try:
-                    check_image = Image.open(image_file)
-                except Exception as e:
-                    error_message = f"Error: {e}, for {image_file}"
-                    print(error_message)
-                    logging.error(error_message)
-                    continue
-                
-                #process caption
-                caption_file = os.path.splitext(image_file)[0] + ".txt" #check for matching txt file
-                #test open.read caption.txt
-                if os.path.exists(caption_file):
-                    try:
-                        caption_file = os.path.splitext(image_file)[0] + ".txt" #check for matching txt file
-                        with open(caption_file, "r") as f:
-                            caption_string = f.read().strip() #test read file
-                    except Exception as e:
-                        error_message = f"Error reading {caption_file}: {e}"
-                        print(error_message)
-                        logging.error(error_message)
-                        continue
-                else:
-                    #dummy caption_file & caption_string
-                    caption_string = ""
-                    with open(caption_file, "w") as f:
-                        pass
-                    
-                    #error message
-                    error_message = f"No caption.txt for {image_file}"
-                    print(f"created blank: {caption_file}, caption_string = \"\" [empty]")
-                    print(error_message)
-                    logging.error(error_message)
-                
-                #append tuple
-                pair = (image_file, caption_file)
-                image_caption_files_tuple_list.append(pair)
 
-                #finish
-                count += 1
-                #running print of processing current file
-                print(f"\r[{count}]: {file[:30]}... : {caption_string[:30]}...", end='')
+    image_caption_files_tuple_list = scan_data_dir(data_dir, image_ext, num_workers, full_decode, scan_cache_file)
 
     #check if num_images = num_captions
-    print("\ndata_search complete")
+    print("data_search complete")
     print(f"{len(image_caption_files_tuple_list)} image-caption pairs found")
-    gc.collect()
     return image_caption_files_tuple_list
 
 
 ##aspect categories for bucketing images
 #current width/height ratios: 2:1 to 1:2. example for 1024: [704, 1408] to [1408, 704]
-aspect_categories = {
-    256: [[256, 256], [192, 320], [320, 192], [192, 256], [256, 192]],
-    320: [[320, 320], [256, 384], [384, 256], [320, 256], [256, 320], [384, 192], [192, 384]],
-    384: [[384, 384], [320, 448], [448, 320], [256, 512], [512, 256], [384, 320], [320, 384], [256, 448], [448, 256]],
-    448: [[448, 448], [384, 512], [512, 384], [320, 576], [576, 320], [448, 384], [384, 448], [320, 512], [512, 320]],
-    512: [[512, 512], [448, 576], [576, 448], [640, 384], [384, 640], [512, 448], [448, 512], [384, 576], [576, 384], [640, 320], [320, 640]],
-    576: [[576, 576], [512, 640], [640, 512], [448, 704], [704, 448], [576, 512], [512, 576], [384, 768], [768, 384], [640, 448], [448, 640], [384, 704], [704, 384]],
-    640: [[640, 640], [704, 576], [576, 704], [896, 448], [448, 896], [512, 768], [768, 512], [832, 448], [448, 832], [576, 640], [640, 576], [704, 512], [512, 704], [448, 768], [768, 448]],
-    704: [[704, 704], [960, 512], [768, 640], [640, 768], [512, 960], [832, 576], [576, 832], [896, 512], [512, 896], [704, 640], [640, 704], [768, 576], [576, 768], [832, 512], [512, 832]],
-    768: [[768, 768], [1024, 576], [576, 1024], [704, 832], [832, 704], [896, 640], [640, 896], [960, 576], [576, 960], [768, 704], [704, 768], [832, 640], [640, 832], [1024, 512], [512, 1024], [896, 576], [576, 896]],
-    832: [[832, 832], [768, 896], [896, 768], [960, 704], [704, 960], [1152, 576], [576, 1152], [1024, 640], [640, 1024], [768, 832], [832, 768], [896, 704], [704, 896], [1088, 576], [576, 1088], [960, 640], [640, 960]],
-    896: [[896, 896], [960, 832], [832, 960], [768, 1024], [1024, 768], [640, 1216], [1216, 640], [704, 1088], [1088, 704], [896, 832], [832, 896], [768, 960], [640, 1152], [1152, 640], [960, 768], [704, 1024], [1024, 704], [640, 1088], [1088, 640]],
-    960: [[960, 960], [1024, 896], [896, 1024], [832, 1088], [1088, 832], [704, 1280], [1280, 704], [768, 1152], [1152, 768], [960, 896], [896, 960], [704, 1216], [1216, 704], [832, 1024], [1024, 832], [768, 1088], [1088, 768], [640, 1280], [1280, 640], [704, 1152], [1152, 704]],
-    1024: [[1024, 1024], [1088, 960], [960, 1088], [768, 1344], [1344, 768], [1152, 896], [896, 1152], [832, 1216], [1216, 832], [1408, 704], [704, 1408], [768, 1280], [1280, 768], [1024, 960], [960, 1024], [896, 1088], [1088, 896], [832, 1152], [1152, 832], [704, 1344], [1344, 704], [768, 1216], [1216, 768]],
-    1088: [[1088, 1088], [1536, 768], [768, 1536], [1152, 1024], [1024, 1152], [832, 1408], [1408, 832], [1216, 960], [960, 1216], [896, 1280], [1280, 896], [1472, 768], [768, 1472], [832, 1344], [1344, 832], [1088, 1024], [1024, 1088], [1152, 960], [960, 1152], [896, 1216], [1216, 896], [1408, 768], [768, 1408], [832, 1280], [1280, 832]],
-    1152: [[1152, 1152], [1216, 1088], [1088, 1216], [896, 1472], [1472, 896], [1280, 1024], [1024, 1280], [960, 1344], [1344, 960], [1536, 832], [832, 1536], [896, 1408], [1408, 896], [1152, 1088], [1088, 1152], [1216, 1024], [1024, 1216], [960, 1280], [1280, 960], [832, 1472], [1472, 832], [896, 1344], [1344, 896]],
-    1216: [[1216, 1216], [960, 1536], [1536, 960], [1280, 1152], [1152, 1280], [1344, 1088], [1088, 1344], [1408, 1024], [1024, 1408], [1600, 896], [896, 1600], [960, 1472], [1472, 960], [1216, 1152], [1152, 1216], [1280, 1088], [1088, 1280], [1664, 832], [832, 1664], [896, 1536], [1536, 896], [1344, 1024], [1024, 1344], [960, 1408], [1408, 960], [1600, 832], [832, 1600]],
-    1280: [[1600, 1024], [1280, 1280], [1024, 1600], [1344, 1216], [1216, 1344], [1408, 1152], [1152, 1408], [1792, 896], [896, 1792], [1472, 1088], [1088, 1472], [1664, 960], [960, 1664], [1536, 1024], [1024, 1536], [1280, 1216], [1216, 1280], [1728, 896], [896, 1728], [1344, 1152], [1152, 1344], [960, 1600], [1600, 960], [1408, 1088], [1088, 1408], [1472, 1024], [1024, 1472], [1664, 896], [896, 1664]],
-    1344: [[1344, 1344], [1408, 1280], [1280, 1408], [1472, 1216], [1216, 1472], [960, 1856], [1856, 960], [1024, 1728], [1728, 1024], [1536, 1152], [1152, 1536], [1600, 1088], [1088, 1600], [1792, 960], [960, 1792], [1344, 1280], [1280, 1344], [1408, 1216], [1216, 1408], [1664, 1024], [1024, 1664], [1472, 1152], [1152, 1472], [1536, 1088], [1088, 1536], [1728, 960], [960, 1728]],
-    1408: [[1408, 1408], [1472, 1344], [1344, 1472], [1024, 1920], [1536, 1280], [1280, 1536], [1920, 1024], [1088, 1792], [1792, 1088], [1600, 1216], [1216, 1600], [1664, 1152], [1152, 1664], [1024, 1856], [1856, 1024], [1408, 1344], [1344, 1408], [1472, 1280], [1280, 1472], [1728, 1088], [1088, 1728], [1536, 1216], [1216, 1536], [1600, 1152], [960, 1920], [1920, 960], [1152, 1600], [1024, 1792], [1792, 1024], [1664, 1088], [1088, 1664]],
-    1472: [[1472, 1472], [1536, 1408], [1408, 1536], [1088, 1984], [1984, 1088], [1600, 1344], [1344, 1600], [1856, 1152], [1152, 1856], [1664, 1280], [1280, 1664], [1728, 1216], [1216, 1728], [1024, 2048], [2048, 1024], [1088, 1920], [1920, 1088], [1472, 1408], [1408, 1472], [1792, 1152], [1536, 1344], [1344, 1536], [1152, 1792], [1600, 1280], [1280, 1600], [1024, 1984], [1984, 1024], [1664, 1216], [1216, 1664], [1088, 1856], [1856, 1088], [1728, 1152], [1152, 1728]],
-    1536: [[1152, 2048], [1536, 1536], [2048, 1152], [1600, 1472], [1472, 1600], [1664, 1408], [1408, 1664], [1216, 1920], [1920, 1216], [1728, 1344], [1344, 1728], [1088, 2112], [2112, 1088], [1792, 1280], [1280, 1792], [1984, 1152], [1152, 1984], [1536, 1472], [1472, 1536], [1216, 1856], [1856, 1216], [1600, 1408], [1408, 1600], [1664, 1344], [1344, 1664], [1088, 2048], [2048, 1088], [1728, 1280], [1280, 1728], [1920, 1152], [1152, 1920], [1792, 1216], [1216, 1792]],
-    1600: [[1600, 1600], [1664, 1536], [1536, 1664], [1728, 1472], [1472, 1728], [1280, 1984], [1984, 1280], [1792, 1408], [1408, 1792], [1152, 2176], [2176, 1152], [1344, 1856], [1856, 1344], [2048, 1216], [1216, 2048], [1600, 1536], [1536, 1600], [1280, 1920], [1920, 1280], [1664, 1472], [1472, 1664], [1152, 2112], [1728, 1408], [1408, 1728], [2112, 1152], [1216, 1984], [1984, 1216], [1792, 1344], [1344, 1792], [1280, 1856], [1856, 1280], [1088, 2176], [2176, 1088]],
-    1664: [[1664, 1664], [1728, 1600], [1600, 1728], [1792, 1536], [1536, 1792], [2048, 1344], [1344, 2048], [1856, 1472], [1472, 1856], [2240, 1216], [1216, 2240], [1408, 1920], [2112, 1280], [1280, 2112], [1920, 1408], [1344, 1984], [1984, 1344], [1664, 1600], [1600, 1664], [1152, 2304], [1728, 1536], [2304, 1152], [1536, 1728], [2176, 1216], [1216, 2176], [1792, 1472], [1472, 1792], [2048, 1280], [1280, 2048], [1408, 1856], [1856, 1408], [1152, 2240], [2240, 1152], [1344, 1920], [1920, 1344], [2112, 1216], [1216, 2112]],
-    1728: [[1728, 1728], [1792, 1664], [1664, 1792], [1408, 2112], [2112, 1408], [1856, 1600], [1600, 1856], [2432, 1216], [1216, 2432], [1920, 1536], [2304, 1280], [1536, 1920], [1280, 2304], [2176, 1344], [1344, 2176], [1472, 1984], [1984, 1472], [1408, 2048], [2048, 1408], [2368, 1216], [1216, 2368], [1728, 1664], [1664, 1728], [1792, 1600], [1600, 1792], [2240, 1280], [1280, 2240], [1856, 1536], [1536, 1856], [2112, 1344], [1344, 2112], [1472, 1920], [1920, 1472], [2304, 1216], [1216, 2304], [1408, 1984], [1984, 1408], [2176, 1280], [1280, 2176]],
-    1792: [[1792, 1792], [1856, 1728], [1728, 1856], [1472, 2176], [2176, 1472], [1920, 1664], [2496, 1280], [1664, 1920], [1280, 2496], [2368, 1344], [1344, 2368], [1984, 1600], [1600, 1984], [2240, 1408], [1408, 2240], [1536, 2048], [2048, 1536], [2432, 1280], [1280, 2432], [1472, 2112], [2112, 1472], [1792, 1728], [1728, 1792], [2304, 1344], [1344, 2304], [1856, 1664], [1664, 1856], [1920, 1600], [1600, 1920], [1408, 2176], [2176, 1408], [1536, 1984], [1984, 1536], [2368, 1280], [1280, 2368], [1472, 2048], [2048, 1472], [2240, 1344], [1344, 2240]],
-    1856: [[1856, 1856], [1920, 1792], [2560, 1344], [1792, 1920], [2240, 1536], [1536, 2240], [1344, 2560], [1984, 1728], [1728, 1984], [2432, 1408], [1408, 2432], [1664, 2048], [2048, 1664], [2304, 1472], [1472, 2304], [1600, 2112], [2112, 1600], [2496, 1344], [1344, 2496], [1536, 2176], [2176, 1536], [2368, 1408], [1408, 2368], [1856, 1792], [1792, 1856], [1920, 1728], [1728, 1920], [1984, 1664], [1664, 1984], [2240, 1472], [1472, 2240], [1280, 2560], [2560, 1280], [1600, 2048], [2048, 1600], [2432, 1344], [1344, 2432], [2304, 1408], [1536, 2112], [1408, 2304], [2112, 1536]],
-    1920: [[1920, 1920], [2304, 1600], [1600, 2304], [1984, 1856], [1856, 1984], [2496, 1472], [1472, 2496], [1792, 2048], [2048, 1792], [1728, 2112], [2112, 1728], [2368, 1536], [1536, 2368], [1664, 2176], [2176, 1664], [2688, 1344], [1344, 2688], [2560, 1408], [1408, 2560], [2240, 1600], [1600, 2240], [2432, 1472], [1472, 2432], [1920, 1856], [1856, 1920], [1984, 1792], [1792, 1984], [1728, 2048], [2304, 1536], [1536, 2304], [2048, 1728], [2624, 1344], [1344, 2624], [2496, 1408], [1664, 2112], [1408, 2496], [2112, 1664], [2368, 1472], [1472, 2368], [1600, 2176], [2176, 1600]],
-    1984: [[1984, 1984], [1920, 2048], [2560, 1536], [1536, 2560], [2048, 1920], [1856, 2112], [2112, 1856], [1792, 2176], [2176, 1792], [2432, 1600], [1600, 2432], [1408, 2752], [2752, 1408], [1728, 2240], [2240, 1728], [2624, 1472], [1472, 2624], [2496, 1536], [1664, 2304], [2304, 1664], [1536, 2496], [1984, 1920], [1920, 1984], [1856, 2048], [2048, 1856], [2368, 1600], [1600, 2368], [1792, 2112], [1408, 2688], [2112, 1792], [2688, 1408], [2560, 1472], [1472, 2560], [1728, 2176], [2176, 1728], [2432, 1536], [1536, 2432], [1664, 2240], [2240, 1664], [1408, 2624], [2624, 1408]],
-    2048: [[2048, 2048], [1984, 2112], [2112, 1984], [1920, 2176], [2176, 1920], [1856, 2240], [2240, 1856], [2496, 1664], [1664, 2496], [2816, 1472], [1472, 2816], [2688, 1536], [1792, 2304], [2304, 1792], [1536, 2688], [2560, 1600], [1600, 2560], [1728, 2368], [2368, 1728], [1984, 2048], [2048, 1984], [1920, 2112], [2112, 1920], [2752, 1472], [1472, 2752], [2432, 1664], [1664, 2432], [1856, 2176], [2176, 1856], [2624, 1536], [1536, 2624], [1792, 2240], [2240, 1792], [2496, 1600], [1600, 2496], [1728, 2304], [2304, 1728], [2816, 1408], [1408, 2816], [1472, 2688], [2688, 1472], [2368, 1664], [1664, 2368]],
-}
+#generated at runtime & cached, see sdxl_bucket_functions
+aspect_categories = create_aspect_categories(256, 2048, 64, 2.0)
+bucket_engine = get_bucket_engine(256, 2048, 64, 2.0)
 
 
 ##preprocess images/caption, cache latents/hidden_encoder_states
 #input:image_caption_pair_file tuple list
     #hashes & caches files & saves json list to disk
 #returns list of json filepaths
+#vae_batch_size: images in the same closest_bucket are vae encoded together, in batches of vae_batch_size
+#caption_batch_size: captions are tokenized & text encoded together, in batches of caption_batch_size
+#use_fast_tokenizer: use CLIPTokenizerFast if available, same token ids as CLIPTokenizer
+#json_list_file: .list file to write, default: cache_dir/basename/data_dir.list
+#dedup_captions: prompt_embed & pooled_prompt_embed stored once per unique caption, see sdxl_caption_embed_functions
+#storage_codec: on-disk format of cached tensors, recorded in .metadata.json, see sdxl_codec_functions
+    #applies to newly cached items, re-encoded components keep their item's storage_codec
+#token ids of both tokenizers are always recorded in .metadata.json: token_ids_one & token_ids_two, 77 ints each
+#cache_prompt_embeds=False: token ids only, no prompt_embed & pooled_prompt_embed files, text encoders not loaded
+    #prompt_embed_file & pooled_prompt_embed_file are None, embeds are computed by sdxl_train --encode_text_on_the_fly
+    #already cached items without token ids are tokenized, their caption embed files are no longer referenced
+    #cache_prompt_embeds=True: token ids only items get their caption embeds encoded
+#num_preprocess_workers: 0 = serial, else staged pipeline, results match the serial path:
+    #preprocess: process pool opens, converts, resizes & crops images, upscaling stays on this process's gpu
+        #results are consumed in order, at most preprocess_queue_size images in flight (backpressure)
+    #encode: this process, batched caption & vae encoding
+    #write: CacheFileWriter thread, at most write_queue_size queued files (backpressure)
 def cache_image_caption_pair(
         image_caption_files_tuple_list,
         pretrained_model_name_or_path,
@@ -294,8 +508,20 @@ def cache_image_caption_pair(
         min_resolution,
         upscale_to_resolution,
         upscale_use_GFPGAN,
-        save_upscale_samples
+        save_upscale_samples,
+        vae_batch_size=1,
+        caption_batch_size=1,
+        use_fast_tokenizer=True,
+        num_preprocess_workers=0,
+        preprocess_queue_size=None,
+        write_queue_size=64,
+        json_list_file=None,
+        dedup_captions=True,
+        storage_codec="raw",
+        cache_prompt_embeds=True
     ):
+    parse_storage_codec(storage_codec) #unknown codecs fail before any caching
+
 
     #absolute data_dir
     if os.path.isabs(data_dir):
@@ -319,6 +545,10 @@ def cache_image_caption_pair(
 
     os.makedirs(cache_dir, exist_ok=True)
 
+    #catalog & manifest, written incrementally as items are cached
+    catalog = CachedDatasetCatalog(os.path.join(cache_dir, catalog_filename), commit_every=catalog_commit_every)
+    manifest = CacheManifest(os.path.join(cache_dir, manifest_filename))
+
     #welcome message
     print("initiating cache_image_caption_pair function")
     print(f"  cache_dir: {cache_dir}")
@@ -332,6 +562,18 @@ def cache_image_caption_pair(
 
         #variables
         json_file_paths_list = []
+        stage_counters = new_stage_counters()
+        start_time = time.perf_counter()
+
+        #preprocess process pool
+            #fork: workers are started by the first submit, before models are loaded to the gpu
+        preprocess_executor = None
+        if num_preprocess_workers > 0:
+            preprocess_executor = ProcessPoolExecutor(max_workers=num_preprocess_workers, mp_context=multiprocessing.get_context("fork"))
+            preprocess_executor.submit(int).result()
+            if preprocess_queue_size is None:
+                preprocess_queue_size = num_preprocess_workers * 4
+        writer = CacheFileWriter(stage_counters, use_thread=num_preprocess_workers > 0, max_queue_size=write_queue_size)
 
         #load individual components (not pipeline)
         #vae
@@ -339,27 +581,38 @@ def cache_image_caption_pair(
             pretrained_vae_model_name_or_path
         )
         vae.to(device)
-        #tokenizers & text_encoders
-        tokenizer_one = CLIPTokenizer.from_pretrained(
-            pretrained_model_name_or_path, subfolder="tokenizer"
-        )
-        tokenizer_two = CLIPTokenizer.from_pretrained(
-            pretrained_model_name_or_path, subfolder="tokenizer_2"
-        )
-        text_encoder_cls_one = CLIPTextModel.from_pretrained(
-            pretrained_model_name_or_path, subfolder="text_encoder"
-        )
-        text_encoder_cls_two = CLIPTextModelWithProjection.from_pretrained(
-            pretrained_model_name_or_path, subfolder="text_encoder_2"
-        )
-        text_encoder_cls_one.to(device)
-        text_encoder_cls_two.to(device)
+        #tokenizers & text_encoders, text_encoders only if prompt embeds are cached
+        tokenizer_one, tokenizer_two = load_clip_tokenizers(pretrained_model_name_or_path, use_fast_tokenizer)
+        text_encoder_cls_one, text_encoder_cls_two = None, None
+        if cache_prompt_embeds:
+            text_encoder_cls_one = CLIPTextModel.from_pretrained(
+                pretrained_model_name_or_path, subfolder="text_encoder"
+            )
+            text_encoder_cls_two = CLIPTextModelWithProjection.from_pretrained(
+                pretrained_model_name_or_path, subfolder="text_encoder_2"
+            )
+            text_encoder_cls_one.to(device)
+            text_encoder_cls_two.to(device)
+        caption_embed_store = None
+        if dedup_captions and cache_prompt_embeds:
+            caption_embed_store = CaptionEmbedStore(
+                os.path.join(cache_dir, caption_embeds_dirname),
+                text_encoder_identity(pretrained_model_name_or_path, text_encoder_cls_one, text_encoder_cls_two)
+            )
+
+        #items waiting for batched caption encoding: [(pixel_values, metadata, json_file_path, model_input_file)]
+        pending_captions = []
+        #items waiting for batched vae encoding: {closest_bucket: [(pixel_values, metadata, json_file_path, model_input_file)]}
+        pending_images = {}
 
         #initiate
         count = 0
         print("\nbegin cache_image_caption_pair")
         print(f"  --{len(image_caption_files_tuple_list)} image-caption.txt files")
         print("...")
+        #find image-caption.txt pairs to cache
+        to_cache_list = [] #[(i, image_file, caption_file, json_file_path, model_input_file, prompt_embed_file, pooled_prompt_embed_file, image_only)]
+        caption_only_list = [] #json_file paths: only caption changed, latent kept
         for i in range(len(image_caption_files_tuple_list)):
 
             #image & caption paths & relative paths
@@ -367,238 +620,110 @@ def cache_image_caption_pair(
             image_file_split = image_file.split(basename, 1)[1].lstrip('/')
             image_file_cache_path = os.path.join(cache_dir, image_file_split)
             caption_file = image_caption_files_tuple_list[i][1]
-            caption_file_split = caption_file.split(basename, 1)[1].lstrip('/')
-            caption_file_cache_path = os.path.join(cache_dir, caption_file_split)
-            print(f"\nprocessing [{i}]:\n{image_file}")
 
             #to cache files' paths
             #os.path.join(cache_dir, data_dir_basename, f"{relative_file...
             json_file_path = f"{image_file_cache_path}.metadata.json"
             model_input_file = f"{image_file_cache_path}.latent.pkl"
-            prompt_embed_file = f"{caption_file_cache_path}.prompt_embed.pkl"
-            pooled_prompt_embed_file = f"{caption_file_cache_path}.pooled_prompt_embed.pkl"
+            prompt_embed_file, pooled_prompt_embed_file = caption_embed_file_paths(caption_file, cache_dir, basename)
             os.makedirs(os.path.dirname(model_input_file), exist_ok=True)
 
 
             #check if image-caption.txt pair already cached
-            #if failed cached_file_integrity_check, will be re-cached
-            #TO-DO: re-cache based failure message
+            #manifest: size & mtime check per file, content hash only if those changed
+            #not in manifest (cached before the manifest existed): if passes cached_file_integrity_check, added to manifest
+            #else, will be re-cached
+            changed_components = None
             if os.path.exists(json_file_path):
-                if cached_file_integrity_check(json_file_path) == "pass":
-                    json_file_paths_list.append(json_file_path)
-                    count += 1
-                    print(f"  --already cached")
+                changed_components, stat_changed = manifest.changed_components(json_file_path, image_file, caption_file)
+                if changed_components is None and cached_file_integrity_check(json_file_path) == "pass":
+                    changed_components, stat_changed = set(), True
+
+            #unchanged
+            if changed_components == set():
+                metadata = catalog.get(json_file_path)
+                in_catalog = metadata is not None
+                if metadata is None:
+                    with open(json_file_path, "r") as f:
+                        metadata = json.load(f)
+                #caption cached in the other mode: token ids missing, or prompt embeds missing
+                if (not cache_prompt_embeds and metadata.get("token_ids_one") is None) or (cache_prompt_embeds and metadata.get("prompt_embed_file") is None):
+                    caption_only_list.append(json_file_path)
                     continue
-
-
-            ######
-            #begin processing image
-            ######
-
-            #reset upscaled metadata
-            upscaled = False
-
-            #try opening image file
-            try:
-                image = Image.open(image_file)
-            except Exception as e: #failed opening
-                error_message = f"Error: {e}, for {image_file}"
-                print(error_message)
-                logging.error(error_message)
-                continue
-            
-            #hash image_file
-            image_file_hash_value = hashlib.sha256(image_file.encode()).hexdigest()
-
-            #calculate image dimensions & aspect ratio
-            org_image_width, org_image_height = image.size
-            original_aspect_ratio = org_image_width / org_image_height #get original aspect ratio 
-            original_image_size = (org_image_width, org_image_height) #actual original_image_size
-
-            #height & width by 64, image_pixels by 64, aspect ratio by 64
-            image_width_64 = (org_image_width // 64) * 64
-            image_height_64 = (org_image_height // 64) * 64
-            image_pixels_64 = image_width_64 * image_height_64
-            image_pixels_64_sqrt = int(math.sqrt(image_pixels_64))
-
-            #check if image is too small
-            if image_pixels_64 < min_resolution ** 2:
-                print(" --too small")
+                json_file_paths_list.append(json_file_path)
+                #caches created before the catalog or manifest existed, or touched files
+                if not in_catalog:
+                    catalog.add(json_file_path, metadata)
+                if stat_changed:
+                    manifest.add(json_file_path, metadata)
+                count += 1
+                print(f"\nprocessing [{i}]:\n{image_file}")
+                print(f"  --already cached")
                 continue
 
+            #caption changed: re-encode caption only
+            if changed_components == {"caption"}:
+                caption_only_list.append(json_file_path)
+                continue
 
-            #convert image to RGB
+            #image changed: re-encode latent only
+            image_only = changed_components == {"image"}
+            to_cache_list.append((i, image_file, caption_file, json_file_path, model_input_file, prompt_embed_file, pooled_prompt_embed_file, image_only))
+
+        #caption changed: re-encode captions, in batches
+        for batch_start in range(0, len(caption_only_list), caption_batch_size):
+            batch_items = []
+            for json_file_path in caption_only_list[batch_start:batch_start + caption_batch_size]:
+                print(f"\nprocessing: {json_file_path}")
+                print(f"  --caption changed, re-encoding caption")
+                metadata = read_metadata_with_caption(json_file_path)
+                if metadata is not None:
+                    batch_items.append((json_file_path, metadata))
+            if len(batch_items) == 0:
+                continue
+            encode_and_write_caption_batch([item[1] for item in batch_items], tokenizer_one, tokenizer_two, text_encoder_cls_one, text_encoder_cls_two, accelerator, device, writer, stage_counters, caption_embed_store, cache_prompt_embeds)
+            for json_file_path, metadata in batch_items:
+                writer.submit(write_metadata_json, json_file_path, metadata, catalog, manifest)
+                json_file_paths_list.append(json_file_path)
+                count += 1
 
-            #if has transparency check
-            if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
-                if image.mode != 'RGBA':
-                    try:
-                        image = image.convert('RGBA')
-                    except Exception as e:
-                        error_message = f"Error: {e}, for {image_file}"
-                        print(error_message)
-                        logging.error(error_message)
-                        continue
+        #open, convert to RGB, upscale, resize & crop: serial or process pool, in order
+        preprocess_arguments = (
+            sorted_categories_keys,
+            max_resolution,
+            min_resolution,
+            upscale_to_resolution,
+            upscale_use_GFPGAN,
+            save_upscale_samples
+            )
+        preprocessed_images = iterate_preprocessed_images(
+            [item[1] for item in to_cache_list],
+            preprocess_arguments,
+            preprocess_executor,
+            preprocess_queue_size,
+            stage_counters
+            )
 
-                #based on alpha value, merge RGB with white background, convert to RGB
-                white_bg = Image.new('RGBA', image.size, 'WHITE')
-                image = Image.alpha_composite(white_bg, image)
-                try:
-                    image = image.convert('RGB')
-                except Exception as e:
-                    error_message = f"Error: {e}, for {image_file}"
-                    print(error_message)
-                    logging.error(error_message)
-                    continue
+        for (i, image_file, caption_file, json_file_path, model_input_file, prompt_embed_file, pooled_prompt_embed_file, image_only), preprocessed_image in zip(to_cache_list, preprocessed_images):
+            print(f"\nprocessing [{i}]:\n{image_file}")
+            if image_only:
+                print(f"  --image changed, re-encoding latent")
 
-                print(f"  --converted: RGBA/LA/P w/ transparency --> RGB w/ white background")
-
-            #no transparency
-            else:
-                try:
-                    image = image.convert("RGB")
-                except Exception as e:
-                    error_message = f"Error: {e}, for {image_file}"
-                    print(error_message)
-                    logging.error(error_message)
-                    continue
 
+            ######
+            #begin processing image
+            ######
 
-            #upscale & image cropping 
-
-            #if upscale_to_resolution
-            if upscale_to_resolution is not None:
-                #image pixels less than upscale, get category_key,then use category key to verify needs upscale
-                if image_pixels_64 <= upscale_to_resolution ** 2: #if image pixels <= upscaled image pixels
-                    category_key = next((key for key in sorted_categories_keys if key >= image_pixels_64_sqrt), max_resolution) #category_key for image
-                    if category_key < upscale_to_resolution: #image needs upscale
-
-                        #get closest_bucket
-                        category_key = upscale_to_resolution
-                        aspect_ratios = aspect_categories[category_key]
-                        original_aspect_ratio = org_image_width / org_image_height
-                        closest_bucket = min(aspect_ratios, key=lambda x: abs((x[0]/x[1]) - original_aspect_ratio))
-
-                        #calculate upscale_factor
-                        upscale_factor_width = closest_bucket[0] / org_image_width
-                        upscale_factor_height = closest_bucket[1] / org_image_height
-                        upscale_factor = max(upscale_factor_width, upscale_factor_height)
-
-                        #upscale image
-                        print(f"  --upscaling image: {upscale_factor}")
-                        image = Real_ESRGAN(
-                            image,
-                            upscale_factor,
-                            upscale_use_GFPGAN,
-                            image_file,
-                            save_upscale_samples
-                            )
-
-                        #re-calculate_64 for upscaled image
-                        up_image_width, up_image_height = image.size
-                        up_image_width_64 = (up_image_width // 64) * 64
-                        up_image_height_64 = (up_image_height // 64) * 64
-                        image_pixels_64 = up_image_width_64 * up_image_height_64
-                        image_pixels_64_sqrt = int(math.sqrt(image_pixels_64))
-
-                        #upscaled metadata = True
-                        upscaled = True
-
-
-            #find closest bucket
-            #find the largest category that is lower than or equal to image_pixels_64
-            category_key = next((key for key in sorted_categories_keys if key >= image_pixels_64_sqrt), max_resolution)
-            #print(f"category_key1: {category_key}")
-            if category_key is None:
-                #do not process images too small
-                print("  --Error: category_key is None:")
+            if preprocessed_image is None:
                 continue
+            image, image_metadata = preprocessed_image
+            pixel_values = image_to_pixel_values(image) #returns normalized tensor
+            del image
 
-            #aspect ratio process
-            aspect_ratios = aspect_categories[category_key]
-            original_aspect_ratio = org_image_width / org_image_height
-            closest_bucket = min(aspect_ratios, key=lambda x: abs((x[0]/x[1]) - original_aspect_ratio))
-
-            #resize and crop
-            target_width, target_height = closest_bucket #target width based on bucket
-            scaling_factor = min(image.width / target_width, image.height / target_height) #find how to resize
-            new_width = int(image.width / scaling_factor)
-            new_height = int(image.height / scaling_factor)
-            image_resized = image.resize((new_width, new_height), Image.LANCZOS)
-
-            # Calculate cropping coordinates to get the final image
-            x1 = (new_width - target_width) // 2
-            y1 = (new_height - target_height) // 2
-            x2 = x1 + target_width
-            y2 = y1 + target_height
-
-            #crop
-            image_cropped = image_resized.crop((x1, y1, x2, y2))
-            del image_resized
-            crop_top_left = (y1, x1)
-
-            cropped_image_width, cropped_image_height = image_cropped.size
-            target_size = (cropped_image_height, cropped_image_width) #for use with add_ids
-            cropped_image_size = (cropped_image_width, cropped_image_height) #actual cropped_image_size
-            cropped_aspect_ratio = cropped_image_width / cropped_image_height #get original aspect ratio 
-
-            #downscale check #might use later
-            downscaled = False
-            if cropped_image_width * cropped_image_height < image_pixels_64:
-                downscaled = True
-
-            #original_size
-            if upscaled == True:
-                original_size = (image_height_64, image_width_64)
-            else:
-                original_size = (cropped_image_height, cropped_image_width)
-
-            #add_time_id
-            add_time_id = [
-                original_size[0],
-                original_size[1],
-                crop_top_left[0],
-                crop_top_left[1],
-                target_size[0],
-                target_size[1]
-                ]
-
-            #continue with cropped_image as image
-            image = image_cropped
-            del image_cropped
-
-
-            #process image for caching
-
-            #transform image
-            train_transforms = transforms.Compose(
-            [
-            transforms.ToTensor(),
-            transforms.Normalize([0.5], [0.5]),
-            ]
-            )
-            image = train_transforms(image) #returns normalized tensor
-
-            #encode model_input (latent_image)
-            with accelerator.autocast(): #mixed-precision (fp16)
-                pixel_values = image.to(memory_format=torch.contiguous_format).to(device).unsqueeze(0)
-                model_input = vae.encode(pixel_values, return_dict=False)[0].sample() #[0] = remove bsz dimension
-                #return_dict false, only returns tensor, so we sample directly. if return_dict=False, .latent_dist.sample() to access
-            model_input = model_input[0] * vae.config.scaling_factor
-            model_input_shape = model_input.shape
-                #print(f"\nmodel_input: {model_input.shape}") #for 1024 image : torch.Size([4, 128, 128])
-            del image, pixel_values
-
-            #save model_input (latent_image) #model_input_file path created earlier
-            joblib.dump(model_input, model_input_file)
-            del model_input
-
-            #latent_file_hash_value 
+            #model_input (latent_image) is encoded later, batched with images from the same bucket
+            #latent_file_hash_value
             model_input_file_hash_value = hashlib.sha256(model_input_file.encode()).hexdigest()
 
-            gc.collect()
-            torch.cuda.empty_cache()
-
 
             ######
             #finished processing image
@@ -606,171 +731,826 @@ def cache_image_caption_pair(
             ######
 
             #setup & read caption
-            prompt_embeds_list = []
             caption_file_hash_value = hashlib.sha256(caption_file.encode()).hexdigest()
-            with open(caption_file, "r") as f:
-                caption_string = f.read().strip() #test read file
-
-
-            ##tokenizers & text_encoders
-
-            #process prompt_embed_1
-
-            #tokenize caption 1 #done on cpu
-            tokenized_caption_1 = tokenizer_one(
-                caption_string,
-                max_length=tokenizer_one.model_max_length, #num_tokens specified by tokenizer
-                padding="max_length", #pad tokens to meet model_max_length
-                truncation=True, #crop excess tokens to meet model_max_length
-                return_tensors="pt", #returns tensor
-            ).input_ids #returns a dictionary: input_ids & attention_mask; .input_ids = the actual tokens
-
-            #get prompt_embed
-            with accelerator.autocast(): #diffusers code uses mixed precision
-                prompt_embed_1 = text_encoder_cls_one(tokenized_caption_1.to(device), output_hidden_states=True, return_dict=False)
-                    #print(f"prompt_embed_1: {prompt_embed_1}") #returns a tuple of tensors
-
-            #[0] = "pooled" output: intended to capture the essence of the entire input sequence in a fixed-size representation
-            #"We are only ALWAYS interested in the pooled output of the final text encoder"
-            #so pooled_prompt_embed_1 is discarded
-
-            prompt_embed_1 = prompt_embed_1[-1][-2] #clip-skip 2: second-to-last layer
-                #print(f"prompt_embed_1: {prompt_embed_1.shape}") #torch.Size([1, 77, 768])
-            bs_embed, seq_len, _ = prompt_embed_1.shape #reshape: bsz, sequence_length, dimensions
-            prompt_embed_1 = prompt_embed_1.view(bs_embed, seq_len, -1)[0] #remove bsz dimensions
-                #print(f"prompt_embed_1: {prompt_embed_1.shape}") #torch.Size([77, 768])
-            prompt_embeds_list.append(prompt_embed_1)
-            del tokenized_caption_1, prompt_embed_1
-
-            #process prompt_embed_2
-
-            #tokenize caption 2 #done on cpu
-            tokenized_caption_2 = tokenizer_two(
-                caption_string,
-                max_length=tokenizer_two.model_max_length, # num_tokens specified by tokenizer
-                padding="max_length", #pad tokens to meet model_max_length
-                truncation=True, #crop excess tokens to meet model_max_length
-                return_tensors="pt", #returns tensor
-            ).input_ids #returns a dictionary: input_ids & attention_mask; .input_ids = the actual tokens
-
-            #get encoder_hidden_state
-            with accelerator.autocast(): #diffusers code uses mixed precision
-                prompt_embed_2 = text_encoder_cls_two(tokenized_caption_2.to(device), output_hidden_states=True, return_dict=False)
-                #print(f"prompt_embed_2: {prompt_embed_2}\n") #returns a tuple of tensors
-
-            #[0] = "pooled" output: intended to capture the essence of the entire input sequence in a fixed-size representation
-            #pooled_prompt_embed_2 is kept
-            pooled_prompt_embed_2 = prompt_embed_2[0] #return "pooled" output
-                #print(f"pooled_prompt_embed_2: {pooled_prompt_embed_2.shape}") #torch.Size([1, 1280])
-
-            prompt_embed_2 = prompt_embed_2[-1][-2]
-                #print(f"prompt_embed_2: {prompt_embed_2.shape}") #torch.Size([1, 77, 1280])
-            bs_embed, seq_len, _ = prompt_embed_2.shape
-            prompt_embed_2 = prompt_embed_2.view(bs_embed, seq_len, -1)[0] 
-                #print(f"prompt_embed_2: {prompt_embed_2.shape}") #torch.Size([77, 1280])
-            prompt_embeds_list.append(prompt_embed_2)
-            del tokenized_caption_2, prompt_embed_2
-            
-            #concatenate prompt_embed(TE1+TE2)
-            prompt_embed = torch.concat(prompt_embeds_list, dim=-1) #torch.Size([77, 2048])
-            prompt_embed_shape = prompt_embed.shape
-            del prompt_embeds_list
-                #print(f"prompt_embed: {prompt_embed.shape}") #torch.Size([77, 768])
-
-            #re-shape pooled_prompt_embed(TE2)
-            pooled_prompt_embed = pooled_prompt_embed_2.view(bs_embed, -1)[0]
-            pooled_prompt_embed_shape = pooled_prompt_embed.shape
-            del pooled_prompt_embed_2
-                #print(f"pooled_prompt_embed: {pooled_prompt_embed.shape}\n") #torch.Size([1280])
-
-
-            #create embed filename by 1. remove root  2. prepend cache 3. append hash_value.latent.pkl
-
-            #prompt_embed_file & pooled_prompt_embed_file: cache & hash # file paths created earlier
-            joblib.dump(prompt_embed, prompt_embed_file)
+            try:
+                with open(caption_file, "r") as f:
+                    caption_string = f.read().strip() #test read file
+            except Exception as e:
+                error_message = f"Error reading {caption_file}: {e}"
+                print(error_message)
+                logging.error(error_message)
+                del pixel_values
+                continue
+
+            #prompt_embed & pooled_prompt_embed are encoded later, batched with other captions
+            #prompt_embed_file & pooled_prompt_embed_file: hash # file paths created earlier
             prompt_embed_file_hash_value = hashlib.sha256(prompt_embed_file.encode()).hexdigest()
-            del prompt_embed
-            joblib.dump(pooled_prompt_embed, pooled_prompt_embed_file)
             pooled_prompt_embed_file_hash_value = hashlib.sha256(pooled_prompt_embed_file.encode()).hexdigest()
-            del pooled_prompt_embed
-
-
-            gc.collect()
-            torch.cuda.empty_cache()
 
             ######
             #finished processing caption
             ######
 
 
-            #setup & save cache json_file
+            #setup cache json_file metadata, json_file is written after caption & vae encoding
             metadata = {
                 "basename": basename,
                 "data_dir": data_dir,
                 "cache_dir": cache_dir,
                 "image_file": image_file,
-                "org_image_height": org_image_height,
-                "org_image_width": org_image_width,		
-                "original_size": original_size,
-                "original_image_size": original_image_size,
-                "category_key": category_key,
-                "closest_bucket": closest_bucket,
-                "crop_top_left": crop_top_left,
-                "cropped_image_height": cropped_image_height,
-                "cropped_image_width": cropped_image_width,
-                "target_size": target_size,
-                "cropped_image_size": cropped_image_size,
-                "downscale": downscaled,
-                "upscaled": upscaled,
-                "original_aspect_ratio": original_aspect_ratio,
-                "cropped_aspect_ratio": cropped_aspect_ratio,
-                "image_file_hash_value": image_file_hash_value,
+                "org_image_height": image_metadata["org_image_height"],
+                "org_image_width": image_metadata["org_image_width"],
+                "original_size": image_metadata["original_size"],
+                "original_image_size": image_metadata["original_image_size"],
+                "category_key": image_metadata["category_key"],
+                "closest_bucket": image_metadata["closest_bucket"],
+                "crop_top_left": image_metadata["crop_top_left"],
+                "cropped_image_height": image_metadata["cropped_image_height"],
+                "cropped_image_width": image_metadata["cropped_image_width"],
+                "target_size": image_metadata["target_size"],
+                "cropped_image_size": image_metadata["cropped_image_size"],
+                "downscale": image_metadata["downscale"],
+                "upscaled": image_metadata["upscaled"],
+                "original_aspect_ratio": image_metadata["original_aspect_ratio"],
+                "cropped_aspect_ratio": image_metadata["cropped_aspect_ratio"],
+                "image_file_hash_value": image_metadata["image_file_hash_value"],
                 "model_input_file": model_input_file,
-                "model_input_shape": model_input_shape,
+                "model_input_shape": None, #set after vae encoding
                 "model_input_file_hash_value": model_input_file_hash_value,
                 "caption_file": caption_file,
                 "caption_string": caption_string,
                 "caption_file_hash_value": caption_file_hash_value,
                 "prompt_embed_file": prompt_embed_file,
-                "prompt_embed_shape": prompt_embed_shape,
+                "prompt_embed_shape": None, #set after caption encoding
                 "prompt_embed_file_hash_value": prompt_embed_file_hash_value,
                 "pooled_prompt_embed_file": pooled_prompt_embed_file,
-                "pooled_prompt_embed_shape": pooled_prompt_embed_shape,
+                "pooled_prompt_embed_shape": None, #set after caption encoding
                 "pooled_prompt_embed_file_hash_value": pooled_prompt_embed_file_hash_value,
-                "add_time_id": add_time_id,
+                "add_time_id": image_metadata["add_time_id"],
+                "storage_codec": storage_codec,
             }
 
-            with open(json_file_path, "w") as f:
-                json.dump(metadata, f, indent=4)
-
-
-            #cache image-caption.txt pair complete
-            json_file_paths_list.append(json_file_path)
-            count += 1
-            print(f"  --processed: [{category_key}]: {closest_bucket}")
-
-            #clean-up
-            del caption_string
-            gc.collect()
-            torch.cuda.empty_cache() 
+            #image changed: caption embeds are kept, straight to batched vae encoding
+            if image_only:
+                with open(json_file_path, "r") as f:
+                    cached_metadata = json.load(f)
+                for key in ["caption_string", "prompt_embed_file", "prompt_embed_shape", "prompt_embed_file_hash_value", "pooled_prompt_embed_file", "pooled_prompt_embed_shape", "pooled_prompt_embed_file_hash_value", "caption_embed_key", "token_ids_one", "token_ids_two", "storage_codec"]:
+                    if key in cached_metadata:
+                        metadata[key] = cached_metadata[key]
+                    elif key == "storage_codec": #cached before storage codecs
+                        metadata[key] = "raw"
+                written_json_files = queue_and_encode_image_batches([(pixel_values, metadata, json_file_path, model_input_file)], pending_images, vae_batch_size, vae, accelerator, device, catalog, manifest, writer, stage_counters)
+                json_file_paths_list += written_json_files
+                count += len(written_json_files)
+                del pixel_values, caption_string
+                continue
 
+            #queue for batched caption encoding
+            pending_captions.append((pixel_values, metadata, json_file_path, model_input_file))
+            del pixel_values, caption_string
+
+            #captions full: encode captions, then queue images for batched vae encoding by bucket
+            if len(pending_captions) >= caption_batch_size:
+                encode_and_write_caption_batch([item[1] for item in pending_captions], tokenizer_one, tokenizer_two, text_encoder_cls_one, text_encoder_cls_two, accelerator, device, writer, stage_counters, caption_embed_store, cache_prompt_embeds)
+                written_json_files = queue_and_encode_image_batches(pending_captions, pending_images, vae_batch_size, vae, accelerator, device, catalog, manifest, writer, stage_counters)
+                json_file_paths_list += written_json_files
+                count += len(written_json_files)
+                pending_captions = []
+
+        #encode remaining captions & partly filled buckets
+        if len(pending_captions) > 0:
+            encode_and_write_caption_batch([item[1] for item in pending_captions], tokenizer_one, tokenizer_two, text_encoder_cls_one, text_encoder_cls_two, accelerator, device, writer, stage_counters, caption_embed_store, cache_prompt_embeds)
+        written_json_files = queue_and_encode_image_batches(pending_captions, pending_images, vae_batch_size, vae, accelerator, device, catalog, manifest, writer, stage_counters, flush=True)
+        json_file_paths_list += written_json_files
+        count += len(written_json_files)
+        del pending_captions
+
+        #wait for writes & workers
+        writer.close()
+        if preprocess_executor is not None:
+            preprocess_executor.shutdown()
+        gc.collect()
+        torch.cuda.empty_cache()
 
         #save json_file_paths_list as data_dir.txt
         json_file_paths_list.sort()
-        json_file_paths_list_txt = os.path.join(cache_dir, data_dir.replace(os.sep, "_") + ".list")
-        with open(json_file_paths_list_txt, "w") as f: #erase file
-            pass
-        with open(json_file_paths_list_txt, "a") as f:
+        json_file_paths_list_txt = json_list_file or cached_dataset_list_path(cache_dir, data_dir)
+        with open(json_file_paths_list_txt + ".tmp", "w") as f:
             for item in json_file_paths_list:
                 f.write(f"{item}\n")
+        os.replace(json_file_paths_list_txt + ".tmp", json_file_paths_list_txt) #atomic, a crash never leaves a partial .list
+
+        catalog.close()
+        print(f"  --manifest: {len(manifest)} items")
+        if caption_embed_store is not None:
+            caption_embed_store.print_report()
 
         print("...")
         print(f"\n{count} image-caption.txt pairs cached")
+        print_stage_counters(stage_counters, time.perf_counter() - start_time)
         return json_file_paths_list
 
 
+#opens, converts to RGB, upscales, resizes & crops an image to its closest bucket
+#returns (image, image_metadata), None if image is skipped
+    #image: cropped RGB PIL.Image, closest_bucket size
+#allow_upscale=False: returns "needs_upscale" instead of upscaling, for process pool workers
+def preprocess_image(
+        image_file,
+        sorted_categories_keys,
+        max_resolution,
+        min_resolution,
+        upscale_to_resolution,
+        upscale_use_GFPGAN,
+        save_upscale_samples,
+        allow_upscale=True
+    ):
+
+    #reset upscaled metadata
+    upscaled = False
+
+    #try opening image file
+    try:
+        image = Image.open(image_file)
+    except Exception as e: #failed opening
+        error_message = f"Error: {e}, for {image_file}"
+        print(error_message)
+        logging.error(error_message)
+        return None
+    
+    #hash image_file
+    image_file_hash_value = hashlib.sha256(image_file.encode()).hexdigest()
+
+    #calculate image dimensions & aspect ratio
+    org_image_width, org_image_height = image.size
+    original_aspect_ratio = org_image_width / org_image_height #get original aspect ratio 
+    original_image_size = (org_image_width, org_image_height) #actual original_image_size
+
+    #height & width by 64, image_pixels by 64, aspect ratio by 64
+    image_width_64 = (org_image_width // 64) * 64
+    image_height_64 = (org_image_height // 64) * 64
+    image_pixels_64 = image_width_64 * image_height_64
+    image_pixels_64_sqrt = int(math.sqrt(image_pixels_64))
+
+    #check if image is too small
+    if image_pixels_64 < min_resolution ** 2:
+        print(" --too small")
+        return None
+
+
+    #convert image to RGB
+
+    #if has transparency check
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        if image.mode != 'RGBA':
+            try:
+                image = image.convert('RGBA')
+            except Exception as e:
+                error_message = f"Error: {e}, for {image_file}"
+                print(error_message)
+                logging.error(error_message)
+                return None
+
+        #based on alpha value, merge RGB with white background, convert to RGB
+        white_bg = Image.new('RGBA', image.size, 'WHITE')
+        image = Image.alpha_composite(white_bg, image)
+        try:
+            image = image.convert('RGB')
+        except Exception as e:
+            error_message = f"Error: {e}, for {image_file}"
+            print(error_message)
+            logging.error(error_message)
+            return None
+
+        print(f"  --converted: RGBA/LA/P w/ transparency --> RGB w/ white background")
+
+    #no transparency
+    else:
+        try:
+            image = image.convert("RGB")
+        except Exception as e:
+            error_message = f"Error: {e}, for {image_file}"
+            print(error_message)
+            logging.error(error_message)
+            return None
+
+
+    #upscale & image cropping 
+
+    #if upscale_to_resolution
+    if upscale_to_resolution is not None:
+        #image pixels less than upscale, get category_key,then use category key to verify needs upscale
+        if image_pixels_64 <= upscale_to_resolution ** 2: #if image pixels <= upscaled image pixels
+            category_key = int(bucket_engine.category_keys_for(image_pixels_64_sqrt, sorted_categories_keys, max_resolution)) #category_key for image
+            if category_key < upscale_to_resolution: #image needs upscale
+                if not allow_upscale:
+                    return "needs_upscale"
+
+                #get closest_bucket
+                category_key = upscale_to_resolution
+                original_aspect_ratio = org_image_width / org_image_height
+                closest_bucket = bucket_engine.closest_buckets_for(category_key, original_aspect_ratio).tolist()
+
+                #calculate upscale_factor
+                upscale_factor_width = closest_bucket[0] / org_image_width
+                upscale_factor_height = closest_bucket[1] / org_image_height
+                upscale_factor = max(upscale_factor_width, upscale_factor_height)
+
+                #upscale image
+                print(f"  --upscaling image: {upscale_factor}")
+                image = Real_ESRGAN(
+                    image,
+                    upscale_factor,
+                    upscale_use_GFPGAN,
+                    image_file,
+                    save_upscale_samples
+                    )
+
+                #re-calculate_64 for upscaled image
+                up_image_width, up_image_height = image.size
+                up_image_width_64 = (up_image_width // 64) * 64
+                up_image_height_64 = (up_image_height // 64) * 64
+                image_pixels_64 = up_image_width_64 * up_image_height_64
+                image_pixels_64_sqrt = int(math.sqrt(image_pixels_64))
+
+                #upscaled metadata = True
+                upscaled = True
+
+
+    #find closest bucket
+    #find the largest category that is lower than or equal to image_pixels_64
+    category_key = int(bucket_engine.category_keys_for(image_pixels_64_sqrt, sorted_categories_keys, max_resolution))
+    #print(f"category_key1: {category_key}")
+    #never None: sizes above every category get max_resolution, too small images were skipped by the min_resolution check
+
+    #aspect ratio process
+    original_aspect_ratio = org_image_width / org_image_height
+    closest_bucket = bucket_engine.closest_buckets_for(category_key, original_aspect_ratio).tolist()
+
+    #resize and crop
+    target_width, target_height = closest_bucket #target width based on bucket
+    scaling_factor = min(image.width / target_width, image.height / target_height) #find how to resize
+    new_width = int(image.width / scaling_factor)
+    new_height = int(image.height / scaling_factor)
+    image_resized = image.resize((new_width, new_height), Image.LANCZOS)
+
+    # Calculate cropping coordinates to get the final image
+    x1 = (new_width - target_width) // 2
+    y1 = (new_height - target_height) // 2
+    x2 = x1 + target_width
+    y2 = y1 + target_height
+
+    #crop
+    image_cropped = image_resized.crop((x1, y1, x2, y2))
+    del image_resized
+    crop_top_left = (y1, x1)
+
+    cropped_image_width, cropped_image_height = image_cropped.size
+    target_size = (cropped_image_height, cropped_image_width) #for use with add_ids
+    cropped_image_size = (cropped_image_width, cropped_image_height) #actual cropped_image_size
+    cropped_aspect_ratio = cropped_image_width / cropped_image_height #get original aspect ratio 
+
+    #downscale check #might use later
+    downscaled = False
+    if cropped_image_width * cropped_image_height < image_pixels_64:
+        downscaled = True
+
+    #original_size
+    if upscaled == True:
+        original_size = (image_height_64, image_width_64)
+    else:
+        original_size = (cropped_image_height, cropped_image_width)
+
+    #add_time_id
+    add_time_id = [
+        original_size[0],
+        original_size[1],
+        crop_top_left[0],
+        crop_top_left[1],
+        target_size[0],
+        target_size[1]
+        ]
+
+    #continue with cropped_image as image
+    image = image_cropped
+    del image_cropped
+
+    image_metadata = {
+        "org_image_height": org_image_height,
+        "org_image_width": org_image_width,
+        "original_size": original_size,
+        "original_image_size": original_image_size,
+        "category_key": category_key,
+        "closest_bucket": closest_bucket,
+        "crop_top_left": crop_top_left,
+        "cropped_image_height": cropped_image_height,
+        "cropped_image_width": cropped_image_width,
+        "target_size": target_size,
+        "cropped_image_size": cropped_image_size,
+        "downscale": downscaled,
+        "upscaled": upscaled,
+        "original_aspect_ratio": original_aspect_ratio,
+        "cropped_aspect_ratio": cropped_aspect_ratio,
+        "image_file_hash_value": image_file_hash_value,
+        "add_time_id": add_time_id,
+    }
+
+    return image, image_metadata
+
+
+#process image for caching
+#returns normalized [3, height, width] tensor, ready for vae.encode
+def image_to_pixel_values(image):
+    #transform image
+    train_transforms = transforms.Compose(
+    [
+    transforms.ToTensor(),
+    transforms.Normalize([0.5], [0.5]),
+    ]
+    )
+    return train_transforms(image)
+
+
+#process pool worker: preprocess_image without upscaling, Real_ESRGAN stays on the main process's gpu
+#returns (result, seconds), result: (image as uint8 array, image_metadata), None, or "needs_upscale"
+def preprocess_image_worker(image_file, preprocess_arguments):
+    start_time = time.perf_counter()
+    result = preprocess_image(image_file, *preprocess_arguments, allow_upscale=False)
+    if isinstance(result, tuple):
+        image, image_metadata = result
+        result = (np.asarray(image), image_metadata) #arrays pickle faster than PIL.Image
+    return result, time.perf_counter() - start_time
+
+
+#yields preprocess_image results for image_files, in order
+#preprocess_executor None: serial, else process pool with at most preprocess_queue_size images in flight
+def iterate_preprocessed_images(image_files, preprocess_arguments, preprocess_executor, preprocess_queue_size, stage_counters):
+    if preprocess_executor is None:
+        for image_file in image_files:
+            start_time = time.perf_counter()
+            result = preprocess_image(image_file, *preprocess_arguments)
+            add_stage_count(stage_counters, "preprocess", 1, time.perf_counter() - start_time)
+            yield result
+        return
+
+    futures = deque()
+    next_index = 0
+    while len(futures) > 0 or next_index < len(image_files):
+        #backpressure: submit until preprocess_queue_size images are in flight
+        while next_index < len(image_files) and len(futures) < preprocess_queue_size:
+            futures.append(preprocess_executor.submit(preprocess_image_worker, image_files[next_index], preprocess_arguments))
+            next_index += 1
+        image_file = image_files[next_index - len(futures)]
+
+        #encoder stage waits for the oldest image
+        wait_start_time = time.perf_counter()
+        result, seconds = futures.popleft().result()
+        add_stage_count(stage_counters, "preprocess_wait", 0, time.perf_counter() - wait_start_time)
+        add_stage_count(stage_counters, "preprocess", 1, seconds)
+
+        if isinstance(result, tuple):
+            result = (Image.fromarray(result[0]), result[1])
+        elif result == "needs_upscale":
+            #upscale on this process
+            start_time = time.perf_counter()
+            result = preprocess_image(image_file, *preprocess_arguments)
+            add_stage_count(stage_counters, "upscale", 1, time.perf_counter() - start_time)
+        yield result
+
+
+#per stage counters for cache_image_caption_pair: {stage: {"items", "seconds"}}
+def new_stage_counters():
+    stages = ["preprocess", "preprocess_wait", "upscale", "caption_encode", "vae_encode", "write", "write_wait"]
+    return {stage: {"items": 0, "seconds": 0.0} for stage in stages}
+
+
+def add_stage_count(stage_counters, stage, items, seconds):
+    stage_counters[stage]["items"] += items
+    stage_counters[stage]["seconds"] += seconds
+
+
+#prints items/sec per stage
+    #preprocess seconds are summed over workers, *_wait = time the encoder stage was blocked
+def print_stage_counters(stage_counters, total_seconds):
+    print(f"  --stage throughput, {total_seconds:.1f}s total:")
+    for stage, counter in stage_counters.items():
+        if counter["items"] == 0 and counter["seconds"] == 0.0:
+            continue
+        if counter["items"] > 0:
+            items_per_second = counter["items"] / counter["seconds"] if counter["seconds"] > 0 else 0.0
+            print(f"    {stage}: {counter['items']} items, {counter['seconds']:.1f}s, {items_per_second:.1f} items/s")
+        else:
+            print(f"    {stage}: {counter['seconds']:.1f}s")
+
+
+#cache file writer stage, write tasks run in submission order
+    #an item's json_file is submitted after its .pkl files, so it is written last
+#use_thread=True: writes run on a background thread, bounded queue blocks the encoder stage when writes fall behind
+#use_thread=False: writes run immediately, serial path
+class CacheFileWriter:
+    def __init__(self, stage_counters, use_thread=False, max_queue_size=64):
+        self.stage_counters = stage_counters
+        self.write_queue = None
+        self.error = None
+        if use_thread:
+            self.write_queue = queue.Queue(maxsize=max_queue_size)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _write(self, function, args):
+        start_time = time.perf_counter()
+        function(*args)
+        add_stage_count(self.stage_counters, "write", 1, time.perf_counter() - start_time)
+
+    def _run(self):
+        while True:
+            task = self.write_queue.get()
+            if task is None:
+                break
+            if self.error is None: #after an error, drain the queue without writing
+                try:
+                    self._write(*task)
+                except Exception as e:
+                    self.error = e
+
+    #function(*args) writes one file
+    def submit(self, function, *args):
+        if self.error is not None:
+            raise self.error
+        if self.write_queue is None:
+            self._write(function, args)
+            return
+        wait_start_time = time.perf_counter()
+        self.write_queue.put((function, args))
+        add_stage_count(self.stage_counters, "write_wait", 0, time.perf_counter() - wait_start_time)
+
+    #waits for queued writes, re-raises a write error
+    def close(self):
+        if self.write_queue is not None:
+            self.write_queue.put(None)
+            self.thread.join()
+            self.write_queue = None
+        if self.error is not None:
+            raise self.error
+
+
+#writes .metadata.json, then adds it to the catalog & manifest
+    #manifest last: an item is only skipped on re-runs once all its files are written
+def write_metadata_json(json_file_path, metadata, catalog, manifest):
+    with open(json_file_path, "w") as f:
+        json.dump(metadata, f, indent=4)
+    if catalog is not None:
+        catalog.add(json_file_path, json.loads(json.dumps(metadata))) #json round trip: tuples -> lists, same as .metadata.json
+    if manifest is not None:
+        manifest.add(json_file_path, metadata)
+
+
+#waits for queued gpu work, for stage timing
+def synchronize_device():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+#.list file of a cached data_dir: cache_dir/basename/data_dir.list
+    #cache_dir: cache_dir joined with basename, data_dir: absolute path
+def cached_dataset_list_path(cache_dir, data_dir):
+    return os.path.join(cache_dir, data_dir.replace(os.sep, "_") + ".list")
+
+
+#reads cached dataset .list files, returns json_file paths sorted & without duplicates or empty lines
+#sorted: the same order on every rank & every launch, sampler state & validation splits are positions in this list
+def load_cached_json_list(cached_dataset_lists):
+    json_file_paths_list = []
+    for list_file in cached_dataset_lists:
+        with open(list_file, "r") as f:
+            json_file_paths_list += [line.strip() for line in f if line.strip()]
+    return sorted(set(json_file_paths_list))
+
+
+#merges per process partial .list files into list_file, then removes the partial files
+#returns merged json_file paths list
+def merge_cached_dataset_lists(partial_list_files, list_file):
+    json_file_paths_list = []
+    for partial_list_file in partial_list_files:
+        with open(partial_list_file, "r") as f:
+            json_file_paths_list += [line.strip() for line in f if line.strip()]
+    json_file_paths_list = sorted(set(json_file_paths_list))
+
+    with open(list_file + ".tmp", "w") as f:
+        for item in json_file_paths_list:
+            f.write(f"{item}\n")
+    os.replace(list_file + ".tmp", list_file)
+
+    for partial_list_file in partial_list_files:
+        os.remove(partial_list_file)
+    return json_file_paths_list
+
+
+#queues caption encoded items for batched vae encoding by bucket: same bucket = same image size
+#encodes full buckets, or the fullest bucket if too many images are queued (limits ram)
+#flush: also encodes all partly filled buckets
+#returns list of written json_file paths
+def queue_and_encode_image_batches(batch_items, pending_images, vae_batch_size, vae, accelerator, device, catalog, manifest, writer, stage_counters, flush=False):
+    max_pending_images = vae_batch_size * 8
+    json_file_paths_list = []
+    for item in batch_items:
+        bucket_key = tuple(item[1]["closest_bucket"])
+        pending_images.setdefault(bucket_key, []).append(item)
+        num_pending_images = sum(len(bucket_items) for bucket_items in pending_images.values())
+        if len(pending_images[bucket_key]) >= vae_batch_size:
+            encode_bucket_key = bucket_key
+        elif num_pending_images >= max_pending_images:
+            encode_bucket_key = max(pending_images, key=lambda key: len(pending_images[key]))
+        else:
+            continue
+        json_file_paths_list += encode_and_write_image_batch(pending_images.pop(encode_bucket_key), vae, accelerator, device, catalog, manifest, writer, stage_counters)
+
+    if flush:
+        for bucket_key in list(pending_images):
+            json_file_paths_list += encode_and_write_image_batch(pending_images.pop(bucket_key), vae, accelerator, device, catalog, manifest, writer, stage_counters)
+
+    return json_file_paths_list
+
+
+#loads tokenizer_one & tokenizer_two
+#use_fast_tokenizer: CLIPTokenizerFast (rust) if available, else CLIPTokenizer
+def load_clip_tokenizers(pretrained_model_name_or_path, use_fast_tokenizer=True):
+    tokenizers = []
+    for subfolder in ["tokenizer", "tokenizer_2"]:
+        tokenizer = None
+        if use_fast_tokenizer:
+            try:
+                tokenizer = CLIPTokenizerFast.from_pretrained(
+                    pretrained_model_name_or_path, subfolder=subfolder
+                )
+            except Exception as e:
+                print(f"  --CLIPTokenizerFast not available for {subfolder}, using CLIPTokenizer: {e}")
+        if tokenizer is None:
+            tokenizer = CLIPTokenizer.from_pretrained(
+                pretrained_model_name_or_path, subfolder=subfolder
+            )
+        tokenizers.append(tokenizer)
+    return tokenizers[0], tokenizers[1]
+
+
+#tokenizes a list of captions with both tokenizers #done on cpu
+#returns token_ids_one, token_ids_two: [bsz, 77] tensors
+def tokenize_captions(caption_strings, tokenizer_one, tokenizer_two):
+    token_ids = []
+    for tokenizer in [tokenizer_one, tokenizer_two]:
+        token_ids.append(tokenizer(
+            caption_strings,
+            max_length=tokenizer.model_max_length, #num_tokens specified by tokenizer
+            padding="max_length", #pad tokens to meet model_max_length
+            truncation=True, #crop excess tokens to meet model_max_length
+            return_tensors="pt", #returns tensor
+        ).input_ids) #returns a dictionary: input_ids & attention_mask; .input_ids = the actual tokens
+    return token_ids[0], token_ids[1]
+
+
+#text encodes a batch of token ids with both text_encoders
+#returns prompt_embeds: [bsz, 77, 2048] (TE1 + TE2), pooled_prompt_embeds: [bsz, 1280] (TE2)
+def encode_caption_token_ids(token_ids_one, token_ids_two, text_encoder_one, text_encoder_two, accelerator, device):
+    with accelerator.autocast(): #diffusers code uses mixed precision
+        prompt_embed_1 = text_encoder_one(token_ids_one.to(device), output_hidden_states=True, return_dict=False)
+        prompt_embed_2 = text_encoder_two(token_ids_two.to(device), output_hidden_states=True, return_dict=False)
+        #returns a tuple of tensors
+
+    #[0] = "pooled" output: intended to capture the essence of the entire input sequence in a fixed-size representation
+    #"We are only ALWAYS interested in the pooled output of the final text encoder"
+    #so pooled_prompt_embed_1 is discarded, pooled_prompt_embed_2 is kept
+    pooled_prompt_embeds = prompt_embed_2[0] #torch.Size([bsz, 1280])
+
+    #clip-skip 2: second-to-last layer
+    #concatenate prompt_embed(TE1+TE2): [bsz, 77, 768] + [bsz, 77, 1280]
+    prompt_embeds = torch.concat([prompt_embed_1[-1][-2], prompt_embed_2[-1][-2]], dim=-1) #torch.Size([bsz, 77, 2048])
+    del prompt_embed_1, prompt_embed_2
+
+    return prompt_embeds, pooled_prompt_embeds
+
+
+#prompt_embed_file & pooled_prompt_embed_file of a caption cached without caption dedup, mirrors data_dir in cache_dir
+#cache_dir: cache_dir/basename
+def caption_embed_file_paths(caption_file, cache_dir, basename):
+    caption_file_cache_path = os.path.join(cache_dir, caption_file.split(basename, 1)[1].lstrip('/'))
+    return f"{caption_file_cache_path}.prompt_embed.pkl", f"{caption_file_cache_path}.pooled_prompt_embed.pkl"
+
+
+#tokenizes & text encodes a batch of captions, then writes each caption's prompt_embed & pooled_prompt_embed
+#metadata_list: .metadata.json dicts, uses caption_string, prompt_embed_file & pooled_prompt_embed_file
+    #sets prompt_embed_shape & pooled_prompt_embed_shape
+#writer: CacheFileWriter
+#caption_embed_store: CaptionEmbedStore, metadata is pointed at the store, only captions not in the store are encoded
+#sets token_ids_one & token_ids_two: [77] ints per tokenizer, for --encode_text_on_the_fly
+#cache_prompt_embeds=False: token ids only, nothing is encoded or written, text_encoders may be None
+    #prompt embed file keys are set to None, older caption embed files are no longer referenced
+def encode_and_write_caption_batch(metadata_list, tokenizer_one, tokenizer_two, text_encoder_one, text_encoder_two, accelerator, device, writer, stage_counters, caption_embed_store=None, cache_prompt_embeds=True):
+    start_time = time.perf_counter()
+    token_ids_one, token_ids_two = tokenize_captions([metadata["caption_string"] for metadata in metadata_list], tokenizer_one, tokenizer_two)
+    for i, metadata in enumerate(metadata_list):
+        metadata["token_ids_one"] = token_ids_one[i].tolist()
+        metadata["token_ids_two"] = token_ids_two[i].tolist()
+
+    if not cache_prompt_embeds:
+        for metadata in metadata_list:
+            for key in ["prompt_embed_file", "prompt_embed_shape", "prompt_embed_file_hash_value", "pooled_prompt_embed_file", "pooled_prompt_embed_shape", "pooled_prompt_embed_file_hash_value"]:
+                metadata[key] = None
+            metadata.pop("caption_embed_key", None)
+        add_stage_count(stage_counters, "caption_encode", len(metadata_list), time.perf_counter() - start_time)
+        return
+
+    encode_indices = list(range(len(metadata_list)))
+    if caption_embed_store is not None:
+        #one encode per unique caption not already stored
+        encode_indices = []
+        encode_keys = set()
+        for i, metadata in enumerate(metadata_list):
+            key = caption_embed_store.assign(metadata)
+            if key not in caption_embed_store and key not in encode_keys:
+                encode_keys.add(key)
+                encode_indices.append(i)
+    else:
+        #token ids only items: embed files next to the caption's cache path again
+        for metadata in metadata_list:
+            if metadata.get("prompt_embed_file") is None:
+                metadata["prompt_embed_file"], metadata["pooled_prompt_embed_file"] = caption_embed_file_paths(metadata["caption_file"], metadata["cache_dir"], metadata["basename"])
+                metadata["prompt_embed_file_hash_value"] = hashlib.sha256(metadata["prompt_embed_file"].encode()).hexdigest()
+                metadata["pooled_prompt_embed_file_hash_value"] = hashlib.sha256(metadata["pooled_prompt_embed_file"].encode()).hexdigest()
+    encode_metadata_list = [metadata_list[i] for i in encode_indices]
+
+    if len(encode_metadata_list) > 0:
+        with torch.no_grad():
+            prompt_embeds, pooled_prompt_embeds = encode_caption_token_ids(token_ids_one[encode_indices], token_ids_two[encode_indices], text_encoder_one, text_encoder_two, accelerator, device)
+        synchronize_device()
+    del token_ids_one, token_ids_two
+    encode_seconds = time.perf_counter() - start_time
+    add_stage_count(stage_counters, "caption_encode", len(encode_metadata_list), encode_seconds)
+
+    for i, metadata in enumerate(encode_metadata_list):
+        #clone: pickling a view would save the whole batch's storage
+        prompt_embed = prompt_embeds[i].clone() #torch.Size([77, 2048])
+        pooled_prompt_embed = pooled_prompt_embeds[i].clone() #torch.Size([1280])
+        if caption_embed_store is not None:
+            caption_embed_store.submit(writer, metadata["caption_embed_key"], prompt_embed, pooled_prompt_embed, metadata.get("storage_codec") or "raw")
+        else:
+            storage_codec = metadata.get("storage_codec") or "raw"
+            writer.submit(dump_tensor, prompt_embed, metadata["prompt_embed_file"], storage_codec)
+            writer.submit(dump_tensor, pooled_prompt_embed, metadata["pooled_prompt_embed_file"], storage_codec)
+        metadata["prompt_embed_shape"] = prompt_embed.shape
+        metadata["pooled_prompt_embed_shape"] = pooled_prompt_embed.shape
+        del prompt_embed, pooled_prompt_embed
+    if len(encode_metadata_list) > 0:
+        del prompt_embeds, pooled_prompt_embeds
+
+    #reused store entries
+    if caption_embed_store is not None:
+        for metadata in metadata_list:
+            metadata["prompt_embed_shape"], metadata["pooled_prompt_embed_shape"] = caption_embed_store.get_embed_shapes(metadata["caption_embed_key"], metadata.get("storage_codec") or "raw")
+        caption_embed_store.add_count(len(metadata_list), len(encode_metadata_list), encode_seconds)
+
+
+#reads a cached item's .metadata.json, with caption_string re-read from caption_file
+#returns metadata, None on error
+def read_metadata_with_caption(json_file):
+    try:
+        with open(json_file, "r") as f:
+            metadata = json.load(f)
+        with open(metadata["caption_file"], "r") as f:
+            metadata["caption_string"] = f.read().strip()
+    except Exception as e:
+        error_message = f"Error: {e}, for {json_file}"
+        print(error_message)
+        logging.error(error_message)
+        return None
+    metadata["caption_file_hash_value"] = hashlib.sha256(metadata["caption_file"].encode()).hexdigest()
+    return metadata
+
+
+#re-encodes captions of an already cached dataset, latents are kept
+    #caption_file is re-read, edited captions get new prompt_embed & pooled_prompt_embed
+    #updates .metadata.json, manifest & catalog, if the cached dataset has one
+#returns number of re-encoded captions
+def recache_captions(
+        json_file_paths_list,
+        pretrained_model_name_or_path,
+        accelerator,
+        device,
+        caption_batch_size=32,
+        use_fast_tokenizer=True,
+        dedup_captions=True
+    ):
+
+    print("\nbegin recache_captions")
+    print(f"  --{len(json_file_paths_list)} cached items")
+
+    #tokenizers & text_encoders
+    tokenizer_one, tokenizer_two = load_clip_tokenizers(pretrained_model_name_or_path, use_fast_tokenizer)
+    text_encoder_cls_one = CLIPTextModel.from_pretrained(
+        pretrained_model_name_or_path, subfolder="text_encoder"
+    )
+    text_encoder_cls_two = CLIPTextModelWithProjection.from_pretrained(
+        pretrained_model_name_or_path, subfolder="text_encoder_2"
+    )
+    text_encoder_cls_one.to(device)
+    text_encoder_cls_two.to(device)
+
+    catalogs = {} #{catalog_path: CachedDatasetCatalog}
+    manifests = {} #{manifest_path: CacheManifest}
+    caption_embed_stores = {} #{cache_dir: CaptionEmbedStore}
+    encoder_identity = text_encoder_identity(pretrained_model_name_or_path, text_encoder_cls_one, text_encoder_cls_two)
+    stage_counters = new_stage_counters()
+    writer = CacheFileWriter(stage_counters)
+    count = 0
+    for batch_start in range(0, len(json_file_paths_list), caption_batch_size):
+
+        #read metadata & captions
+        batch_items = []
+        for json_file in json_file_paths_list[batch_start:batch_start + caption_batch_size]:
+            metadata = read_metadata_with_caption(json_file)
+            if metadata is not None:
+                batch_items.append((json_file, metadata))
+        if len(batch_items) == 0:
+            continue
+
+        #caption_embeds: one store per cached dataset
+        batch_items_by_cache_dir = defaultdict(list)
+        for json_file, metadata in batch_items:
+            batch_items_by_cache_dir[metadata["cache_dir"]].append(metadata)
+        for cache_dir, metadata_list in batch_items_by_cache_dir.items():
+            caption_embed_store = None
+            if dedup_captions:
+                if cache_dir not in caption_embed_stores:
+                    caption_embed_stores[cache_dir] = CaptionEmbedStore(os.path.join(cache_dir, caption_embeds_dirname), encoder_identity)
+                caption_embed_store = caption_embed_stores[cache_dir]
+            encode_and_write_caption_batch(metadata_list, tokenizer_one, tokenizer_two, text_encoder_cls_one, text_encoder_cls_two, accelerator, device, writer, stage_counters, caption_embed_store)
+
+        #save json_file, update catalog & manifest
+        for json_file, metadata in batch_items:
+            catalog_path = os.path.join(metadata["cache_dir"], catalog_filename)
+            if catalog_path not in catalogs and os.path.exists(catalog_path):
+                catalogs[catalog_path] = CachedDatasetCatalog(catalog_path, commit_every=catalog_commit_every)
+            manifest_path = os.path.join(metadata["cache_dir"], manifest_filename)
+            if manifest_path not in manifests:
+                manifests[manifest_path] = CacheManifest(manifest_path)
+            writer.submit(write_metadata_json, json_file, metadata, catalogs.get(catalog_path), manifests[manifest_path])
+        count += len(batch_items)
+        print(f"\r[{count}/{len(json_file_paths_list)}]", end="")
+
+    writer.close()
+    for catalog in catalogs.values():
+        catalog.close()
+    del text_encoder_cls_one, text_encoder_cls_two
+    gc.collect()
+    torch.cuda.empty_cache()
+
+    print(f"\n{count} captions re-encoded")
+    for caption_embed_store in caption_embed_stores.values():
+        caption_embed_store.print_report()
+    return count
+
+
+#vae encodes a batch of same bucket images, then writes each image's latent & json_file
+#batch_items: list of (pixel_values, metadata, json_file_path, model_input_file)
+    #json_file is written last, an item only counts as cached once all its files exist
+#writer: CacheFileWriter
+#returns list of json_file paths, written once writer is closed
+def encode_and_write_image_batch(batch_items, vae, accelerator, device, catalog, manifest, writer, stage_counters):
+    start_time = time.perf_counter()
+    with torch.no_grad():
+        #encode model_input (latent_image)
+        with accelerator.autocast(): #mixed-precision (fp16)
+            pixel_values = torch.stack([item[0] for item in batch_items]).to(memory_format=torch.contiguous_format).to(device)
+            model_input = vae.encode(pixel_values, return_dict=False)[0].sample()
+            #return_dict false, only returns tensor, so we sample directly. if return_dict=False, .latent_dist.sample() to access
+        model_input = model_input * vae.config.scaling_factor
+            #print(f"\nmodel_input: {model_input.shape}") #for 1024 images : torch.Size([bsz, 4, 128, 128])
+        del pixel_values
+    synchronize_device()
+    add_stage_count(stage_counters, "vae_encode", len(batch_items), time.perf_counter() - start_time)
+
+    json_file_paths_list = []
+    for i, (_, metadata, json_file_path, model_input_file) in enumerate(batch_items):
+        #save model_input (latent_image)
+        #clone: pickling a view would save the whole batch's storage
+        image_model_input = model_input[i].clone()
+        writer.submit(dump_tensor, image_model_input, model_input_file, metadata.get("storage_codec") or "raw")
+        metadata["model_input_shape"] = image_model_input.shape
+        del image_model_input
+
+        #save json_file
+        writer.submit(write_metadata_json, json_file_path, metadata, catalog, manifest)
+
+        #cache image-caption.txt pair complete
+        json_file_paths_list.append(json_file_path)
+        print(f"  --processed: [{metadata['category_key']}]: {metadata['closest_bucket']}: {metadata['image_file']}")
+
+    del model_input
+    return json_file_paths_list
+
+
 #cached file integrity check
-def cached_file_integrity_check(json_file_path):
+#deep_check: also loads cached tensors, see cached_tensor_check
+def cached_file_integrity_check(json_file_path, deep_check=False):
     with open(json_file_path, "r") as f:
         metadata = json.load(f)
 
@@ -797,6 +1577,14 @@ def cached_file_integrity_check(json_file_path):
         pass
     else:
         return "\nmodel_input_file_fail"
+
+    #token ids only item: no prompt embed files, token ids instead
+    if metadata.get("prompt_embed_file") is None:
+        if len(metadata.get("token_ids_one") or []) == 0 or len(metadata.get("token_ids_two") or []) == 0:
+            return "\ntoken_ids_fail"
+        if deep_check:
+            return cached_tensor_check(metadata)
+        return "pass"
     
     #verify prompt_embed_file
     prompt_embed_file = metadata["prompt_embed_file"]
@@ -814,11 +1602,70 @@ def cached_file_integrity_check(json_file_path):
     else:
         return "\npooled_prompt_embed_file_fail"
 
+    #verify cached tensors
+    if deep_check:
+        return cached_tensor_check(metadata)
+
     #success
-    gc.collect()
     return "pass"
 
 
+#loads an item's cached tensors: shape matches metadata, floating point dtype, no NaN/Inf
+#token ids only items: model_input only
+def cached_tensor_check(metadata):
+    for key in ["model_input", "prompt_embed", "pooled_prompt_embed"]:
+        if key != "model_input" and metadata.get(f"{key}_file") is None:
+            continue
+        try:
+            tensor = load_tensor(metadata[f"{key}_file"], metadata.get("storage_codec") or "raw")
+        except Exception:
+            return f"\n{key}_file_fail"
+        if metadata.get(f"{key}_shape") is not None and list(tensor.shape) != list(metadata[f"{key}_shape"]):
+            return f"\n{key}_shape_fail"
+        if not torch.is_floating_point(tensor):
+            return f"\n{key}_dtype_fail"
+        if not torch.isfinite(tensor).all():
+            return f"\n{key}_nan_inf_fail"
+    return "pass"
+
+
+#cached_file_integrity_check, unreadable json_file fails instead of raising
+def verify_cached_item(json_file_path, deep_check=False):
+    try:
+        return cached_file_integrity_check(json_file_path, deep_check)
+    except Exception:
+        return "\njson_file_fail"
+
+
+#verifies cached items in parallel, checks mostly wait on disk: threads
+    #deep_check: also loads cached tensors, see cached_tensor_check
+    #items are submitted in chunks, memory stays flat for large datasets
+#returns (passed json_file paths list, {failed json_file: result})
+def verify_cached_dataset(json_file_paths_list, deep_check=False, num_workers=16):
+    print(f"\nbegin verify_cached_dataset: {len(json_file_paths_list)} items, {num_workers} threads, deep_check={deep_check}")
+    passed_json_files = []
+    failed_json_files = {}
+    start_time = time.perf_counter()
+    chunk_size = num_workers * 64
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for chunk_start in range(0, len(json_file_paths_list), chunk_size):
+            chunk = json_file_paths_list[chunk_start:chunk_start + chunk_size]
+            for json_file, result in zip(chunk, executor.map(verify_cached_item, chunk, [deep_check] * len(chunk))):
+                if result == "pass":
+                    passed_json_files.append(json_file)
+                else:
+                    failed_json_files[json_file] = result
+                    error_message = f"{json_file} : {result.strip()}"
+                    print(f"\n{error_message}")
+                    logging.error(error_message)
+            count = chunk_start + len(chunk)
+            print(f"\r[{count}/{len(json_file_paths_list)}] {count / (time.perf_counter() - start_time):.0f} files/sec", end="")
+
+    elapsed_seconds = time.perf_counter() - start_time
+    print(f"\n  --{len(passed_json_files)} passed, {len(failed_json_files)} failed, {elapsed_seconds:.1f}s, {len(json_file_paths_list) / max(elapsed_seconds, 1e-9):.0f} files/sec")
+    return passed_json_files, failed_json_files
+
+
 def Real_ESRGAN(image, outscale, upscale_use_GFPGAN, image_file, save_upscale_samples):
     #Real-ESRGAN is BSD-3-Clause license
     #License: https://github.com/xinntao/Real-ESRGAN/blob/master/LICENSE 
@@ -850,7 +1697,7 @@ def Real_ESRGAN(image, outscale, upscale_use_GFPGAN, image_file, save_upscale_sa
         tile=tile,
         tile_pad=tile_pad,
         pre_pad=pre_pad,
-        half=True,
+        half=torch.cuda.is_available(), #fp16 needs a gpu
         gpu_id=gpu_id)
 
     if upscale_use_GFPGAN == True:
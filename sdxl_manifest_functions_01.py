@@ -0,0 +1,162 @@
+#sdxl_manifest_functions.py
+#content-hash manifest for incremental, crash-safe caching:
+    #one append-only file per cached dataset: cache_dir/basename/manifest.jsonl, next to catalog.sqlite
+    #one line per cached item, appended as soon as the item's files are written
+        #after a crash, every finished item is in the manifest, re-runs skip it
+        #an item cached again appends a new line, last line per json_file wins
+    #per file: size, mtime_ns & blake2b content hash
+        #source files: image_file, caption_file
+        #cached files: model_input_file, prompt_embed_file, pooled_prompt_embed_file
+    #re-runs: size & mtime_ns unchanged = file unchanged, no read needed
+        #size or mtime_ns changed: content hash decides
+    #add(): hashes memoized per path & (size, mtime_ns), also from loaded entries
+        #a file is hashed once per run: shared caption embed files referenced by many items, unchanged source images
+        #new cached files are hashed right after they are written, read from the page cache
+    #changed_components: which parts of an item need re-encoding
+        #"image": image_file or model_input_file changed
+        #"caption": caption_file, prompt_embed_file or pooled_prompt_embed_file changed
+    #token ids only items (no prompt embed files): only caption_file is recorded for the caption
+
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+
+manifest_filename = "manifest.jsonl"
+
+#metadata keys of files recorded per item
+manifest_image_keys = ["image_file", "model_input_file"]
+manifest_caption_keys = ["caption_file", "prompt_embed_file", "pooled_prompt_embed_file"]
+
+
+#blake2b content hash, 16 byte digest
+def hash_file(file_path, chunk_size=1024 * 1024):
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+#returns {"size", "mtime_ns", "hash"} for file_path
+#hash_memo: optional {file_path: record}, the hash is reused if size & mtime_ns are unchanged
+def file_record(file_path, hash_memo=None):
+    file_stat = os.stat(file_path)
+    memo_record = hash_memo.get(file_path) if hash_memo is not None else None
+    if memo_record is not None and memo_record["size"] == file_stat.st_size and memo_record["mtime_ns"] == file_stat.st_mtime_ns:
+        file_hash = memo_record["hash"]
+    else:
+        file_hash = hash_file(file_path)
+    record = {
+        "size": file_stat.st_size,
+        "mtime_ns": file_stat.st_mtime_ns,
+        "hash": file_hash,
+    }
+    if hash_memo is not None:
+        hash_memo[file_path] = record
+    return record
+
+
+#returns (changed, stat_changed)
+    #changed: file_path's contents differ from record, or file_path is missing
+    #stat_changed: size or mtime_ns differ from record, record should be refreshed
+def file_changed(record, file_path):
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return True, True
+    if record is None:
+        return True, True
+    if file_stat.st_size == record["size"] and file_stat.st_mtime_ns == record["mtime_ns"]:
+        return False, False
+    if file_stat.st_size != record["size"]:
+        return True, True
+    return hash_file(file_path) != record["hash"], True
+
+
+class CacheManifest:
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.lock = threading.Lock() #add() is called from the cache writer thread
+        self.entries = {} #{json_file: entry}
+        self.hash_memo = {} #{file_path: {"size", "mtime_ns", "hash"}}, see file_record
+        self.needs_newline = False #last line partly written, next add() starts a new line
+        if os.path.exists(manifest_path):
+            self._load()
+
+    def _load(self):
+        with open(self.manifest_path, "r") as f:
+            for line in f:
+                self.needs_newline = not line.endswith("\n")
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError: #partly written last line, after a crash
+                    error_message = f"manifest: skipped unreadable line in {self.manifest_path}"
+                    print(error_message)
+                    logging.error(error_message)
+                    continue
+                self.entries[entry["json_file"]] = entry
+                for key in manifest_image_keys + manifest_caption_keys:
+                    if key in entry:
+                        self.hash_memo[entry[key]["path"]] = entry[key]
+
+    def __contains__(self, json_file):
+        return json_file in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, json_file):
+        return self.entries.get(json_file)
+
+    #records an item's files, metadata: the item's .metadata.json contents
+    #one os.write per line with O_APPEND: lines from several caching processes don't interleave
+    def add(self, json_file, metadata):
+        entry = {"json_file": json_file}
+        for key in manifest_image_keys + manifest_caption_keys:
+            if metadata.get(key) is None:
+                continue
+            entry[key] = {"path": metadata[key], **file_record(metadata[key], self.hash_memo)}
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            if self.needs_newline:
+                line = "\n" + line
+                self.needs_newline = False
+            fd = os.open(self.manifest_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
+            self.entries[json_file] = entry
+
+    #returns (changed_components, stat_changed)
+        #changed_components: None if json_file is not in the manifest, else set of "image" & "caption" needing re-encoding
+        #stat_changed: some file was touched without changing its contents, add() again to refresh
+    #image_file & caption_file: current source paths, a moved source counts as changed
+    def changed_components(self, json_file, image_file, caption_file):
+        entry = self.entries.get(json_file)
+        if entry is None:
+            return None, False
+
+        changed_components = set()
+        stat_changed = False
+        for component, keys in [("image", manifest_image_keys), ("caption", manifest_caption_keys)]:
+            for key in keys:
+                record = entry.get(key)
+                if record is None:
+                    continue
+                if (key == "image_file" and record["path"] != image_file) or (key == "caption_file" and record["path"] != caption_file):
+                    changed_components.add(component)
+                    break
+                changed, record_stat_changed = file_changed(record, record["path"])
+                stat_changed = stat_changed or record_stat_changed
+                if changed:
+                    changed_components.add(component)
+                    break
+        return changed_components, stat_changed
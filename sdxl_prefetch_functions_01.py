@@ -0,0 +1,95 @@
+#sdxl_prefetch_functions.py
+#BatchPrefetcher - keeps the next num_prefetch batches staged on the device while the current step runs:
+    #batches are taken from the dataloader on the training thread, same order, loading overlaps the gpu through DataLoader workers / fetch threads
+        #cuda: pins cpu tensors (if not pinned yet), non_blocking copies on a side stream, the main stream waits on an event
+        #cpu: batches are only queued
+    #data_wait_seconds: time the training thread spent getting & staging batches for the last step, ~0 = the step never stalls on data loading
+    #accelerate (requirements.txt pins accelerate==0.28.0): prepare the dataloader with device_placement=False, the prefetcher places batches
+        #prepared dataloaders set end_of_dataloader when they hand out their last batch, the prefetcher runs up to num_prefetch batches ahead
+        #so it sets the dataloader's end_of_dataloader attribute to the flag of the batch it yields, accumulate() syncs on the real last batch
+        #the dataloader isn't advanced past its last batch until that batch is yielded, it stays registered with the gradient state until then
+
+
+from collections import deque
+import time
+
+import torch
+
+
+class BatchPrefetcher:
+    def __init__(self, dataloader, device, num_prefetch=2):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.num_prefetch = max(1, num_prefetch)
+        self.data_wait_seconds = 0.0
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    #moves batch tensors to device, other values unchanged
+    def _to_device(self, batch):
+        if isinstance(batch, dict):
+            return {key: self._to_device(value) for key, value in batch.items()}
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(self._to_device(value) for value in batch)
+        if isinstance(batch, torch.Tensor):
+            if self.device.type == "cuda" and not batch.is_pinned():
+                batch = batch.pin_memory()
+            return batch.to(self.device, non_blocking=True)
+        return batch
+
+    #tensors made on the side stream are used on the main stream, keeps their memory from being reused early
+    def _record_stream(self, batch, stream):
+        if isinstance(batch, dict):
+            for value in batch.values():
+                self._record_stream(value, stream)
+        elif isinstance(batch, (list, tuple)):
+            for value in batch:
+                self._record_stream(value, stream)
+        elif isinstance(batch, torch.Tensor) and batch.device.type == "cuda":
+            batch.record_stream(stream)
+
+    def __iter__(self):
+        batches = iter(self.dataloader)
+        staged = deque() #(batch, event, end_of_dataloader)
+        copy_stream = torch.cuda.Stream(device=self.device) if self.device.type == "cuda" else None
+
+        #takes the next batch & starts its copy, False when the dataloader is done
+        #never past a batch flagged end_of_dataloader: the prepared dataloader would unregister from the gradient state
+        def stage():
+            if staged and staged[-1][2]:
+                return False
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return False
+            end_of_dataloader = getattr(self.dataloader, "end_of_dataloader", False)
+            event = None
+            if copy_stream is not None:
+                with torch.cuda.stream(copy_stream):
+                    batch = self._to_device(batch)
+                    event = torch.cuda.Event()
+                    event.record(copy_stream)
+            staged.append((batch, event, end_of_dataloader))
+            return True
+
+        start_time = time.perf_counter()
+        while len(staged) < self.num_prefetch and stage():
+            pass
+        while staged:
+            batch, event, end_of_dataloader = staged.popleft()
+            if event is not None:
+                stream = torch.cuda.current_stream(self.device)
+                stream.wait_event(event)
+                self._record_stream(batch, stream)
+            #the flag accumulate() reads, for this batch rather than the last one taken from the dataloader
+            if hasattr(self.dataloader, "end_of_dataloader"):
+                self.dataloader.end_of_dataloader = end_of_dataloader
+            self.data_wait_seconds = time.perf_counter() - start_time
+            yield batch
+            #refill after the step's kernels are queued, loading overlaps the gpu work
+            start_time = time.perf_counter()
+            while len(staged) < self.num_prefetch and stage():
+                pass
+        #lets a prepared dataloader finish its epoch & unregister from the gradient state
+        next(batches, None)
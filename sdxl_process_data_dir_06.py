@@ -4,6 +4,13 @@
 	#mirrors data_dir directory structure in cache_dir 
 	#per image-caption.txt pair creates needed cache files & json file:
 	#per data_dir, creates data_dir.txt: contains json_files list
+	#images in the same aspect bucket are vae encoded together: --vae_batch_size
+	#captions are tokenized & text encoded together: --caption_batch_size
+	#--recache_captions_only: re-encode captions of an existing cache, keeps latents
+	#--token_ids_only: captions cached as token ids only, no prompt embed files, for sdxl_train --encode_text_on_the_fly
+	#--num_preprocess_workers: image preprocessing in a process pool, overlapped with encoding & file writes
+	#multiple processes: accelerate launch --num_processes N, pairs are split across processes, one merged .list
+		#--cpu: cache on cpu processes, no gpu needed
 
 #upscale to resolution info:
 	#no upscale to resolution:
@@ -21,22 +28,16 @@ import logging
 import os
 
 from accelerate import Accelerator
+import torch
 
-from sdxl_data_functions_18 import data_dir_search, cache_image_caption_pair
+from sdxl_data_functions_18 import data_dir_search, cache_image_caption_pair, recache_captions, cached_dataset_list_path, merge_cached_dataset_lists
+from sdxl_scan_functions_01 import scan_cache_filename
 
 
 #welcome message
 print("\nprocess_data_dir: initializing")
 
 
-#initiate accelerator
-accelerator = Accelerator(
-	mixed_precision="fp16",
-)
-
-device = accelerator.device
-
-
 ##arguments
 parser = argparse.ArgumentParser()
 parser.add_argument("--basename", type=str, default="data", help="The name of the dataset folder: ie '/mnt/storage/comics/' basename would be 'comics'")
@@ -48,9 +49,35 @@ parser.add_argument("--min_resolution", type=int, default=512, help="maximum ima
 parser.add_argument("--upscale_to_resolution", type=int, help="upscale image to resolution for caching, use original_size parameter")
 parser.add_argument("--upscale_use_GFPGAN", action='store_true', help="after upscale image, use GFPGAN to fix face (use for photos only)")
 parser.add_argument("--save_upscale_samples", action='store_true', help="after upscale image, save_upscale_samples")
+parser.add_argument("--vae_batch_size", type=int, default=4, help="images per vae.encode batch, images are batched by aspect bucket")
+parser.add_argument("--caption_batch_size", type=int, default=32, help="captions per tokenize & text_encoder batch")
+parser.add_argument("--use_slow_tokenizer", action='store_true', help="use CLIPTokenizer instead of CLIPTokenizerFast")
+parser.add_argument("--storage_codec", type=str, default="raw", help="cached tensor format: raw, fp16, bf16 or int8, optionally +zstd or +lz4 (ie fp16+zstd), see sdxl_codec_functions")
+parser.add_argument("--no_caption_dedup", action='store_true', help="store prompt embeds per image, instead of once per unique caption in cache_dir/basename/caption_embeds")
+parser.add_argument("--num_preprocess_workers", type=int, default=4, help="processes for image open/resize/crop, overlapped with encoding & writing, 0 = serial")
+parser.add_argument("--preprocess_queue_size", type=int, help="max images being preprocessed ahead of the encoders, default: 4 * num_preprocess_workers")
+parser.add_argument("--token_ids_only", action='store_true', help="cache caption token ids only, no prompt embeds: train with --encode_text_on_the_fly")
+parser.add_argument("--recache_captions_only", action='store_true', help="re-encode captions of an already cached data_dir, keeps latents")
+parser.add_argument("--scan_workers", type=int, default=16, help="threads for data_dir listing & image header checks")
+parser.add_argument("--scan_full_decode", action='store_true', help="data_dir search decodes every image to catch truncated/corrupt files, slower")
+parser.add_argument("--no_scan_cache", action='store_true', help="re-scan all of data_dir, instead of only directories changed since the last scan")
+parser.add_argument("--cpu", action='store_true', help="cache on cpu without mixed precision, ie for testing or machines without gpus")
 args = parser.parse_args()
 
 
+#initiate accelerator
+#multiple processes (accelerate launch --num_processes N): image-caption pairs are split across processes
+	#fp16 mixed precision needs a gpu
+accelerator = Accelerator(
+	mixed_precision="no" if args.cpu or not torch.cuda.is_available() else "fp16",
+	cpu=args.cpu,
+)
+
+device = accelerator.device
+process_index = accelerator.process_index
+num_processes = accelerator.num_processes
+
+
 ##variables
 
 #dirs
@@ -67,6 +94,20 @@ min_resolution = args.min_resolution
 upscale_to_resolution = args.upscale_to_resolution
 save_upscale_samples = args.save_upscale_samples
 upscale_use_GFPGAN = args.upscale_use_GFPGAN
+#caching
+vae_batch_size = args.vae_batch_size
+caption_batch_size = args.caption_batch_size
+use_fast_tokenizer = not args.use_slow_tokenizer
+dedup_captions = not args.no_caption_dedup
+storage_codec = args.storage_codec
+cache_prompt_embeds = not args.token_ids_only
+recache_captions_only = args.recache_captions_only
+num_preprocess_workers = args.num_preprocess_workers
+preprocess_queue_size = args.preprocess_queue_size
+#data_dir search
+scan_workers = args.scan_workers
+scan_full_decode = args.scan_full_decode
+scan_cache_file = None if args.no_scan_cache else os.path.join(os.path.abspath(cache_dir), basename, scan_cache_filename)
 
 
 ##error logging
@@ -77,10 +118,42 @@ logging.basicConfig(
 )
 
 
+#data_dir's .list, multiple processes: each process writes a partial list, merged by main process
+json_file_paths_list_txt = cached_dataset_list_path(os.path.join(os.path.abspath(cache_dir), basename.lstrip('/')), os.path.abspath(data_dir))
+process_json_file_paths_list_txt = None
+if num_processes > 1:
+	process_json_file_paths_list_txt = f"{json_file_paths_list_txt}.{process_index}.part" #not .list, ignored by sdxl_train
+
+
+#recache_captions_only: re-encode captions listed in data_dir's .list, then exit
+if recache_captions_only:
+	print(f"recache_captions_only: {json_file_paths_list_txt}")
+	with open(json_file_paths_list_txt, "r") as f:
+		json_file_paths_list = [line.strip() for line in f if line.strip()]
+	recache_captions(
+		json_file_paths_list[process_index::num_processes],
+		pretrained_model_name_or_path,
+		accelerator,
+		device,
+		caption_batch_size=caption_batch_size,
+		use_fast_tokenizer=use_fast_tokenizer,
+		dedup_captions=dedup_captions,
+	)
+	exit()
+
+
 #search for image-caption.txt pairs the directory and subdirectories
 #input: data_dir 
 #return: image_caption_pair_file tuple list
-image_caption_files_tuple_list = data_dir_search(data_dir)
+#main process first: creates blank caption.txt files, then other processes find the same pairs
+with accelerator.main_process_first():
+	image_caption_files_tuple_list = data_dir_search(data_dir, scan_workers, scan_full_decode, scan_cache_file)
+
+#deterministic split across processes: sorted, then every num_processes-th pair
+image_caption_files_tuple_list.sort()
+image_caption_files_tuple_list = image_caption_files_tuple_list[process_index::num_processes]
+if num_processes > 1:
+	print(f"process {process_index}: caching {len(image_caption_files_tuple_list)} image-caption.txt pairs")
 
 
 ##preprocess images/caption, cache latents/hidden_encoder_states
@@ -100,5 +173,23 @@ json_file_paths_list = cache_image_caption_pair(
 	min_resolution,
 	upscale_to_resolution,
 	upscale_use_GFPGAN,
-	save_upscale_samples
+	save_upscale_samples,
+	vae_batch_size=vae_batch_size,
+	caption_batch_size=caption_batch_size,
+	use_fast_tokenizer=use_fast_tokenizer,
+	num_preprocess_workers=num_preprocess_workers,
+	preprocess_queue_size=preprocess_queue_size,
+	json_list_file=process_json_file_paths_list_txt,
+	dedup_captions=dedup_captions,
+	storage_codec=storage_codec,
+	cache_prompt_embeds=cache_prompt_embeds,
 )
+
+#merge partial lists into data_dir's .list
+if num_processes > 1:
+	accelerator.wait_for_everyone()
+	if accelerator.is_main_process:
+		partial_list_files = [f"{json_file_paths_list_txt}.{index}.part" for index in range(num_processes)]
+		json_file_paths_list = merge_cached_dataset_lists(partial_list_files, json_file_paths_list_txt)
+		print(f"\n{len(json_file_paths_list)} image-caption.txt pairs in {json_file_paths_list_txt}")
+	accelerator.wait_for_everyone()
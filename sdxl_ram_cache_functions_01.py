@@ -0,0 +1,68 @@
+#sdxl_ram_cache_functions.py
+#bounded in-RAM LRU cache of decoded cached tensors, used by CachedImageDataset (--dataset_ram_cache_gb):
+    #key: dataset index, value: (model_input, prompt_embed, pooled_prompt_embed) cpu tensors, before conditional dropout
+    #size: bytes of the tensors' storages, least recently used entries are evicted before an insert would exceed max_bytes
+        #evicted tensors are only referenced by the cache, dropped references free them right away
+    #thread safe: CachedImageDataset.__getitems__ loads a batch on several threads
+    #per process: every DataLoader worker has its own cache, workers are restarted each epoch unless persistent_workers
+    #hits & misses: returned per item, counted per batch by cached_batch_collate, logged by sdxl_train
+
+
+from collections import OrderedDict
+import threading
+
+
+#bytes held by a tensor, whole storage: a view keeps its full storage alive
+def tensor_storage_nbytes(tensor):
+    return tensor.untyped_storage().nbytes()
+
+
+class TensorLRUCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.entries = OrderedDict() #index: (tensors, nbytes), least recently used first
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    #locks can't be pickled, entries aren't sent to DataLoader workers
+    def __getstate__(self):
+        return {"max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state["max_bytes"])
+
+    #returns cached tensors, None on a miss
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    #membership only, no hit/miss count & LRU order unchanged, used by read-ahead
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    #entries larger than max_bytes are not cached, None entries (tensors not loaded) take no space
+    def put(self, key, tensors):
+        nbytes = sum(tensor_storage_nbytes(tensor) for tensor in tensors if tensor is not None)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            while self.entries and self.num_bytes + nbytes > self.max_bytes:
+                self.num_bytes -= self.entries.popitem(last=False)[1][1]
+            self.entries[key] = (tuple(tensors), nbytes)
+            self.num_bytes += nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
@@ -0,0 +1,133 @@
+#sdxl_readahead_functions.py
+#ReadAheadService - asks the OS for the files of upcoming batches before the dataset reads them (--readahead_batches):
+    #BucketBatchSampler knows the whole epoch's batch order, start() gets it, advance() is called at every yielded batch
+        #the next depth batches of this rank are requested on background threads, cold reads overlap training
+        #rank filter: prepared dataloaders give rank r the yielded batches at positions i % num_processes == r
+    #what to read: dataset._readahead_ranges(index, dropped) -> [(path, offset, length)], length 0 = whole file
+        #CachedImageDataset: model_input file + prompt embed files, dropped items skip their prompt embed files
+        #PackedShardDataset: the item's range of its shard file, BucketMemmapDataset: the item's row of each bucket array
+    #mode:
+        #fadvise: posix_fadvise(WILLNEED), the kernel starts reading the range into the page cache & returns
+        #read: ranges are read on the threads & discarded, page cache filled for filesystems that ignore fadvise (some NFS/FUSE)
+    #adaptive depth: update(fetch_seconds) once per training step, fetch_seconds from cached_batch_collate
+        #fetch time > 10% of the step time: batches are still read cold, depth doubles up to max_depth
+        #fetch time < 2% of the step time: depth shrinks by 1 down to min_depth, less page cache held for upcoming batches
+        #at most one change per depth steps, the batches requested before a change are fetched first
+    #page cache only: no tensors are held, nothing to keep in sync with DataLoader workers
+
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import threading
+import time
+
+
+readahead_modes = ["fadvise", "read"]
+readahead_chunk_bytes = 1024 ** 2
+
+
+class ReadAheadService:
+    def __init__(self, dataset, depth=4, max_depth=32, num_threads=8, mode="fadvise", process_index=0, num_processes=1):
+        if mode not in readahead_modes:
+            raise ValueError(f"unknown read-ahead mode: {mode}, use one of {readahead_modes}")
+        self.dataset = dataset
+        self.min_depth = max(1, depth)
+        self.max_depth = max(self.min_depth, max_depth)
+        self.depth = self.min_depth
+        self.mode = mode
+        self.process_index = process_index
+        self.num_processes = num_processes
+        self.executor = ThreadPoolExecutor(max_workers=max(1, num_threads))
+        self.lock = threading.Lock()
+        self.batches = [] #current epoch's yielded batches, [(index, dropped), ...] each
+        self.position = -1 #last batch yielded by the sampler
+        self.requested = -1 #last batch position requested
+        #adaptive depth
+        self.fetch_seconds = None #moving averages
+        self.step_seconds = None
+        self.last_update_time = None
+        self.steps_since_change = 0
+        self.warned = False
+
+    #new epoch, batches: every batch the sampler will yield, in order
+    def start(self, batches):
+        with self.lock:
+            self.batches = batches
+            self.position = -1
+            self.requested = -1
+
+    #the sampler yields batch position, requests this rank's batches up to depth ahead
+    def advance(self, position):
+        with self.lock:
+            self.position = position
+            last = min(len(self.batches) - 1, position + self.depth * self.num_processes)
+            first = max(self.requested + 1, position)
+            self.requested = max(self.requested, last)
+            batches = self.batches
+        for j in range(first, last + 1):
+            if j % self.num_processes == self.process_index:
+                self.executor.submit(self._read_batch, batches, j)
+
+    def _read_batch(self, batches, position):
+        #already taken by the dataloader or a new epoch started, too late to help
+        if batches is not self.batches or position < self.position:
+            return
+        try:
+            for index, dropped in batches[position]:
+                for path, offset, length in self.dataset._readahead_ranges(index, dropped):
+                    self._read_range(path, offset, length)
+        except Exception as e: #read-ahead is only a hint, the dataset reports real read errors
+            if not self.warned:
+                self.warned = True
+                error_message = f"read-ahead: Error: {e}, batch {position} skipped"
+                print(error_message)
+                logging.error(error_message)
+
+    def _read_range(self, path, offset, length):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if self.mode == "fadvise":
+                try:
+                    os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+                    return
+                except AttributeError: #no posix_fadvise on this platform, read instead
+                    self.mode = "read"
+            end = offset + length if length > 0 else os.fstat(fd).st_size
+            while offset < end:
+                data = os.pread(fd, min(readahead_chunk_bytes, end - offset), offset)
+                if not data:
+                    break
+                offset += len(data)
+        finally:
+            os.close(fd)
+
+    #once per training step, fetch_seconds of the step's batch
+    def update(self, fetch_seconds):
+        now = time.perf_counter()
+        if self.last_update_time is None:
+            self.last_update_time = now
+            return
+        step_seconds = now - self.last_update_time
+        self.last_update_time = now
+        if self.fetch_seconds is None:
+            self.fetch_seconds, self.step_seconds = fetch_seconds, step_seconds
+        else:
+            self.fetch_seconds = 0.9 * self.fetch_seconds + 0.1 * fetch_seconds
+            self.step_seconds = 0.9 * self.step_seconds + 0.1 * step_seconds
+
+        self.steps_since_change += 1
+        if self.steps_since_change < self.depth:
+            return
+        with self.lock:
+            if self.fetch_seconds > 0.1 * self.step_seconds and self.depth < self.max_depth:
+                self.depth = min(self.max_depth, self.depth * 2)
+                self.steps_since_change = 0
+            elif self.fetch_seconds < 0.02 * self.step_seconds and self.depth > self.min_depth:
+                self.depth -= 1
+                self.steps_since_change = 0
+
+    def close(self):
+        with self.lock:
+            self.batches = []
+        self.executor.shutdown(wait=True, cancel_futures=True)
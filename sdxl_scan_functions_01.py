@@ -0,0 +1,162 @@
+#sdxl_scan_functions.py
+#parallel data_dir scanner with a persistent scan cache, used by data_dir_search:
+    #directories: os.scandir, one thread pool level per directory depth
+    #images: header probe (Image.open) in the thread pool, full_decode=True also decodes pixels to catch truncated files
+    #scan cache: json file, {dir_path: entry}, entry: directory mtime_ns, ok images, failed images & subdirs
+        #unchanged directory mtime: entry reused, no listing & no probing
+        #changed directory: re-listed, images already probed ok are kept, new & failed images are probed
+        #directory mtime changes when files are added, removed or renamed, not when a file is rewritten in place
+            #rewritten files are caught when caching, see sdxl_manifest_functions
+    #caption.txt: matched by name from the directory listing, missing captions are created blank
+
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+
+from PIL import Image
+
+
+scan_cache_filename = "scan_cache.json"
+scan_cache_version = 1
+
+
+#returns {dir_path: entry}, empty if scan_cache_file is missing or was made with different settings
+def load_scan_cache(scan_cache_file, image_ext, full_decode):
+    if scan_cache_file is None or not os.path.exists(scan_cache_file):
+        return {}
+    try:
+        with open(scan_cache_file, "r") as f:
+            scan_cache = json.load(f)
+    except Exception as e:
+        error_message = f"scan cache: Error: {e}, for {scan_cache_file}, re-scanning"
+        print(error_message)
+        logging.error(error_message)
+        return {}
+    #full_decode scan cache also valid for header probe scans
+    if scan_cache.get("version") != scan_cache_version or scan_cache.get("image_ext") != image_ext or (full_decode and not scan_cache.get("full_decode")):
+        return {}
+    return scan_cache["dirs"]
+
+
+#temp file + os.replace: several caching processes may scan the same data_dir
+def save_scan_cache(scan_cache_file, dirs, image_ext, full_decode):
+    os.makedirs(os.path.dirname(scan_cache_file), exist_ok=True)
+    temp_file = f"{scan_cache_file}.{os.getpid()}.tmp"
+    with open(temp_file, "w") as f:
+        json.dump({"version": scan_cache_version, "image_ext": image_ext, "full_decode": full_decode, "dirs": dirs}, f)
+    os.replace(temp_file, scan_cache_file)
+
+
+#returns (entry, caption_names, listed)
+    #listed: False if cached_entry was reused, caption_names is None then
+def list_directory(dir_path, cached_entry, image_ext):
+    try:
+        mtime_ns = os.stat(dir_path).st_mtime_ns
+        if cached_entry is not None and cached_entry["mtime_ns"] == mtime_ns:
+            return cached_entry, None, False
+
+        image_names = []
+        caption_names = set()
+        subdirs = []
+        with os.scandir(dir_path) as dir_entries:
+            for dir_entry in dir_entries:
+                if dir_entry.is_dir(follow_symlinks=False): #same as os.walk
+                    subdirs.append(dir_entry.name)
+                elif os.path.splitext(dir_entry.name)[1].lower() in image_ext:
+                    image_names.append(dir_entry.name)
+                elif dir_entry.name[-4:] == ".txt":
+                    caption_names.add(dir_entry.name)
+    except OSError as e:
+        error_message = f"Error: {e}, for {dir_path}"
+        print(error_message)
+        logging.error(error_message)
+        return {"mtime_ns": None, "images": [], "failed": [], "subdirs": []}, set(), True
+
+    #images already probed ok are kept, only new & failed images are probed
+    image_names.sort()
+    known_images = set(cached_entry["images"]) if cached_entry is not None else set()
+    entry = {
+        "mtime_ns": mtime_ns,
+        "images": [name for name in image_names if name in known_images],
+        "failed": [name for name in image_names if name not in known_images],
+        "subdirs": sorted(subdirs),
+    }
+    return entry, caption_names, True
+
+
+#returns error message, None if image_file is ok
+def probe_image(image_file, full_decode=False):
+    try:
+        with Image.open(image_file) as image:
+            if full_decode:
+                image.load()
+    except Exception as e:
+        return f"Error: {e}, for {image_file}"
+    return None
+
+
+#scans data_dir & subdirectories for image-caption.txt pairs
+#returns sorted image_caption_pair_file tuple list
+def scan_data_dir(data_dir, image_ext, num_workers=16, full_decode=False, scan_cache_file=None):
+    cached_dirs = load_scan_cache(scan_cache_file, image_ext, full_decode)
+    dirs = {} #{dir_path: entry}
+    image_caption_files_tuple_list = []
+    num_listed = 0
+    num_probed = 0
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        dir_paths = [data_dir]
+        while len(dir_paths) > 0:
+            list_results = executor.map(lambda dir_path: list_directory(dir_path, cached_dirs.get(dir_path), image_ext), dir_paths)
+            next_dir_paths = []
+            listed_dirs = [] #[(dir_path, entry, caption_names)]
+            for dir_path, (entry, caption_names, listed) in zip(dir_paths, list_results):
+                next_dir_paths += [os.path.join(dir_path, subdir) for subdir in entry["subdirs"]]
+                dirs[dir_path] = entry
+                if listed:
+                    listed_dirs.append((dir_path, entry, caption_names))
+            num_listed += len(listed_dirs)
+
+            #probe new & failed images, all listed dirs of this depth together
+            probe_items = [(entry, name) for dir_path, entry, caption_names in listed_dirs for name in entry["failed"]]
+            probe_files = [os.path.join(dir_path, name) for dir_path, entry, caption_names in listed_dirs for name in entry["failed"]]
+            for dir_path, entry, caption_names in listed_dirs:
+                entry["failed"] = []
+            for (entry, name), error_message in zip(probe_items, executor.map(probe_image, probe_files, [full_decode] * len(probe_files))):
+                num_probed += 1
+                if error_message is not None:
+                    print(error_message)
+                    logging.error(error_message)
+                    entry["failed"].append(name)
+                    continue
+                entry["images"].append(name)
+
+            #missing caption.txt: dummy caption_file, caption_string = ""
+            for dir_path, entry, caption_names in listed_dirs:
+                entry["images"].sort()
+                for name in entry["images"]:
+                    caption_name = os.path.splitext(name)[0] + ".txt"
+                    if caption_name not in caption_names:
+                        caption_file = os.path.join(dir_path, caption_name)
+                        if not os.path.exists(caption_file):
+                            with open(caption_file, "w") as f:
+                                pass
+                            error_message = f"No caption.txt for {os.path.join(dir_path, name)}"
+                            print(f"created blank: {caption_file}, caption_string = \"\" [empty]")
+                            print(error_message)
+                            logging.error(error_message)
+            dir_paths = next_dir_paths
+            print(f"\r{len(dirs)} dirs, {num_listed} listed, {num_probed} images probed", end="")
+
+    for dir_path, entry in dirs.items():
+        for name in entry["images"]:
+            image_file = os.path.join(dir_path, name)
+            image_caption_files_tuple_list.append((image_file, os.path.splitext(image_file)[0] + ".txt"))
+    image_caption_files_tuple_list.sort()
+
+    if scan_cache_file is not None:
+        save_scan_cache(scan_cache_file, dirs, image_ext, full_decode)
+    print(f"\n  --{len(dirs) - num_listed} of {len(dirs)} dirs unchanged since last scan")
+    return image_caption_files_tuple_list
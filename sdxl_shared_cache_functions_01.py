@@ -0,0 +1,229 @@
+#sdxl_shared_cache_functions.py
+#node-shared dataset cache, one copy of the cached tensors per node instead of one per rank (--node_shared_cache):
+    #cached tensors + empty prompt embeds are written once to packed shards in a ram disk dir (default /dev/shm)
+        #first local rank to take the lock fills it, the others wait on the lock, then all read it
+    #datasets are PackedShardDataset on the shared dir: zero-copy mmap views, tmpfs pages shared by all ranks
+    #cache dir name: hash of the json_file list & their mtimes, a changed cached dataset gets a new dir
+        #node_shared_cache_key: computed once on the main process & broadcast, not one stat per item on every rank
+    #reference counting: pids using the cache are listed in refs.json, protected by flock
+        #release() removes own pid, the last process removes the cache dir
+        #pids of crashed processes are dropped on the next acquire/release
+        #the empty .lock file is kept, removing it could split waiting processes onto different locks
+    #not enough free space in the ram disk: cache is not built, open() returns False, use the normal dataset
+        #size: decoded bytes of one item per (closest_bucket, storage_codec) times the bucket's item count
+        #the ram disk still fills up while packing (other users): temp dir removed, open() returns False
+
+
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import torch
+
+from sdxl_cache_format_functions_01 import PackedShardDataset, PackedShardWriter, load_packed_index, packed_index_filename, torch_dtypes
+from sdxl_codec_functions_01 import load_tensor
+
+
+node_shared_cache_root = "/dev/shm/sdxl_dataset_cache"
+node_shared_refs_filename = "refs.json"
+empty_embeds_key = "__empty_prompt_embeds__"
+
+
+#True if process pid is running
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+#cache id: json_file paths & mtimes, stats on num_workers threads
+#call on one process & broadcast the key (sdxl_train: main process, broadcast_object_list)
+def node_shared_cache_key(json_file_paths_list, num_workers=16):
+    json_file_paths = sorted(set(json_file_paths_list))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        mtimes = list(executor.map(lambda json_file: os.stat(json_file).st_mtime_ns, json_file_paths))
+    cache_hash = hashlib.blake2b(digest_size=16)
+    for json_file, mtime_ns in zip(json_file_paths, mtimes):
+        cache_hash.update(f"{json_file}\0{mtime_ns}\n".encode())
+    return cache_hash.hexdigest()
+
+
+class NodeSharedCache:
+    #json_file_paths_list: every cached item any dataset of this run uses (train + validation)
+    #metadata_lookup: optional {json_file: metadata} from catalog
+    #cache_key: node_shared_cache_key of json_file_paths_list, None = computed here
+    def __init__(self, json_file_paths_list, metadata_lookup=None, cache_root=node_shared_cache_root, shard_size_gb=4.0, num_workers=16, cache_key=None):
+        self.json_file_paths = sorted(set(json_file_paths_list))
+        self.metadata_lookup = metadata_lookup
+        self.shard_size_gb = shard_size_gb
+        self.num_workers = num_workers
+
+        if cache_key is None:
+            cache_key = node_shared_cache_key(self.json_file_paths, num_workers)
+        self.cache_dir = os.path.join(cache_root, cache_key)
+        self.lock_file = self.cache_dir + ".lock"
+        self.acquired = False
+
+    #runs fn() while holding the cache's exclusive flock
+    def _locked(self, fn):
+        os.makedirs(os.path.dirname(self.lock_file), exist_ok=True)
+        with open(self.lock_file, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return fn()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_refs(self):
+        refs_file = os.path.join(self.cache_dir, node_shared_refs_filename)
+        if not os.path.exists(refs_file):
+            return []
+        with open(refs_file, "r") as f:
+            return [pid for pid in json.load(f) if pid_alive(pid)]
+
+    def _write_refs(self, refs):
+        refs_file = os.path.join(self.cache_dir, node_shared_refs_filename)
+        with open(refs_file + ".tmp", "w") as f:
+            json.dump(refs, f)
+        os.replace(refs_file + ".tmp", refs_file)
+
+    #returns metadata of json_file, from catalog if available
+    def _metadata(self, json_file):
+        if self.metadata_lookup is not None and json_file in self.metadata_lookup:
+            return self.metadata_lookup[json_file]
+        with open(json_file, "r") as f:
+            return json.load(f)
+
+    #returns (metadata, {name: cpu tensor})
+    def _load_item(self, json_file):
+        metadata = self._metadata(json_file)
+        storage_codec = metadata.get("storage_codec") or "raw"
+        tensors = {name: load_tensor(metadata[f"{name}_file"], storage_codec, map_location="cpu") for name in ["model_input", "prompt_embed", "pooled_prompt_embed"]}
+        return metadata, tensors
+
+    #decoded bytes of all items: tensor shapes & dtypes are set by closest_bucket & storage_codec
+        #one item per (closest_bucket, storage_codec) is loaded, times the number of items with it
+    def _estimate_bytes(self):
+        groups = {}
+        for json_file in self.json_file_paths:
+            metadata = self._metadata(json_file)
+            groups.setdefault((tuple(metadata["closest_bucket"]), metadata.get("storage_codec") or "raw"), []).append(json_file)
+        needed_bytes = 0
+        for json_files in groups.values():
+            for json_file in json_files:
+                try:
+                    metadata, tensors = self._load_item(json_file)
+                except Exception: #unreadable items are reported & skipped by _build, try the next one
+                    continue
+                item_bytes = sum(tensor.element_size() * tensor.nelement() for tensor in tensors.values())
+                needed_bytes += item_bytes * len(json_files)
+                break
+        return int(needed_bytes * 1.1)
+
+    #packs all items into the cache dir, temp dir + rename: an incomplete cache is never used
+    def _build(self):
+        cache_root = os.path.dirname(self.cache_dir)
+        needed_bytes = self._estimate_bytes()
+        free_bytes = shutil.disk_usage(cache_root).free
+        if needed_bytes > free_bytes:
+            error_message = f"node shared cache: needs ~{needed_bytes / 1024 ** 3:.1f} GB, {free_bytes / 1024 ** 3:.1f} GB free in {cache_root}, not used"
+            print(error_message)
+            logging.error(error_message)
+            return False
+
+        print(f"node shared cache: packing {len(self.json_file_paths)} cached items to {self.cache_dir}")
+        #temp dirs of crashed builds & a partly removed cache dir, no other build of this cache runs while the lock is held
+        for temp_dir in glob.glob(f"{self.cache_dir}.*.tmp"):
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        temp_dir = f"{self.cache_dir}.{os.getpid()}.tmp"
+        count = 0
+        try:
+            writer = PackedShardWriter(temp_dir, self.shard_size_gb)
+            #empty prompt embeds for conditional dropout, shared as well
+            writer.add(empty_embeds_key, {
+                "prompt_embed": load_tensor("empty.prompt_embed.pkl", map_location="cpu"),
+                "pooled_prompt_embed": load_tensor("empty.pooled_prompt_embed.pkl", map_location="cpu"),
+            }, {})
+            with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+                #bounded window: only num_workers * 4 items decoded at once
+                window = self.num_workers * 4
+                for start in range(0, len(self.json_file_paths), window):
+                    json_files = self.json_file_paths[start:start + window]
+                    for json_file, future in zip(json_files, [executor.submit(self._load_item, json_file) for json_file in json_files]):
+                        try:
+                            metadata, tensors = future.result()
+                        except Exception as e:
+                            error_message = f"node shared cache: Error: {e}, for {json_file}"
+                            print(error_message)
+                            logging.error(error_message)
+                            continue
+                        writer.add(json_file, tensors, metadata)
+                        count += 1
+                    print(f"\r[{count}/{len(self.json_file_paths)}]", end="")
+            writer.close()
+            os.replace(temp_dir, self.cache_dir)
+        except OSError as e: #ram disk full while packing
+            writer = None #drops the open shard file, its pages are freed with the temp dir
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            error_message = f"node shared cache: Error: {e}, after {count} items in {cache_root}, not used"
+            print(f"\n{error_message}")
+            logging.error(error_message)
+            return False
+        print(f"\n  --{count} items packed into {len(writer.shards)} shards")
+        return True
+
+    #builds the cache if needed & adds this process to refs, returns False if the cache can't be used
+    def open(self):
+        def acquire():
+            if not os.path.exists(os.path.join(self.cache_dir, packed_index_filename)):
+                if not self._build():
+                    return False
+            refs = self._read_refs()
+            if os.getpid() not in refs:
+                refs.append(os.getpid())
+            self._write_refs(refs)
+            return True
+        self.acquired = self._locked(acquire)
+        return self.acquired
+
+    #PackedShardDataset on the shared cache, same item order as json_file_paths_list
+    def dataset(self, json_file_paths_list, conditional_dropout_percent=0.1, fetch_threads=8):
+        dataset = PackedShardDataset(self.cache_dir, json_file_paths_list, conditional_dropout_percent, fetch_threads=fetch_threads)
+        #replace the per process empty prompt embeds with views of the shared copy
+        empty_item = next(item for item in load_packed_index(self.cache_dir) if item["key"] == empty_embeds_key)
+        shard_map = dataset._shard_map(empty_item["shard_path"])
+        empty_embeds = []
+        for name in ["prompt_embed", "pooled_prompt_embed"]:
+            layout = empty_item["tensors"][name]
+            count = 1
+            for dim in layout["shape"]:
+                count *= dim
+            tensor = torch.frombuffer(shard_map, dtype=torch_dtypes[layout["dtype"]], count=count, offset=empty_item["offset"] + layout["offset"])
+            empty_embeds.append(tensor.view(layout["shape"]))
+        dataset.empty_prompt_embed, dataset.empty_pooled_prompt_embed = empty_embeds
+        return dataset
+
+    #removes this process from refs, the last process removes the cache dir
+    #call before accelerator.end_training(), datasets of this cache must not be used after
+    def release(self):
+        if not self.acquired:
+            return
+        def remove_ref():
+            refs = [pid for pid in self._read_refs() if pid != os.getpid()]
+            if len(refs) == 0:
+                shutil.rmtree(self.cache_dir, ignore_errors=True)
+                print(f"node shared cache: removed {self.cache_dir}")
+            else:
+                self._write_refs(refs)
+        self._locked(remove_ref)
+        self.acquired = False
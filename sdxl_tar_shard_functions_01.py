@@ -0,0 +1,389 @@
+#sdxl_tar_shard_functions.py
+#streaming tar shard cache format, for cached datasets kept on bulk storage (HDD, NFS) or larger than local disk:
+    #convert_cached_dataset_to_tar_shards - packs a cached dataset into sequential WebDataset-style tar shards
+        #one aspect bucket per shard, items shuffled within their bucket (seeded) before writing
+        #sample members, back to back: {sample_id}.json (metadata & tensor dtypes), {sample_id}.{name}.npy per cached tensor
+    #TarShardIterableDataset - streams tar shards front to back, yields same-bucket batches of CachedImageDataset items
+        #shard-level shuffling: shard order drawn per epoch from (seed, epoch)
+        #per rank shard assignment: shards dealt to ranks (& DataLoader workers) balanced by item count, each rank reads only its shards
+        #open_shards shards are read at once, next sample from a random one: batches of different buckets interleave
+        #per-bucket shuffle buffer: samples wait in their bucket's buffer, a random one joins the bucket's batch when the buffer is full
+        #equal batches on every rank: batches per epoch = min over ranks & workers, computed from the index, no communication
+            #FSDP ranks must run the same number of steps, the rest of a longer stream's items are left for other epochs
+        #conditional dropout: drawn per batch from (seed, epoch, stream), dropped items don't decode their prompt embeds
+        #set_epoch / state_dict / load_state_dict: same as BucketBatchSampler, resume skips the batches already trained
+            #skipped batches are still read, tar shards are streamed, not seeked
+            #num_workers > 1: the DataLoader restarts its worker round robin at worker 0, resume skips whole rounds
+                #the rest of a partly trained round (< num_workers batches per rank) is dropped, later batches keep their order
+        #DataLoader: batch_size=None, collate_fn=cached_batch_collate, num_workers must match the dataset's num_workers
+            #no persistent_workers: workers get the epoch when they are started
+            #not prepared by accelerate: ranks already read disjoint shards, BatchPrefetcher places batches on the device
+            #sdxl_train uses accelerate's DataLoaderShard (no sharding, no device), accumulate() sees the epoch's last batch
+#tar shard dir layout:
+    #bucket_{width}x{height}_{n:05d}.tar : samples of one bucket
+    #tar_shard_index.json : shard files, bucket & sample keys (json_file path of the original cache), written last
+
+
+from collections import defaultdict, deque
+import io
+import json
+import logging
+import os
+import tarfile
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from sdxl_cache_format_functions_01 import cached_tensor_names, packed_metadata_keys, tensor_to_numpy
+from sdxl_codec_functions_01 import load_tensor
+
+
+tar_shard_index_filename = "tar_shard_index.json"
+#bytes tarfile reads at once, large sequential reads for HDD/NFS
+tar_read_bufsize = 4 * 1024 ** 2
+
+
+#adds a file member to an open tar
+def add_tar_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+
+
+#tensor -> .npy bytes, bfloat16 stored as int16, its dtype is kept in the sample's .json
+def tensor_to_npy_bytes(tensor):
+    f = io.BytesIO()
+    np.save(f, tensor_to_numpy(tensor), allow_pickle=False)
+    return f.getvalue()
+
+
+#.npy bytes -> tensor, writable data is used in place, no copy
+def tensor_from_npy_bytes(data, dtype_name):
+    stream = io.BytesIO(data)
+    version = np.lib.format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+    array = np.frombuffer(data, dtype=dtype, offset=stream.tell()).reshape(shape, order="F" if fortran_order else "C")
+    tensor = torch.from_numpy(array)
+    if dtype_name == "torch.bfloat16":
+        tensor = tensor.view(torch.bfloat16)
+    return tensor
+
+
+#converts existing cached dataset (.metadata.json + .pkl files) to tar shards, one bucket per shard
+#input: json_file_paths_list, output: tar_dir
+#returns (items written, items that failed), sdxl_convert_cache_format fails the run if any item failed
+def convert_cached_dataset_to_tar_shards(json_file_paths_list, tar_dir, shard_size_gb=1.0, seed=123):
+    print(f"\nconverting {len(json_file_paths_list)} cached items to tar shards")
+    print(f"  tar_dir: {tar_dir}")
+    os.makedirs(tar_dir, exist_ok=True)
+    max_shard_bytes = int(shard_size_gb * 1024 ** 3)
+
+    #first pass: group items by bucket
+    bucket_items = {}
+    num_failed = 0
+    for json_file in json_file_paths_list:
+        try:
+            with open(json_file, "r") as f:
+                metadata = json.load(f)
+        except Exception as e:
+            error_message = f"Error: {e}, for {json_file}"
+            print(error_message)
+            logging.error(error_message)
+            num_failed += 1
+            continue
+        bucket_items.setdefault(tuple(metadata["closest_bucket"]), []).append((json_file, metadata))
+
+    #second pass: write each bucket's items in shuffled order
+    rng = np.random.default_rng(seed)
+    shards = []
+    count = 0
+    for closest_bucket, items in sorted(bucket_items.items()):
+        tar = None
+        for item_index in rng.permutation(len(items)):
+            json_file, metadata = items[item_index]
+            try:
+                storage_codec = metadata.get("storage_codec") or "raw"
+                tensors = {name: load_tensor(metadata[f"{name}_file"], storage_codec, map_location="cpu") for name in cached_tensor_names}
+            except Exception as e:
+                error_message = f"Error: {e}, for {json_file}"
+                print(error_message)
+                logging.error(error_message)
+                num_failed += 1
+                continue
+
+            sample_metadata = {"key": json_file}
+            sample_metadata.update({k: metadata[k] for k in packed_metadata_keys if k in metadata})
+            sample_metadata["dtypes"] = {name: str(tensor.dtype) for name, tensor in tensors.items()}
+            members = [("json", json.dumps(sample_metadata).encode())]
+            members += [(f"{name}.npy", tensor_to_npy_bytes(tensor)) for name, tensor in tensors.items()]
+
+            #start new shard if needed, a sample never spans 2 shards
+            sample_bytes = sum(len(data) for _, data in members)
+            if tar is None or (shard_bytes > 0 and shard_bytes + sample_bytes > max_shard_bytes):
+                if tar is not None:
+                    tar.close()
+                shard_name = f"bucket_{closest_bucket[0]}x{closest_bucket[1]}_{sum(1 for shard in shards if shard['closest_bucket'] == list(closest_bucket)):05d}.tar"
+                tar = tarfile.open(os.path.join(tar_dir, shard_name), "w", format=tarfile.PAX_FORMAT)
+                shards.append({"file": shard_name, "closest_bucket": list(closest_bucket), "keys": []})
+                shard_bytes = 0
+
+            #sample_id: position in the shard, no dots, json first so readers see the metadata before the tensors
+            sample_id = f"{len(shards[-1]['keys']):08d}"
+            for suffix, data in members:
+                add_tar_member(tar, f"{sample_id}.{suffix}", data)
+            shard_bytes += sample_bytes
+            shards[-1]["keys"].append(json_file)
+            count += 1
+            print(f"\r[{count}]: {json_file[-60:]}", end="")
+        if tar is not None:
+            tar.close()
+
+    #write index last, a tar dir without index is incomplete
+    index_path = os.path.join(tar_dir, tar_shard_index_filename)
+    with open(index_path + ".tmp", "w") as f:
+        json.dump({"shards": shards}, f)
+    os.replace(index_path + ".tmp", index_path)
+
+    print(f"\n{count} items written to {len(shards)} tar shards, {num_failed} failed")
+    return count, num_failed
+
+
+#reads tar_shard_index.json, returns list of shards with absolute paths
+def load_tar_shard_index(tar_dir):
+    with open(os.path.join(tar_dir, tar_shard_index_filename), "r") as f:
+        index = json.load(f)
+    for shard in index["shards"]:
+        shard["path"] = os.path.join(tar_dir, shard["file"])
+    return index["shards"]
+
+
+##input: tar shard dir(s) -> output: batches of the same items as CachedImageDataset, one bucket per batch
+#json_file_paths_list: optional, selects items by their original json_file path, others are skipped while streaming
+#process_index, num_processes: this rank, num_workers: DataLoader workers per rank
+#shuffle_buffer: samples held per bucket before one is taken at random, open_shards: shards read at once
+class TarShardIterableDataset(IterableDataset):
+    def __init__(self, tar_dirs, batch_size, json_file_paths_list=None, conditional_dropout_percent=0.1, seed=123, process_index=0, num_processes=1, num_workers=0, shuffle_buffer=64, open_shards=4):
+        if isinstance(tar_dirs, str):
+            tar_dirs = [tar_dirs]
+        self.batch_size = batch_size
+        self.conditional_dropout_percent = conditional_dropout_percent
+        self.seed = seed
+        self.process_index = process_index
+        self.num_processes = num_processes
+        self.num_workers = max(1, num_workers)
+        self.shuffle_buffer = max(1, shuffle_buffer)
+        self.open_shards = max(1, open_shards)
+        self.epoch = 0
+        #resume: batches of resume_epoch already trained, summed over all ranks, set by load_state_dict
+        self.resume_epoch = None
+        self.resume_num_batches = 0
+
+        #combine indexes
+        self.shards = []
+        for tar_dir in tar_dirs:
+            self.shards += load_tar_shard_index(tar_dir)
+
+        #select items
+        if json_file_paths_list is None:
+            self.keys = None
+            self.num_items = sum(len(shard["keys"]) for shard in self.shards)
+        else:
+            self.keys = set(json_file_paths_list)
+            found_keys = set(key for shard in self.shards for key in shard["keys"] if key in self.keys)
+            for json_file in json_file_paths_list:
+                if json_file not in found_keys:
+                    error_message = f"TarShardIterableDataset: {json_file} not found in tar shards, skipped"
+                    print(error_message)
+                    logging.error(error_message)
+            self.num_items = len(found_keys)
+        #selected items per shard
+        self.shard_counts = [len(shard["keys"]) if self.keys is None else sum(1 for key in shard["keys"] if key in self.keys) for shard in self.shards]
+        num_streams = self.num_processes * self.num_workers
+        #a stream without shards has 0 batches, every rank would run 0 steps per epoch
+        if len(self.shards) < num_streams:
+            error_message = f"TarShardIterableDataset: {len(self.shards)} shards for {num_streams} ranks * workers, every stream needs a shard, re-export with a smaller shard_size_gb"
+            logging.error(error_message)
+            raise ValueError(error_message)
+
+        #cpu: same empty prompt embeds as CachedImageDataset
+        self.empty_prompt_embed = load_tensor("empty.prompt_embed.pkl", map_location="cpu")
+        self.empty_pooled_prompt_embed = load_tensor("empty.pooled_prompt_embed.pkl", map_location="cpu")
+
+    #selected items, as len(CachedImageDataset), see num_batches for the batches of an epoch
+    def __len__(self):
+        return self.num_items
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    #returns (shards per stream, batches per stream) of an epoch, stream = process_index * num_workers + worker id
+    #same result on every rank & worker: shuffled from (seed, epoch), each shard to the stream with the fewest items so far
+    def _epoch_plan(self, epoch):
+        num_streams = self.num_processes * self.num_workers
+        stream_shards = [[] for _ in range(num_streams)]
+        stream_items = np.zeros(num_streams, dtype=np.int64)
+        bucket_items = [defaultdict(int) for _ in range(num_streams)]
+        for shard_index in np.random.default_rng([self.seed, epoch]).permutation(len(self.shards)):
+            stream = int(np.argmin(stream_items))
+            stream_shards[stream].append(self.shards[shard_index])
+            stream_items[stream] += self.shard_counts[shard_index]
+            bucket_items[stream][tuple(self.shards[shard_index]["closest_bucket"])] += self.shard_counts[shard_index]
+        #full batches only, per bucket
+        num_batches = min(sum(count // self.batch_size for count in items.values()) for items in bucket_items)
+        return stream_shards, num_batches
+
+    #batches per rank in an epoch, every rank gets the same number
+    def num_batches(self, epoch=None):
+        return self._epoch_plan(self.epoch if epoch is None else epoch)[1] * self.num_workers
+
+    #num_batches_consumed: None = epoch boundary, resume starts the next epoch
+        #else batches of the current epoch already trained, summed over all ranks
+    def state_dict(self, num_batches_consumed=None):
+        if num_batches_consumed is None:
+            return {
+                "seed": self.seed,
+                "epoch": self.epoch + 1,
+                "leftover_items": [],
+                "num_batches_consumed": 0,
+            }
+        resumed = self.resume_num_batches if self.resume_epoch == self.epoch else 0
+        return {
+            "seed": self.seed,
+            "epoch": self.epoch,
+            "leftover_items": [],
+            "num_batches_consumed": resumed + num_batches_consumed,
+        }
+
+    #next epoch set by the trainer continues at the next batch, also accepts BucketBatchSampler states
+    #resume_num_batches: rounded up to whole worker rounds, see __iter__
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict["seed"]
+        self.epoch = state_dict["epoch"]
+        self.resume_epoch = state_dict["epoch"]
+        rank_rounds = -(-(state_dict["num_batches_consumed"] // self.num_processes) // self.num_workers)
+        self.resume_num_batches = rank_rounds * self.num_workers * self.num_processes
+
+    #yields samples of a shard: {"metadata": dict, suffix: bytearray}, members in file order
+    def _read_shard(self, shard_path):
+        with open(shard_path, "rb") as f:
+            with tarfile.open(fileobj=f, mode="r|", bufsize=tar_read_bufsize) as tar:
+                sample_id, sample = None, {}
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    member_id, _, suffix = member.name.partition(".")
+                    if member_id != sample_id:
+                        if sample:
+                            yield sample
+                        sample_id, sample = member_id, {}
+                    data = bytearray(member.size)
+                    tar.extractfile(member).readinto(data)
+                    if suffix == "json":
+                        sample["metadata"] = json.loads(data)
+                    else:
+                        sample[suffix] = data
+                if sample:
+                    yield sample
+
+    #CachedImageDataset item from a streamed sample
+    def _decode_item(self, sample, dropped):
+        metadata = sample["metadata"]
+        tensors = {}
+        for name in cached_tensor_names:
+            if dropped and name != "model_input":
+                continue
+            tensors[name] = tensor_from_npy_bytes(sample[f"{name}.npy"], metadata["dtypes"][name])
+        return {
+            "model_input": tensors["model_input"],
+            "conditional_dropout": dropped,
+            #empty embeds only give shape & dtype to cached_batch_collate, rows filled on device
+            "prompt_embed": self.empty_prompt_embed if dropped else tensors["prompt_embed"],
+            "pooled_prompt_embed": self.empty_pooled_prompt_embed if dropped else tensors["pooled_prompt_embed"],
+            "add_time_id": metadata["add_time_id"],
+            "category_key": metadata["category_key"],
+            "closest_bucket": metadata["category_key"],
+            "original_image_size": metadata["original_image_size"],
+            "cropped_image_size": metadata["cropped_image_size"],
+        }
+
+    #same-bucket batches of raw samples from a stream's shards, at most num_batches
+    def _sample_batches(self, shards, num_batches, rng):
+        shard_queue = deque(shard["path"] for shard in shards)
+        open_streams = []
+        buffers = defaultdict(list) #bucket: samples waiting
+        pending = defaultdict(list) #bucket: samples of the bucket's next batch
+        num_yielded = 0
+
+        def take(buffer):
+            i = rng.integers(len(buffer))
+            buffer[i], buffer[-1] = buffer[-1], buffer[i]
+            return buffer.pop()
+
+        try:
+            while num_yielded < num_batches:
+                while len(open_streams) < self.open_shards and shard_queue:
+                    open_streams.append(self._read_shard(shard_queue.popleft()))
+                if not open_streams:
+                    break
+                k = rng.integers(len(open_streams))
+                sample = next(open_streams[k], None)
+                if sample is None:
+                    open_streams.pop(k).close()
+                    continue
+                if self.keys is not None and sample["metadata"]["key"] not in self.keys:
+                    continue
+                bucket = tuple(sample["metadata"]["closest_bucket"])
+                buffers[bucket].append(sample)
+                if len(buffers[bucket]) >= self.shuffle_buffer:
+                    pending[bucket].append(take(buffers[bucket]))
+                    if len(pending[bucket]) == self.batch_size:
+                        yield pending.pop(bucket)
+                        num_yielded += 1
+
+            #shards done: remaining full batches, random bucket each batch
+            while num_yielded < num_batches:
+                ready = [bucket for bucket in buffers if len(buffers[bucket]) + len(pending[bucket]) >= self.batch_size]
+                if not ready:
+                    break
+                bucket = ready[rng.integers(len(ready))]
+                while len(pending[bucket]) < self.batch_size:
+                    pending[bucket].append(take(buffers[bucket]))
+                yield pending.pop(bucket)
+                num_yielded += 1
+        finally:
+            for stream in open_streams:
+                stream.close()
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        if num_workers != self.num_workers:
+            raise ValueError(f"TarShardIterableDataset: created for {self.num_workers} DataLoader workers, used with {num_workers}")
+        stream = self.process_index * self.num_workers + worker_id
+        stream_shards, num_batches = self._epoch_plan(self.epoch)
+
+        #resume: the DataLoader takes batches from workers in turn starting at worker 0
+            #every worker skips the same number of batches (whole rounds), the remaining batches keep the original order
+        skip = 0
+        if self.resume_epoch == self.epoch:
+            skip = self.resume_num_batches // self.num_processes // self.num_workers
+
+        rng = np.random.default_rng([self.seed, self.epoch, 2, stream])
+        dropout_rng = np.random.default_rng([self.seed, self.epoch, 1, stream]) #drawn for skipped batches too, same flags on resume
+        start_time = time.perf_counter()
+        for i, samples in enumerate(self._sample_batches(stream_shards[stream], num_batches, rng)):
+            dropped = dropout_rng.random(len(samples)) < self.conditional_dropout_percent
+            if i < skip:
+                continue
+            items = [self._decode_item(sample, bool(dropped[j])) for j, sample in enumerate(samples)]
+            fetch_seconds = time.perf_counter() - start_time
+            for item in items:
+                item["fetch_seconds"] = fetch_seconds
+            yield items
+            start_time = time.perf_counter()
@@ -28,6 +28,8 @@ from torchvision import transforms
 import torchvision.models as models
 from tqdm.auto import tqdm
 
+from sdxl_data_functions_18 import encode_caption_token_ids
+
 
 #creates sample images
 def make_sample_images(pipeline, generator, accelerator, sample_image_prompts, epoch, output_dir, train_name):
@@ -113,7 +115,8 @@ def make_sample_images(pipeline, generator, accelerator, sample_image_prompts, e
 
 
 #calculates validation_image scores, uses distributed state, not dataset/DataLoader
-def calculate_validation_image_scores(pipeline, generator, device, accelerator, validation_image_jsons, epoch, writer, output_dir):
+#metadata_lookup: optional {json_file: metadata} from catalog, avoids reading .metadata.json per item
+def calculate_validation_image_scores(pipeline, generator, device, accelerator, validation_image_jsons, epoch, writer, output_dir, metadata_lookup=None):
 
     with torch.no_grad(): #validation, no gradients
         
@@ -213,8 +216,11 @@ def calculate_validation_image_scores(pipeline, generator, device, accelerator,
                 val_image_idx += 1 #count idx per json, for tracking to ensure json_list division between GPUs
                 accelerator.print(f"\rvalidating: [{val_image_idx}]", end="")
                 #read json metadata, get info for reference image & generated image parameters
-                with open(json_file, "r") as f: #open and read json file
-                    metadata = json.load(f)
+                if metadata_lookup is not None and json_file in metadata_lookup:
+                    metadata = metadata_lookup[json_file]
+                else:
+                    with open(json_file, "r") as f: #open and read json file
+                        metadata = json.load(f)
                 prompt = metadata["caption_string"]
                 height = metadata["cropped_image_height"]
                 width = metadata["cropped_image_width"]
@@ -444,7 +450,8 @@ def calculate_validation_image_scores(pipeline, generator, device, accelerator,
             print(f"seconds per imgs: {secs_img:.2f}seconds/img")
 
 
-def calculate_validation_loss(accelerator, unet, validation_loss_dataloader, val_batch_size, num_val_steps_per_epoch, num_processes, noise_scheduler, writer, epoch):
+#text_encoders: (text_encoder_one, text_encoder_two) with --encode_text_on_the_fly, batches carry token ids instead of prompt embeds
+def calculate_validation_loss(accelerator, unet, validation_loss_dataloader, val_batch_size, num_val_steps_per_epoch, num_processes, noise_scheduler, writer, epoch, text_encoders=None):
 
     with torch.no_grad():
         if accelerator.is_main_process:
@@ -466,6 +473,10 @@ def calculate_validation_loss(accelerator, unet, validation_loss_dataloader, val
 
         for step, batch in enumerate(validation_loss_dataloader):
 
+            #prompt embeds from token ids, see sdxl_data_functions encode_caption_token_ids
+            if text_encoders is not None:
+                batch["prompt_embed"], batch["pooled_prompt_embed"] = encode_caption_token_ids(batch["token_ids_one"], batch["token_ids_two"], *text_encoders, accelerator, accelerator.device)
+
             #sample noise to add to latents
             noise = torch.randn_like(batch["model_input"]) #create noise in the shape of latent tensor
             bsz = batch["model_input"].shape[0] #bsz = batch size
@@ -477,9 +488,8 @@ def calculate_validation_loss(accelerator, unet, validation_loss_dataloader, val
             #add noise to the latents according to the noise magnitude at each timestep (noise manitude@timestep is set by scheduler)
             noisy_model_input = noise_scheduler.add_noise(batch["model_input"], noise, timesteps)
 
-            #time_ids come in as a list of six tensors, with num_values per tensor = batch_size, then it gets flattened here
-            add_time_id = torch.cat(batch["add_time_id"], dim=0).view(-1)
-            #add_time_id.shape: torch.Size([66] #6 * batch_size 11
+            #time_ids: [bsz, 6] from cached_batch_collate, one row per sample
+            add_time_id = batch["add_time_id"]
 
             # Predict the noise residual
             unet_added_conditions = {"time_ids": add_time_id}
@@ -15,7 +15,19 @@
 #	--save_samples \ #save sample_images during training
 #	--validation_image #use validation_image (IS/FID/KID/LPIPS/HPSv2) scoring
 #	--verify_cached_dataset_hash_values #verify cached dataset integrity before training
+#	--verify_deep_check #with --verify_cached_dataset_hash_values, also load cached tensors: shape, dtype & NaN/Inf check
 #	--validation_loss #use validation_loss
+#	--num_workers 4 \ #DataLoader worker processes, same batches & dropout as 0 for a fixed --set_seed
+#	--prefetch_factor 2 \ #batches loaded in advance per worker, with --num_workers > 0
+#	--persistent_workers \ #keep DataLoader workers alive between epochs, with --num_workers > 0
+#	--pin_memory \ #pinned memory batches, faster host to gpu copies
+#	--fetch_threads 8 \ #threads reading each batch's cached files in parallel, 0 = one item after another
+#	--prefetch_batches 2 \ #training batches copied to the gpu ahead of each step, 0 = off
+#	--tar_shard_dirs /path/to/tar_shards \ #stream training items from tar shards, see sdxl_convert_cache_format --output_format tar_shards
+#	--readahead_batches 4 \ #upcoming batches' cached files requested from the OS ahead of the dataset, for HDD/NFS cache dirs, 0 = off
+#	--node_shared_cache \ #one copy of the cached tensors per node in /dev/shm, shared by all local ranks, if the dataset fits in RAM
+#	--dataset_ram_cache_gb 32 \ #in-RAM LRU cache of cached tensors per gpu process, small/medium datasets aren't re-read from disk each epoch
+#	--encode_text_on_the_fly \ #text encode cached token ids each step instead of reading prompt embeds, for I/O bound nodes, needs token ids in the cache
 #	--load_saved_state \ #load saved unet
 
 #see sdxl_FSDP_train for full list of arguments
@@ -0,0 +1,36 @@
+#aspect_categories_reference.py
+#reference aspect_categories table, as pasted into sdxl_data_functions_18 before the table was generated at runtime
+#created with create_aspects.py: 256 to 2048, step 64, max_aspect_ratio 2.0
+#used by verify_bucket_engine.py
+
+aspect_categories = {
+    256: [[256, 256], [192, 320], [320, 192], [192, 256], [256, 192]],
+    320: [[320, 320], [256, 384], [384, 256], [320, 256], [256, 320], [384, 192], [192, 384]],
+    384: [[384, 384], [320, 448], [448, 320], [256, 512], [512, 256], [384, 320], [320, 384], [256, 448], [448, 256]],
+    448: [[448, 448], [384, 512], [512, 384], [320, 576], [576, 320], [448, 384], [384, 448], [320, 512], [512, 320]],
+    512: [[512, 512], [448, 576], [576, 448], [640, 384], [384, 640], [512, 448], [448, 512], [384, 576], [576, 384], [640, 320], [320, 640]],
+    576: [[576, 576], [512, 640], [640, 512], [448, 704], [704, 448], [576, 512], [512, 576], [384, 768], [768, 384], [640, 448], [448, 640], [384, 704], [704, 384]],
+    640: [[640, 640], [704, 576], [576, 704], [896, 448], [448, 896], [512, 768], [768, 512], [832, 448], [448, 832], [576, 640], [640, 576], [704, 512], [512, 704], [448, 768], [768, 448]],
+    704: [[704, 704], [960, 512], [768, 640], [640, 768], [512, 960], [832, 576], [576, 832], [896, 512], [512, 896], [704, 640], [640, 704], [768, 576], [576, 768], [832, 512], [512, 832]],
+    768: [[768, 768], [1024, 576], [576, 1024], [704, 832], [832, 704], [896, 640], [640, 896], [960, 576], [576, 960], [768, 704], [704, 768], [832, 640], [640, 832], [1024, 512], [512, 1024], [896, 576], [576, 896]],
+    832: [[832, 832], [768, 896], [896, 768], [960, 704], [704, 960], [1152, 576], [576, 1152], [1024, 640], [640, 1024], [768, 832], [832, 768], [896, 704], [704, 896], [1088, 576], [576, 1088], [960, 640], [640, 960]],
+    896: [[896, 896], [960, 832], [832, 960], [768, 1024], [1024, 768], [640, 1216], [1216, 640], [704, 1088], [1088, 704], [896, 832], [832, 896], [768, 960], [640, 1152], [1152, 640], [960, 768], [704, 1024], [1024, 704], [640, 1088], [1088, 640]],
+    960: [[960, 960], [1024, 896], [896, 1024], [832, 1088], [1088, 832], [704, 1280], [1280, 704], [768, 1152], [1152, 768], [960, 896], [896, 960], [704, 1216], [1216, 704], [832, 1024], [1024, 832], [768, 1088], [1088, 768], [640, 1280], [1280, 640], [704, 1152], [1152, 704]],
+    1024: [[1024, 1024], [1088, 960], [960, 1088], [768, 1344], [1344, 768], [1152, 896], [896, 1152], [832, 1216], [1216, 832], [1408, 704], [704, 1408], [768, 1280], [1280, 768], [1024, 960], [960, 1024], [896, 1088], [1088, 896], [832, 1152], [1152, 832], [704, 1344], [1344, 704], [768, 1216], [1216, 768]],
+    1088: [[1088, 1088], [1536, 768], [768, 1536], [1152, 1024], [1024, 1152], [832, 1408], [1408, 832], [1216, 960], [960, 1216], [896, 1280], [1280, 896], [1472, 768], [768, 1472], [832, 1344], [1344, 832], [1088, 1024], [1024, 1088], [1152, 960], [960, 1152], [896, 1216], [1216, 896], [1408, 768], [768, 1408], [832, 1280], [1280, 832]],
+    1152: [[1152, 1152], [1216, 1088], [1088, 1216], [896, 1472], [1472, 896], [1280, 1024], [1024, 1280], [960, 1344], [1344, 960], [1536, 832], [832, 1536], [896, 1408], [1408, 896], [1152, 1088], [1088, 1152], [1216, 1024], [1024, 1216], [960, 1280], [1280, 960], [832, 1472], [1472, 832], [896, 1344], [1344, 896]],
+    1216: [[1216, 1216], [960, 1536], [1536, 960], [1280, 1152], [1152, 1280], [1344, 1088], [1088, 1344], [1408, 1024], [1024, 1408], [1600, 896], [896, 1600], [960, 1472], [1472, 960], [1216, 1152], [1152, 1216], [1280, 1088], [1088, 1280], [1664, 832], [832, 1664], [896, 1536], [1536, 896], [1344, 1024], [1024, 1344], [960, 1408], [1408, 960], [1600, 832], [832, 1600]],
+    1280: [[1600, 1024], [1280, 1280], [1024, 1600], [1344, 1216], [1216, 1344], [1408, 1152], [1152, 1408], [1792, 896], [896, 1792], [1472, 1088], [1088, 1472], [1664, 960], [960, 1664], [1536, 1024], [1024, 1536], [1280, 1216], [1216, 1280], [1728, 896], [896, 1728], [1344, 1152], [1152, 1344], [960, 1600], [1600, 960], [1408, 1088], [1088, 1408], [1472, 1024], [1024, 1472], [1664, 896], [896, 1664]],
+    1344: [[1344, 1344], [1408, 1280], [1280, 1408], [1472, 1216], [1216, 1472], [960, 1856], [1856, 960], [1024, 1728], [1728, 1024], [1536, 1152], [1152, 1536], [1600, 1088], [1088, 1600], [1792, 960], [960, 1792], [1344, 1280], [1280, 1344], [1408, 1216], [1216, 1408], [1664, 1024], [1024, 1664], [1472, 1152], [1152, 1472], [1536, 1088], [1088, 1536], [1728, 960], [960, 1728]],
+    1408: [[1408, 1408], [1472, 1344], [1344, 1472], [1024, 1920], [1536, 1280], [1280, 1536], [1920, 1024], [1088, 1792], [1792, 1088], [1600, 1216], [1216, 1600], [1664, 1152], [1152, 1664], [1024, 1856], [1856, 1024], [1408, 1344], [1344, 1408], [1472, 1280], [1280, 1472], [1728, 1088], [1088, 1728], [1536, 1216], [1216, 1536], [1600, 1152], [960, 1920], [1920, 960], [1152, 1600], [1024, 1792], [1792, 1024], [1664, 1088], [1088, 1664]],
+    1472: [[1472, 1472], [1536, 1408], [1408, 1536], [1088, 1984], [1984, 1088], [1600, 1344], [1344, 1600], [1856, 1152], [1152, 1856], [1664, 1280], [1280, 1664], [1728, 1216], [1216, 1728], [1024, 2048], [2048, 1024], [1088, 1920], [1920, 1088], [1472, 1408], [1408, 1472], [1792, 1152], [1536, 1344], [1344, 1536], [1152, 1792], [1600, 1280], [1280, 1600], [1024, 1984], [1984, 1024], [1664, 1216], [1216, 1664], [1088, 1856], [1856, 1088], [1728, 1152], [1152, 1728]],
+    1536: [[1152, 2048], [1536, 1536], [2048, 1152], [1600, 1472], [1472, 1600], [1664, 1408], [1408, 1664], [1216, 1920], [1920, 1216], [1728, 1344], [1344, 1728], [1088, 2112], [2112, 1088], [1792, 1280], [1280, 1792], [1984, 1152], [1152, 1984], [1536, 1472], [1472, 1536], [1216, 1856], [1856, 1216], [1600, 1408], [1408, 1600], [1664, 1344], [1344, 1664], [1088, 2048], [2048, 1088], [1728, 1280], [1280, 1728], [1920, 1152], [1152, 1920], [1792, 1216], [1216, 1792]],
+    1600: [[1600, 1600], [1664, 1536], [1536, 1664], [1728, 1472], [1472, 1728], [1280, 1984], [1984, 1280], [1792, 1408], [1408, 1792], [1152, 2176], [2176, 1152], [1344, 1856], [1856, 1344], [2048, 1216], [1216, 2048], [1600, 1536], [1536, 1600], [1280, 1920], [1920, 1280], [1664, 1472], [1472, 1664], [1152, 2112], [1728, 1408], [1408, 1728], [2112, 1152], [1216, 1984], [1984, 1216], [1792, 1344], [1344, 1792], [1280, 1856], [1856, 1280], [1088, 2176], [2176, 1088]],
+    1664: [[1664, 1664], [1728, 1600], [1600, 1728], [1792, 1536], [1536, 1792], [2048, 1344], [1344, 2048], [1856, 1472], [1472, 1856], [2240, 1216], [1216, 2240], [1408, 1920], [2112, 1280], [1280, 2112], [1920, 1408], [1344, 1984], [1984, 1344], [1664, 1600], [1600, 1664], [1152, 2304], [1728, 1536], [2304, 1152], [1536, 1728], [2176, 1216], [1216, 2176], [1792, 1472], [1472, 1792], [2048, 1280], [1280, 2048], [1408, 1856], [1856, 1408], [1152, 2240], [2240, 1152], [1344, 1920], [1920, 1344], [2112, 1216], [1216, 2112]],
+    1728: [[1728, 1728], [1792, 1664], [1664, 1792], [1408, 2112], [2112, 1408], [1856, 1600], [1600, 1856], [2432, 1216], [1216, 2432], [1920, 1536], [2304, 1280], [1536, 1920], [1280, 2304], [2176, 1344], [1344, 2176], [1472, 1984], [1984, 1472], [1408, 2048], [2048, 1408], [2368, 1216], [1216, 2368], [1728, 1664], [1664, 1728], [1792, 1600], [1600, 1792], [2240, 1280], [1280, 2240], [1856, 1536], [1536, 1856], [2112, 1344], [1344, 2112], [1472, 1920], [1920, 1472], [2304, 1216], [1216, 2304], [1408, 1984], [1984, 1408], [2176, 1280], [1280, 2176]],
+    1792: [[1792, 1792], [1856, 1728], [1728, 1856], [1472, 2176], [2176, 1472], [1920, 1664], [2496, 1280], [1664, 1920], [1280, 2496], [2368, 1344], [1344, 2368], [1984, 1600], [1600, 1984], [2240, 1408], [1408, 2240], [1536, 2048], [2048, 1536], [2432, 1280], [1280, 2432], [1472, 2112], [2112, 1472], [1792, 1728], [1728, 1792], [2304, 1344], [1344, 2304], [1856, 1664], [1664, 1856], [1920, 1600], [1600, 1920], [1408, 2176], [2176, 1408], [1536, 1984], [1984, 1536], [2368, 1280], [1280, 2368], [1472, 2048], [2048, 1472], [2240, 1344], [1344, 2240]],
+    1856: [[1856, 1856], [1920, 1792], [2560, 1344], [1792, 1920], [2240, 1536], [1536, 2240], [1344, 2560], [1984, 1728], [1728, 1984], [2432, 1408], [1408, 2432], [1664, 2048], [2048, 1664], [2304, 1472], [1472, 2304], [1600, 2112], [2112, 1600], [2496, 1344], [1344, 2496], [1536, 2176], [2176, 1536], [2368, 1408], [1408, 2368], [1856, 1792], [1792, 1856], [1920, 1728], [1728, 1920], [1984, 1664], [1664, 1984], [2240, 1472], [1472, 2240], [1280, 2560], [2560, 1280], [1600, 2048], [2048, 1600], [2432, 1344], [1344, 2432], [2304, 1408], [1536, 2112], [1408, 2304], [2112, 1536]],
+    1920: [[1920, 1920], [2304, 1600], [1600, 2304], [1984, 1856], [1856, 1984], [2496, 1472], [1472, 2496], [1792, 2048], [2048, 1792], [1728, 2112], [2112, 1728], [2368, 1536], [1536, 2368], [1664, 2176], [2176, 1664], [2688, 1344], [1344, 2688], [2560, 1408], [1408, 2560], [2240, 1600], [1600, 2240], [2432, 1472], [1472, 2432], [1920, 1856], [1856, 1920], [1984, 1792], [1792, 1984], [1728, 2048], [2304, 1536], [1536, 2304], [2048, 1728], [2624, 1344], [1344, 2624], [2496, 1408], [1664, 2112], [1408, 2496], [2112, 1664], [2368, 1472], [1472, 2368], [1600, 2176], [2176, 1600]],
+    1984: [[1984, 1984], [1920, 2048], [2560, 1536], [1536, 2560], [2048, 1920], [1856, 2112], [2112, 1856], [1792, 2176], [2176, 1792], [2432, 1600], [1600, 2432], [1408, 2752], [2752, 1408], [1728, 2240], [2240, 1728], [2624, 1472], [1472, 2624], [2496, 1536], [1664, 2304], [2304, 1664], [1536, 2496], [1984, 1920], [1920, 1984], [1856, 2048], [2048, 1856], [2368, 1600], [1600, 2368], [1792, 2112], [1408, 2688], [2112, 1792], [2688, 1408], [2560, 1472], [1472, 2560], [1728, 2176], [2176, 1728], [2432, 1536], [1536, 2432], [1664, 2240], [2240, 1664], [1408, 2624], [2624, 1408]],
+    2048: [[2048, 2048], [1984, 2112], [2112, 1984], [1920, 2176], [2176, 1920], [1856, 2240], [2240, 1856], [2496, 1664], [1664, 2496], [2816, 1472], [1472, 2816], [2688, 1536], [1792, 2304], [2304, 1792], [1536, 2688], [2560, 1600], [1600, 2560], [1728, 2368], [2368, 1728], [1984, 2048], [2048, 1984], [1920, 2112], [2112, 1920], [2752, 1472], [1472, 2752], [2432, 1664], [1664, 2432], [1856, 2176], [2176, 1856], [2624, 1536], [1536, 2624], [1792, 2240], [2240, 1792], [2496, 1600], [1600, 2496], [1728, 2304], [2304, 1728], [2816, 1408], [1408, 2816], [1472, 2688], [2688, 1472], [2368, 1664], [1664, 2368]],
+}
@@ -0,0 +1,147 @@
+#verify_bucket_batch_sampler.py
+#checks BucketBatchSampler + CachedImageDataset batch order is independent of DataLoader workers & exact on resume:
+    #DataLoader batches (item ids & conditional_dropout_mask) for num_workers 1, 2, 4 == num_workers=0, same seed, over several epochs
+    #num_workers=0 batches == the sampler's own [(index, dropped), ...] batches
+    #resume: state_dict(num_batches_consumed) mid-epoch -> new sampler load_state_dict -> remaining batches identical, any num_workers
+    #json_file list built like sdxl_train (load_cached_json_list of .list files): same order under any PYTHONHASHSEED
+    #leftover items restored by json_file on a dataset in another item order
+#builds a small synthetic cached dataset in a temp dir, each item's model_input is filled with its index
+#run from the repo root (empty prompt embed files): python utils/verify_bucket_batch_sampler.py
+
+import functools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sdxl_data_functions_18 import CachedImageDataset, BucketBatchSampler, cached_batch_collate, load_cached_json_list
+from sdxl_codec_functions_01 import dump_tensor
+
+
+num_items = 61
+batch_size = 4
+conditional_dropout_percent = 0.3
+seed = 123
+num_epochs = 3
+buckets = [[1024, 1024], [832, 1216], [1216, 832], [896, 1152]]
+
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+#cached dataset with tiny tensors, model_input of item i filled with i, zero padded names: sorted order == i
+#returns 2 .list files: shuffled, overlapping, with an empty line, like merged & re-cached lists
+def create_cached_dataset(cache_dir):
+    json_file_paths_list = []
+    for i in range(num_items):
+        closest_bucket = buckets[(i * 7) % len(buckets)]
+        metadata = {
+            "closest_bucket": closest_bucket,
+            "category_key": 1024,
+            "add_time_id": [closest_bucket[1], closest_bucket[0], 0, 0, closest_bucket[1], closest_bucket[0]],
+            "original_image_size": closest_bucket,
+            "cropped_image_size": closest_bucket,
+            "storage_codec": "raw",
+        }
+        for name, shape in [("model_input", (4, closest_bucket[1] // 64, closest_bucket[0] // 64)), ("prompt_embed", (77, 2048)), ("pooled_prompt_embed", (1280,))]:
+            tensor_file = os.path.join(cache_dir, f"{i:05d}.{name}.pkl")
+            dump_tensor(torch.full(shape, float(i)), tensor_file, "raw")
+            metadata[f"{name}_file"] = tensor_file
+        json_file = os.path.join(cache_dir, f"{i:05d}.metadata.json")
+        with open(json_file, "w") as f:
+            json.dump(metadata, f)
+        json_file_paths_list.append(json_file)
+    rng = random.Random(seed)
+    list_files = []
+    for list_number, (start, end) in enumerate([(0, num_items * 2 // 3), (num_items // 2, num_items)]):
+        json_files = json_file_paths_list[start:end] + [""]
+        rng.shuffle(json_files)
+        list_file = os.path.join(cache_dir, f"cached_{list_number}.list")
+        with open(list_file, "w") as f:
+            f.writelines(f"{json_file}\n" for json_file in json_files)
+        list_files.append(list_file)
+    return list_files
+
+
+#load_cached_json_list in a new python process with hash_seed
+def load_cached_json_list_subprocess(list_files, hash_seed):
+    code = f"import json, sys; sys.path.insert(0, {repo_dir!r}); from sdxl_data_functions_18 import load_cached_json_list; print(json.dumps(load_cached_json_list({list_files!r})))"
+    result = subprocess.run([sys.executable, "-c", code], env={**os.environ, "PYTHONHASHSEED": str(hash_seed)}, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+#(item ids, dropout flags) per batch
+def batch_key(batch):
+    return batch["model_input"][:, 0, 0, 0].long().tolist(), batch["conditional_dropout_mask"].tolist()
+
+
+def sampler_key(batch):
+    return [index for index, dropped in batch], [dropped for index, dropped in batch]
+
+
+#trains num_epochs, stops after stop_after batches if set: returns batch keys & the sampler's state_dict at the stop
+def run_dataloader(json_file_paths_list, num_workers, state_dict=None, stop_after=None):
+    dataset = CachedImageDataset(json_file_paths_list, conditional_dropout_percent)
+    sampler = BucketBatchSampler(dataset, batch_size, seed=seed)
+    if state_dict is not None:
+        sampler.load_state_dict(state_dict)
+    worker_arguments = {"prefetch_factor": 2, "persistent_workers": True} if num_workers > 0 else {}
+    dataloader = DataLoader(dataset, batch_sampler=sampler, num_workers=num_workers, collate_fn=functools.partial(cached_batch_collate, pin_memory=False), **worker_arguments)
+    keys = []
+    for epoch in range(num_epochs):
+        for step, batch in enumerate(dataloader):
+            keys.append(batch_key(batch))
+            if stop_after is not None and len(keys) == stop_after:
+                return keys, sampler.state_dict(num_batches_consumed=step + 1)
+    return keys, None
+
+
+with tempfile.TemporaryDirectory() as cache_dir:
+    list_files = create_cached_dataset(cache_dir)
+
+    #json_file list, sdxl_train loading path
+    json_file_paths_list = load_cached_json_list(list_files)
+    assert len(json_file_paths_list) == num_items, "duplicate or empty .list lines kept"
+    for hash_seed in [1, 2]:
+        assert load_cached_json_list_subprocess(list_files, hash_seed) == json_file_paths_list, f"json_file order differs with PYTHONHASHSEED={hash_seed}"
+    print(f"json_file list: {num_items} items, same order for different PYTHONHASHSEED")
+
+    #sampler only
+    sampler = BucketBatchSampler(CachedImageDataset(json_file_paths_list, conditional_dropout_percent), batch_size, seed=seed)
+    sampler_keys = [sampler_key(batch) for epoch in range(num_epochs) for batch in sampler]
+    num_dropped = sum(sum(dropped) for ids, dropped in sampler_keys)
+    num_batched = sum(len(dropped) for ids, dropped in sampler_keys)
+    assert 0 < num_dropped < num_batched, "conditional dropout flags not drawn"
+    print(f"sampler: {len(sampler_keys)} batches, {num_dropped}/{num_batched} items dropped")
+
+    #worker counts
+    reference_keys, _ = run_dataloader(json_file_paths_list, 0)
+    assert reference_keys == sampler_keys, "num_workers=0 batches differ from sampler batches"
+    for num_workers in [1, 2, 4]:
+        keys, _ = run_dataloader(json_file_paths_list, num_workers)
+        assert keys == reference_keys, f"num_workers={num_workers} batches differ from num_workers=0"
+        print(f"dataloader: num_workers={num_workers} {len(keys)} batches identical to num_workers=0")
+
+    #resume mid-epoch, in the first & a later epoch
+    epoch_length = len(reference_keys) // num_epochs
+    for stop_after in [3, epoch_length + 5]:
+        for num_workers, resume_num_workers in [(0, 0), (0, 2), (2, 0), (2, 4)]:
+            keys, state_dict = run_dataloader(json_file_paths_list, num_workers, stop_after=stop_after)
+            resumed_keys, _ = run_dataloader(json_file_paths_list, resume_num_workers, state_dict=state_dict)
+            assert keys + resumed_keys[:len(reference_keys) - stop_after] == reference_keys, f"resume after {stop_after} batches, num_workers {num_workers} -> {resume_num_workers}, batches differ"
+        print(f"resume: after {stop_after} batches (epoch {state_dict['epoch']}), remaining batches identical")
+
+    #leftover items by json_file, dataset in reversed item order
+    assert len(state_dict["leftover_items"]) > 0, "no leftover items to check"
+    reversed_sampler = BucketBatchSampler(CachedImageDataset(json_file_paths_list[::-1], conditional_dropout_percent), batch_size, seed=seed)
+    reversed_sampler.load_state_dict(state_dict)
+    assert [json_file_paths_list[::-1][index] for index in reversed_sampler.leftover_items] == state_dict["leftover_json_files"], "leftover items not restored by json_file"
+    print(f"resume: {len(state_dict['leftover_items'])} leftover items restored by json_file")
+
+print("  --bucket batch sampler verified")
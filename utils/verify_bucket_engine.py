@@ -0,0 +1,49 @@
+#verify_bucket_engine.py
+#checks sdxl_bucket_functions against the reference aspect_categories table & the per image bucket code it replaced:
+    #generated table == aspect_categories_reference.py, same keys, buckets & bucket order
+    #AspectBucketEngine.assign == next(...) category_key & min(...) closest_bucket, for random & edge case image sizes
+#run from the repo root: python utils/verify_bucket_engine.py
+
+import math
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sdxl_bucket_functions_01 import create_aspect_categories, get_bucket_engine
+from aspect_categories_reference import aspect_categories as reference_aspect_categories
+
+
+#per image bucket code, as used by preprocess_image before the bucket engine
+def reference_assign(width, height, sorted_categories_keys, max_resolution):
+    image_pixels_64 = ((width // 64) * 64) * ((height // 64) * 64)
+    image_pixels_64_sqrt = int(math.sqrt(image_pixels_64))
+    category_key = next((key for key in sorted_categories_keys if key >= image_pixels_64_sqrt), max_resolution)
+    aspect_ratios = reference_aspect_categories[category_key]
+    original_aspect_ratio = width / height
+    closest_bucket = min(aspect_ratios, key=lambda x: abs((x[0]/x[1]) - original_aspect_ratio))
+    return category_key, closest_bucket
+
+
+#table
+aspect_categories = create_aspect_categories(256, 2048, 64, 2.0)
+assert list(aspect_categories) == list(reference_aspect_categories), "category keys differ"
+for key in reference_aspect_categories:
+    assert aspect_categories[key] == reference_aspect_categories[key], f"buckets differ for category {key}"
+print(f"table: {len(aspect_categories)} categories identical")
+
+#assignment
+bucket_engine = get_bucket_engine(256, 2048, 64, 2.0)
+rng = np.random.default_rng(0)
+widths = np.concatenate([rng.integers(64, 8192, 200000), np.arange(64, 4097, 1), [64, 8191, 1024, 1023, 1088]])
+heights = np.concatenate([rng.integers(64, 8192, 200000), np.arange(4096, 63, -1), [8191, 64, 1024, 1025, 1024]])
+for min_resolution, max_resolution in [(256, 2048), (512, 1024), (256, 1536), (1024, 1024), (320, 1792)]:
+    sorted_categories_keys = sorted(key for key in reference_aspect_categories if max_resolution >= key >= min_resolution)
+    category_keys, closest_buckets = bucket_engine.assign(widths, heights, min_resolution, max_resolution)
+    for i in range(len(widths)):
+        category_key, closest_bucket = reference_assign(int(widths[i]), int(heights[i]), sorted_categories_keys, max_resolution)
+        assert category_keys[i] == category_key and closest_buckets[i].tolist() == closest_bucket, (widths[i], heights[i], min_resolution, max_resolution)
+    print(f"assign: {len(widths)} image sizes identical, resolution {min_resolution}-{max_resolution}")
+
+print("  --bucket engine verified")